@@ -0,0 +1,253 @@
+import os
+import math
+import time
+import asyncio
+import threading
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+# Admission control for the API. Every request that does real work first
+# reserves an estimate of its peak memory and CPU from a process-wide budget:
+#
+#   interactive  previews, single-file plans, explanations - may use the whole
+#                budget and are always granted before any waiting batch
+#   batch        /apply-plan, jobs, dataset plans - capped at batch_share of the
+#                memory and CPU budgets (and at one CPU slot less than
+#                interactive requests get), so previews keep headroom even
+#                under bulk load
+#
+# Requests that don't fit wait in a strict priority FIFO (interactive first) for
+# up to their class's max wait, then are rejected with a retry hint. Waiting is
+# done on the event loop, and releases may come from any thread (background
+# jobs hold their reservation until they finish).
+
+PRIORITIES = ("interactive", "batch")
+
+
+@dataclass
+class Cost:
+    memory_bytes: int
+    cpu_slots: int = 1
+
+
+@dataclass
+class Ticket:
+    cost: Cost
+    priority: str
+    granted_at: float = 0.0
+    released: bool = False
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, retry_after_s: int, reason: str):
+        super().__init__(reason)
+        self.retry_after_s = retry_after_s
+        self.reason = reason
+
+
+@dataclass(order=True)
+class _Waiter:
+    rank: int
+    seq: int
+    ticket: Ticket = field(compare=False)
+    future: Any = field(compare=False)
+    loop: Any = field(compare=False)
+
+
+class AdmissionController:
+    def __init__(self,
+                 memory_budget_bytes: int = 2 * 1024 ** 3,
+                 cpu_slots: int = None,
+                 batch_share: float = 0.75,
+                 max_wait_s: Dict[str, float] = None,
+                 max_queue: int = 64):
+        self.memory_budget = memory_budget_bytes
+        self.cpu_slots = cpu_slots or (os.cpu_count() or 4)
+        self.batch_share = batch_share
+        self.max_wait_s = {"interactive": 10.0, "batch": 30.0, **(max_wait_s or {})}
+        self.max_queue = max_queue
+        self.memory_in_use = 0
+        self.cpu_in_use = 0
+        self._waiters: List[_Waiter] = []
+        self._seq = 0
+        self._lock = threading.Lock()
+        # EWMA of how long each class holds its reservation, for Retry-After
+        self._hold_s = {p: 1.0 for p in PRIORITIES}
+        self.counts = {p: {"admitted": 0, "queued": 0, "rejected": 0} for p in PRIORITIES}
+
+    @classmethod
+    def from_env(cls) -> "AdmissionController":
+        env = os.environ.get
+        cpu = env("PRISM_CPU_SLOTS")
+        return cls(memory_budget_bytes=int(env("PRISM_MEMORY_BUDGET_BYTES", 2 * 1024 ** 3)),
+                   cpu_slots=int(cpu) if cpu else None,
+                   batch_share=float(env("PRISM_BATCH_SHARE", 0.75)),
+                   max_wait_s={"interactive": float(env("PRISM_INTERACTIVE_WAIT_S", 10)),
+                               "batch": float(env("PRISM_BATCH_WAIT_S", 30))})
+
+    # (memory, cpu) a class may fill up to. Batches never get the last CPU slot an
+    # interactive request could use; on a single slot that means previews may
+    # oversubscribe by one rather than queue behind a whole batch.
+    def _limits(self, priority: str) -> Tuple[int, int]:
+        batch_cpu = max(1, min(int(self.cpu_slots * self.batch_share), self.cpu_slots - 1))
+        if priority == "batch":
+            return int(self.memory_budget * self.batch_share), batch_cpu
+        return self.memory_budget, max(self.cpu_slots, batch_cpu + 1)
+
+    # Clamp to the class limit so an oversized request can still run alone
+    def _clamp(self, cost: Cost, priority: str) -> Cost:
+        mem_limit, cpu_limit = self._limits(priority)
+        return Cost(min(cost.memory_bytes, mem_limit), min(cost.cpu_slots, cpu_limit))
+
+    def _fits(self, ticket: Ticket) -> bool:
+        mem_limit, cpu_limit = self._limits(ticket.priority)
+        return (self.memory_in_use + ticket.cost.memory_bytes <= mem_limit
+                and self.cpu_in_use + ticket.cost.cpu_slots <= cpu_limit)
+
+    # Strict priority FIFO: grant from the head until a waiter doesn't fit. Lock held.
+    def _grant_waiters(self) -> None:
+        while self._waiters and self._fits(self._waiters[0].ticket):
+            waiter = self._waiters.pop(0)
+            self._grant(waiter.ticket)
+            waiter.loop.call_soon_threadsafe(_resolve, waiter.future)
+
+    # Drop a waiter that gave up; whoever queued behind it may fit now. Lock held.
+    def _abandon(self, waiter: "_Waiter") -> bool:
+        if waiter not in self._waiters:
+            return False
+        self._waiters.remove(waiter)
+        self._grant_waiters()
+        return True
+
+    def _grant(self, ticket: Ticket) -> None:
+        self.memory_in_use += ticket.cost.memory_bytes
+        self.cpu_in_use += ticket.cost.cpu_slots
+        ticket.granted_at = time.monotonic()
+        self.counts[ticket.priority]["admitted"] += 1
+
+    def retry_after(self, priority: str) -> int:
+        return max(1, math.ceil(self._hold_s[priority]))
+
+    async def acquire(self, cost: Cost, priority: str = "interactive") -> Ticket:
+        ticket = Ticket(self._clamp(cost, priority), priority)
+        with self._lock:
+            # Nobody ahead of us that we'd overtake: grant straight away
+            ahead = [w for w in self._waiters if w.rank <= PRIORITIES.index(priority)]
+            if not ahead and self._fits(ticket):
+                self._grant(ticket)
+                return ticket
+            if len(self._waiters) >= self.max_queue or self.max_wait_s[priority] <= 0:
+                self.counts[priority]["rejected"] += 1
+                raise AdmissionRejected(self.retry_after(priority), "server busy")
+            loop = asyncio.get_running_loop()
+            self._seq += 1
+            waiter = _Waiter(PRIORITIES.index(priority), self._seq, ticket, loop.create_future(), loop)
+            self._waiters.append(waiter)
+            self._waiters.sort()
+            self.counts[priority]["queued"] += 1
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), self.max_wait_s[priority])
+            return ticket
+        except asyncio.TimeoutError:
+            with self._lock:
+                if self._abandon(waiter):
+                    self.counts[priority]["rejected"] += 1
+                    raise AdmissionRejected(self.retry_after(priority), "timed out waiting for capacity")
+            # Granted just as we timed out
+            return ticket
+        except asyncio.CancelledError:  # client went away while queued
+            with self._lock:
+                if self._abandon(waiter):
+                    raise
+            self.release(ticket)
+            raise
+
+    def release(self, ticket: Ticket) -> None:
+        with self._lock:
+            if ticket.released or not ticket.granted_at:
+                return
+            ticket.released = True
+            self.memory_in_use -= ticket.cost.memory_bytes
+            self.cpu_in_use -= ticket.cost.cpu_slots
+            held = time.monotonic() - ticket.granted_at
+            self._hold_s[ticket.priority] = 0.8 * self._hold_s[ticket.priority] + 0.2 * held
+            self._grant_waiters()
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            queued = {p: sum(w.ticket.priority == p for w in self._waiters) for p in PRIORITIES}
+        return {"memory_budget_bytes": self.memory_budget, "memory_in_use_bytes": self.memory_in_use,
+                "cpu_slots": self.cpu_slots, "cpu_in_use": self.cpu_in_use, "queued": queued,
+                "counts": self.counts}
+
+
+def _resolve(future: asyncio.Future) -> None:
+    if not future.done():
+        future.set_result(None)
+
+
+# --- Cost estimates ----------------------------------------------------------------
+# Deliberately rough peak-memory models (check them against the benchmark suite's
+# peak RSS when tuning): a parsed CSV costs several times its text size, text a
+# few copies of the decoded string, and an image its decoded pixels times the
+# number of intermediate arrays the plan creates (float normalize and augment
+# variants add more).
+
+CSV_EXPANSION = 6
+TEXT_EXPANSION = {"pdf": 8, "default": 4}
+BASE_REQUEST_BYTES = 8 * 1024 ** 2
+
+
+def _plan_ops(plan: Optional[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    return (plan or {}).get("ops", []) if isinstance(plan, dict) else []
+
+
+def _image_factor(plan: Optional[Dict[str, Any]]) -> float:
+    factor = 2.0  # decoded image + one working copy
+    for step in _plan_ops(plan):
+        op = step.get("op")
+        if op == "normalize":
+            factor += 4 if step.get("method") == "zscore" else 1  # float32 output
+        elif op == "augment" and step.get("mode") == "ml_training":
+            factor += int(step.get("num_variants", 6))
+        else:
+            factor += 1
+    return factor
+
+
+# files: [(size in bytes, (width, height) or None)] as uploaded; in_flight is how
+# many files a batch works on at once.
+def estimate_cost(data_type: str, files: Sequence[Tuple[int, Optional[Tuple[int, int]]]],
+                  plan: Optional[Dict[str, Any]] = None, ext: str = "",
+                  in_flight: Optional[int] = None) -> Cost:
+    if not files:
+        return Cost(BASE_REQUEST_BYTES, 1)
+    n_ops = len(_plan_ops(plan))
+    if data_type == "csv":
+        per_file = [size * CSV_EXPANSION * (1 + 0.25 * n_ops) for size, _ in files]
+        concurrent = 1  # CSV batches run file by file
+    elif data_type == "text":
+        k = TEXT_EXPANSION.get(ext, TEXT_EXPANSION["default"])
+        per_file = [size * k for size, _ in files]
+        concurrent = 1
+    else:
+        factor = _image_factor(plan)
+        # Unknown dims: assume ~10x compression of 3-channel 8-bit pixels
+        per_file = [(w * h * 3 if dims else size * 10) * factor
+                    for size, dims in files for w, h in [dims or (0, 0)]]
+        concurrent = in_flight or min(len(files), 2 * (os.cpu_count() or 4))
+    peak = sum(sorted(per_file, reverse=True)[:concurrent])
+    return Cost(int(peak) + BASE_REQUEST_BYTES, max(1, min(concurrent, len(files))))
+
+
+# Width/height from an image header (file object or path) without decoding
+def image_dims(src: Any) -> Optional[Tuple[int, int]]:
+    from PIL import Image
+    try:
+        with Image.open(src) as im:
+            return im.size
+    except Exception:
+        return None
+    finally:
+        if hasattr(src, "seek"):
+            src.seek(0)
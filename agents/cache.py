@@ -0,0 +1,186 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import hashlib
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from agents.metrics import CACHE_LOOKUPS
+
+# Content-addressed result store shared by the three agents. Entries are keyed
+# by hashes of (file bytes, plan, code version, ...), so a rerun over a mostly
+# unchanged dataset finds profiles, plans and output artifacts for every file it
+# has seen before and only does real work for new or changed files.
+#
+# On-disk layout (local backend):
+#   <root>/objects/<key[:2]>/<key>/meta.json   JSON value + bookkeeping
+#   <root>/objects/<key[:2]>/<key>/files/...   copied output artifacts
+# Entries are written to a temp dir and renamed into place, so concurrent
+# writers (batch workers, API workers) never see half-written entries.
+
+
+# Hash a file's bytes in 1 MB chunks
+def file_digest(path: str) -> str:
+    h = hashlib.blake2b(digest_size=20)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+# Hash any JSON-serialisable value (plans, profiles, option dicts) canonically
+def json_digest(value: Any) -> str:
+    blob = json.dumps(value, sort_keys=True, default=str).encode("utf-8")
+    return hashlib.blake2b(blob, digest_size=20).hexdigest()
+
+
+_CODE_VERSIONS: Dict[str, str] = {}
+
+
+# Version of an agent's code = hash of its source file, so editing an agent
+# invalidates its cached results without anyone remembering to bump a number.
+def code_version(module_file: str) -> str:
+    if module_file not in _CODE_VERSIONS:
+        _CODE_VERSIONS[module_file] = file_digest(module_file)[:12]
+    return _CODE_VERSIONS[module_file]
+
+
+class ResultStore:
+    """
+    Local on-disk content-addressed store with size-based LRU garbage collection.
+    max_bytes caps the total size; when a put pushes it over, the least recently
+    used entries are evicted until the store is back under 90% of the cap.
+    """
+    def __init__(self, root: str = ".prism_cache", max_bytes: int = 2 * 1024 ** 3):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._objects = os.path.join(root, "objects")
+        os.makedirs(self._objects, exist_ok=True)
+        self._total: Optional[int] = None  # lazily scanned
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(*parts: Any) -> str:
+        return json_digest(list(parts))
+
+    def _dir(self, key: str) -> str:
+        return os.path.join(self._objects, key[:2], key)
+
+    # Returns (value, artifact dir or None) or None on a miss
+    def get(self, key: str) -> Optional[Tuple[Any, Optional[str]]]:
+        d = self._dir(key)
+        meta_path = os.path.join(d, "meta.json")
+        try:
+            with open(meta_path, encoding="utf-8") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            self.misses += 1
+            CACHE_LOOKUPS.inc(result="miss")
+            return None
+        os.utime(meta_path)  # mark as recently used for LRU eviction
+        self.hits += 1
+        CACHE_LOOKUPS.inc(result="hit")
+        files = os.path.join(d, "files")
+        return meta["value"], files if os.path.isdir(files) else None
+
+    # Store a JSON value plus optional artifacts {name in store: source path}
+    def put(self, key: str, value: Any, files: Optional[Dict[str, str]] = None) -> None:
+        final = self._dir(key)
+        if os.path.exists(final):
+            # Only upgrade a value-only entry to one that carries artifacts
+            if not files or os.path.isdir(os.path.join(final, "files")):
+                return
+            shutil.rmtree(final, ignore_errors=True)
+        tmp = os.path.join(self.root, "tmp", uuid.uuid4().hex)
+        os.makedirs(tmp)
+        size = 0
+        try:
+            if files:
+                os.makedirs(os.path.join(tmp, "files"))
+                for name, src in files.items():
+                    dst = os.path.join(tmp, "files", name)
+                    shutil.copyfile(src, dst)
+                    size += os.path.getsize(dst)
+            meta_path = os.path.join(tmp, "meta.json")
+            with open(meta_path, "w", encoding="utf-8") as f:
+                json.dump({"value": value, "size": size, "created": time.time()}, f, default=str)
+            size += os.path.getsize(meta_path)
+            os.makedirs(os.path.dirname(final), exist_ok=True)
+            os.rename(tmp, final)
+        except OSError:
+            # Lost a race with another writer (or disk error): keep whatever is there
+            shutil.rmtree(tmp, ignore_errors=True)
+            return
+
+        if self._total is None:
+            self._total = self._scan()[1]
+        else:
+            self._total += size
+        if self._total > self.max_bytes:
+            self.gc()
+
+    # Return the cached value for key, computing and storing it on a miss.
+    # Values for which cacheable(value) is False are returned but not stored.
+    def memo(self, key: str, compute: Callable[[], Any],
+             cacheable: Callable[[Any], bool] = lambda v: True) -> Any:
+        hit = self.get(key)
+        if hit is not None:
+            return hit[0]
+        value = compute()
+        if cacheable(value):
+            self.put(key, value)
+        return value
+
+    def _scan(self):
+        entries, total = [], 0
+        for shard in os.listdir(self._objects):
+            shard_dir = os.path.join(self._objects, shard)
+            for key in os.listdir(shard_dir):
+                meta_path = os.path.join(shard_dir, key, "meta.json")
+                try:
+                    st = os.stat(meta_path)
+                    with open(meta_path, encoding="utf-8") as f:
+                        size = json.load(f).get("size", 0)
+                except (OSError, ValueError):
+                    continue
+                entries.append((st.st_mtime, size, key))
+                total += size
+        return entries, total
+
+    # Evict least recently used entries until the store is under target bytes
+    def gc(self, target_bytes: Optional[int] = None) -> Dict[str, int]:
+        target = int(self.max_bytes * 0.9) if target_bytes is None else target_bytes
+        entries, total = self._scan()
+        evicted = freed = 0
+        for _, size, key in sorted(entries):
+            if total <= target:
+                break
+            shutil.rmtree(self._dir(key), ignore_errors=True)
+            total -= size
+            freed += size
+            evicted += 1
+        self._total = total
+        return {"evicted": evicted, "freed_bytes": freed, "total_bytes": total}
+
+
+# Plans produced by the offline fallbacks must not be cached, or one LLM outage
+# would pin the fallback plan for that profile forever.
+def is_real_plan(plan: Any) -> bool:
+    notes = str(plan.get("notes", "")) if isinstance(plan, dict) else ""
+    return "AI unavailable" not in notes and "invalid JSON" not in notes
+
+
+_DEFAULT: Dict[str, ResultStore] = {}
+
+
+# Process-wide store configured by PRISM_CACHE_DIR (and PRISM_CACHE_MAX_BYTES);
+# None when caching is not configured, which keeps the agents cache-free.
+def default_store() -> Optional[ResultStore]:
+    root = os.environ.get("PRISM_CACHE_DIR")
+    if not root:
+        return None
+    if root not in _DEFAULT:
+        _DEFAULT[root] = ResultStore(root, int(os.environ.get("PRISM_CACHE_MAX_BYTES", 2 * 1024 ** 3)))
+    return _DEFAULT[root]
@@ -0,0 +1,188 @@
+import os
+import io
+import time
+import uuid
+import pstats
+import cProfile
+import threading
+import tracemalloc
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional
+
+# Per-op instrumentation for the agents' execution logs. Off by default; when on,
+# every op's log entry gets a "metrics" block with wall/CPU time and the size of
+# the data before and after the op (rows/bytes for tables, chars for text,
+# pixels/bytes for images).
+#
+# Levels:
+#   off   nothing measured - op_meter() returns None, one dict lookup per op
+#   time  wall + thread CPU time and data sizes
+#   mem   also the peak Python allocation during the op (tracemalloc; numpy and
+#         pandas buffers are tracked, OpenCV's internal buffers are not). Much
+#         slower: tracemalloc is process-wide, so while any mem block is active
+#         every thread pays for it and concurrent ops blur each other's peaks.
+# Set PRISM_INSTRUMENT=time|mem, or wrap a call in `with instrumented("time"):`.
+# The override is a context variable, so it applies to the calling request or
+# task only. Thread pools don't inherit it: submit with
+# contextvars.copy_context().run. Process pools take it by name via
+# call_instrumented(level_name(), fn, ...).
+# Results served from a ResultStore carry the metrics of the run that made them.
+
+_LEVELS = {"off": 0, "time": 1, "mem": 2}
+_lock = threading.Lock()
+_override: ContextVar[int] = ContextVar("instrument_level", default=0)
+_mem_blocks = 0  # active instrumented("mem") blocks across all contexts
+_started_tracemalloc = False
+
+
+def level() -> int:
+    env = _LEVELS.get(os.environ.get("PRISM_INSTRUMENT", "off").lower(), 0)
+    return max(env, _override.get())
+
+
+def level_name() -> str:
+    return {v: k for k, v in _LEVELS.items()}[level()]
+
+
+# Turn instrumentation on for the duration of a block (e.g. one API request)
+@contextmanager
+def instrumented(name: str = "time"):
+    global _mem_blocks, _started_tracemalloc
+    lvl = _LEVELS.get(name, 1)
+    token = _override.set(max(lvl, _override.get()))
+    if lvl >= 2:
+        with _lock:
+            _mem_blocks += 1
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                _started_tracemalloc = True
+    try:
+        yield
+    finally:
+        _override.reset(token)
+        if lvl >= 2:
+            with _lock:
+                _mem_blocks -= 1
+                if _started_tracemalloc and not _mem_blocks:
+                    tracemalloc.stop()
+                    _started_tracemalloc = False
+
+
+# Entry point for process-pool workers: run fn at the submitting caller's level
+def call_instrumented(name: str, fn, *args: Any) -> Any:
+    with instrumented(name):
+        return fn(*args)
+
+
+class OpMeter:
+    """Measures one op. Create with op_meter(); call stop() with the output size."""
+    __slots__ = ("size_in", "t0", "c0", "mem0")
+
+    def __init__(self, size_in: Dict[str, int], mem: bool):
+        self.size_in = size_in
+        self.mem0 = None
+        if mem and tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+            self.mem0 = tracemalloc.get_traced_memory()[0]
+        self.c0 = time.thread_time()
+        self.t0 = time.perf_counter()
+
+    def stop(self, size_out: Dict[str, int]) -> Dict[str, Any]:
+        wall = time.perf_counter() - self.t0
+        cpu = time.thread_time() - self.c0
+        m: Dict[str, Any] = {"wall_ms": round(wall * 1000, 3), "cpu_ms": round(cpu * 1000, 3)}
+        for k, v in self.size_in.items():
+            m[f"{k}_in"] = v
+        for k, v in size_out.items():
+            m[f"{k}_out"] = v
+        if self.mem0 is not None:
+            m["peak_alloc_bytes"] = max(0, tracemalloc.get_traced_memory()[1] - self.mem0)
+        return m
+
+
+# Start measuring an op, or None when instrumentation is off. size_fn is only
+# called when a meter is actually created, so the off path stays free.
+def op_meter(size_fn, *args) -> Optional[OpMeter]:
+    lvl = level()
+    if not lvl:
+        return None
+    return OpMeter(size_fn(*args), lvl >= 2)
+
+
+# Attach metrics to the last log entry the op wrote (ops that log per column
+# still get one block for the whole op).
+def attach(log: List[Dict[str, Any]], n_before: int, metrics: Optional[Dict[str, Any]]) -> None:
+    if metrics is not None and len(log) > n_before:
+        log[-1]["metrics"] = metrics
+
+
+# --- Per-request profiles ---------------------------------------------------------
+# capture_profile() records a cProfile (default) or pyinstrument profile of the
+# calling thread and saves it under PROFILE_DIR as <id>.prof / <id>.html, ready
+# for snakeviz / pstats or a browser. Work handed to worker threads or processes
+# is not included; the instrumented() metrics cover those.
+
+PROFILE_DIR = os.environ.get("PRISM_PROFILE_DIR", "profiles")
+PROFILE_KINDS = ("cprofile", "pyinstrument")
+
+
+class ProfileCapture:
+    def __init__(self, kind: str):
+        if kind not in PROFILE_KINDS:
+            raise ValueError(f"Unknown profiler '{kind}'; use one of {PROFILE_KINDS}")
+        self.kind = kind
+        self.id = uuid.uuid4().hex
+        self.path: Optional[str] = None
+        self.summary: Optional[str] = None
+
+
+@contextmanager
+def capture_profile(kind: Optional[str] = "cprofile", out_dir: str = None, top: int = 25):
+    """Yields a ProfileCapture (or None when kind is falsy) whose path is set on exit."""
+    if not kind:
+        yield None
+        return
+    cap = ProfileCapture(kind)
+    out_dir = out_dir or PROFILE_DIR
+    os.makedirs(out_dir, exist_ok=True)
+    if kind == "pyinstrument":
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            raise RuntimeError("pyinstrument is not installed; use kind='cprofile'")
+        prof = Profiler()
+        prof.start()
+        try:
+            yield cap
+        finally:
+            prof.stop()
+            cap.path = os.path.join(out_dir, f"{cap.id}.html")
+            with open(cap.path, "w", encoding="utf-8") as f:
+                f.write(prof.output_html())
+            cap.summary = prof.output_text()
+        return
+
+    prof = cProfile.Profile()
+    prof.enable()
+    try:
+        yield cap
+    finally:
+        prof.disable()
+        cap.path = os.path.join(out_dir, f"{cap.id}.prof")
+        prof.dump_stats(cap.path)
+        buf = io.StringIO()
+        pstats.Stats(prof, stream=buf).sort_stats("cumulative").print_stats(top)
+        cap.summary = buf.getvalue()
+
+
+# Locate a saved profile by id (ids are hex, so this can't escape out_dir)
+def find_profile(profile_id: str, out_dir: str = None) -> Optional[str]:
+    out_dir = out_dir or PROFILE_DIR
+    if not profile_id.isalnum():
+        return None
+    for ext in (".prof", ".html"):
+        path = os.path.join(out_dir, profile_id + ext)
+        if os.path.exists(path):
+            return path
+    return None
@@ -0,0 +1,203 @@
+import time
+import bisect
+import threading
+from abc import ABC, abstractmethod
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+# Minimal Prometheus-style metrics: counters, gauges and histograms with labels,
+# rendered in the text exposition format by render(). Recording is a dict lookup
+# plus a short per-metric lock (histograms add one bisect), cheap enough to leave
+# on for every request. Values live in this process only; pool workers in other
+# processes are not aggregated.
+
+_LabelKey = Tuple[str, ...]
+
+
+def _escape(v: str) -> str:
+    return str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _fmt_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _fmt_value(v: float) -> str:
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+class _Metric(ABC):
+    kind = ""
+
+    def __init__(self, name: str, doc: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labels)
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels: Dict[str, Any]) -> _LabelKey:
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    @abstractmethod
+    def samples(self) -> List[str]:
+        """Exposition lines for the current values, without HELP/TYPE."""
+
+    def render(self) -> str:
+        head = f"# HELP {self.name} {self.doc}\n# TYPE {self.name} {self.kind}\n"
+        return head + "".join(line + "\n" for line in self.samples())
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, doc: str, labels: Sequence[str] = ()):
+        super().__init__(name, doc, labels)
+        self._values: Dict[_LabelKey, float] = {}
+
+    def inc(self, amount: float = 1, **labels: Any) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: Any) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_fmt_labels(self.labelnames, k)} {_fmt_value(v)}" for k, v in items]
+
+
+class Gauge(_Metric):
+    """Settable gauge; or pass fn to compute the (unlabelled) value at scrape time."""
+    kind = "gauge"
+
+    def __init__(self, name: str, doc: str, labels: Sequence[str] = (),
+                 fn: Optional[Callable[[], Dict[_LabelKey, float]]] = None):
+        super().__init__(name, doc, labels)
+        self._values: Dict[_LabelKey, float] = {}
+        self._fn = fn
+
+    def set(self, value: float, **labels: Any) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels: Any) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels: Any) -> None:
+        self.inc(-amount, **labels)
+
+    def samples(self) -> List[str]:
+        if self._fn is not None:
+            items = list(self._fn().items())
+        else:
+            with self._lock:
+                items = list(self._values.items())
+        return [f"{self.name}{_fmt_labels(self.labelnames, k)} {_fmt_value(v)}" for k, v in items]
+
+
+# Default buckets in seconds, from fast previews to slow LLM calls and batches
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, doc: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, doc, labels)
+        self.buckets = tuple(sorted(buckets))
+        # per label set: [bucket counts..., +Inf count], sum
+        self._values: Dict[_LabelKey, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = self._key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = ([0] * (len(self.buckets) + 1), [0.0])
+            entry[0][i] += 1
+            entry[1][0] += value
+
+    def time(self, **labels: Any) -> "_Timer":
+        return _Timer(self, labels)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = [(k, list(c), s[0]) for k, (c, s) in self._values.items()]
+        out = []
+        for key, counts, total in items:
+            acc = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                acc += n
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound}"'
+                out.append(f"{self.name}_bucket{_fmt_labels(self.labelnames, key, le)} {acc}")
+            out.append(f"{self.name}_sum{_fmt_labels(self.labelnames, key)} {_fmt_value(total)}")
+            out.append(f"{self.name}_count{_fmt_labels(self.labelnames, key)} {acc}")
+        return out
+
+
+class _Timer:
+    __slots__ = ("hist", "labels", "t0")
+
+    def __init__(self, hist: Histogram, labels: Dict[str, Any]):
+        self.hist, self.labels = hist, labels
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.hist.observe(time.perf_counter() - self.t0, **self.labels)
+
+
+REGISTRY: List[_Metric] = []
+
+
+def render() -> str:
+    return "".join(m.render() for m in REGISTRY)
+
+
+# --- Metrics shared by the agents --------------------------------------------------
+
+LLM_CALLS = Counter("prism_llm_calls_total", "LLM API calls by purpose and outcome",
+                    ("purpose", "outcome"))
+LLM_LATENCY = Histogram("prism_llm_call_seconds", "LLM API call latency", ("purpose",))
+CACHE_LOOKUPS = Counter("prism_cache_lookups_total", "Result store lookups", ("result",))
+
+
+# POST to the LLM API, recording latency and outcome (ok / http_error / exception).
+# Callers keep their own fallback handling; this only observes.
+def observed_post(purpose: str, url: str, **kwargs: Any):
+    import requests
+    t0 = time.perf_counter()
+    outcome = "exception"
+    try:
+        response = requests.post(url, **kwargs)
+        outcome = "ok" if response.status_code == 200 else "http_error"
+        return response
+    finally:
+        LLM_LATENCY.observe(time.perf_counter() - t0, purpose=purpose)
+        LLM_CALLS.inc(purpose=purpose, outcome=outcome)
+
+
+# Per-request labels the API middleware reads back once the endpoint has run
+# (e.g. which data type a /generate-plan upload turned out to be).
+request_labels: ContextVar[Optional[Dict[str, str]]] = ContextVar("request_labels", default=None)
+
+
+def set_request_label(name: str, value: str) -> None:
+    labels = request_labels.get()
+    if labels is not None:
+        labels[name] = value
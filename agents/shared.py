@@ -0,0 +1,270 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import sqlite3
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from agents.cache import json_digest
+from agents.metrics import CACHE_LOOKUPS
+
+# Shared store for multi-process deployments (several uvicorn workers, batch
+# workers) on one machine. It speaks the same key/get/put/memo interface as
+# ResultStore, so the agents take it as their `cache`, and adds:
+#   - numpy arrays (decoded images) saved as .npy and handed back memory-mapped,
+#     so every worker maps the same page-cache pages instead of holding a copy
+#   - the batch job registry: snapshots, progress events and cancel requests,
+#     so any worker can report on, stream or cancel a job another worker runs
+#
+# Layout:
+#   <root>/store.db                  SQLite (WAL) index: entries, jobs, job events
+#   <root>/blobs/<key[:2]>/<key>/    artifact files of an entry
+#   <root>/blobs/<key[:2]>/<key>.npy array entries
+# Blobs are written to a temp name and renamed into place before their row is
+# inserted, so readers in other processes never see partial files. Entries are
+# evicted least recently used first once the total passes max_bytes.
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY, value TEXT, kind TEXT, size INTEGER, accessed REAL);
+CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed);
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY, snapshot TEXT, cancel INTEGER DEFAULT 0, updated REAL);
+CREATE TABLE IF NOT EXISTS job_events (
+    job_id TEXT, seq INTEGER, event TEXT, PRIMARY KEY (job_id, seq));
+"""
+
+_TOUCH_S = 60  # access times are refreshed at most this often per entry
+
+
+class SharedStore:
+    def __init__(self, root: str = ".prism_shared", max_bytes: int = 2 * 1024 ** 3):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._blobs = os.path.join(root, "blobs")
+        os.makedirs(self._blobs, exist_ok=True)
+        self._local = threading.local()
+        self._db().executescript(_SCHEMA)
+
+    # One connection per thread and process (a forked worker must not reuse its parent's)
+    def _db(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(os.path.join(self.root, "store.db"), timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    @staticmethod
+    def key(*parts: Any) -> str:
+        return json_digest(list(parts))
+
+    def _path(self, key: str, kind: str) -> str:
+        name = f"{key}.npy" if kind == "array" else key
+        return os.path.join(self._blobs, key[:2], name)
+
+    def _lookup(self, key: str) -> Optional[Tuple[Any, str]]:
+        row = self._db().execute("SELECT value, kind, accessed FROM entries WHERE key = ?",
+                                 (key,)).fetchone()
+        if row is None:
+            CACHE_LOOKUPS.inc(result="miss")
+            return None
+        now = time.time()
+        if now - row[2] > _TOUCH_S:
+            self._db().execute("UPDATE entries SET accessed = ? WHERE key = ?", (now, key))
+        CACHE_LOOKUPS.inc(result="hit")
+        return json.loads(row[0]), row[1]
+
+    def _insert(self, key: str, value: Any, kind: str, size: int, replace: bool = False) -> None:
+        verb = "INSERT OR REPLACE" if replace else "INSERT OR IGNORE"
+        self._db().execute(f"{verb} INTO entries VALUES (?, ?, ?, ?, ?)",
+                           (key, json.dumps(value, default=str), kind, size, time.time()))
+        total = self._db().execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total > self.max_bytes:
+            self.gc()
+
+    # --- ResultStore interface ----------------------------------------------------
+
+    # Returns (value, artifact dir or None) or None on a miss
+    def get(self, key: str) -> Optional[Tuple[Any, Optional[str]]]:
+        hit = self._lookup(key)
+        if hit is None:
+            return None
+        value, kind = hit
+        files = self._path(key, kind) if kind == "files" else None
+        if files is not None and not os.path.isdir(files):
+            return None  # evicted by another process since the lookup
+        return value, files
+
+    # Store a JSON value plus optional artifacts {name in store: source path}
+    def put(self, key: str, value: Any, files: Optional[Dict[str, str]] = None) -> None:
+        row = self._db().execute("SELECT kind FROM entries WHERE key = ?", (key,)).fetchone()
+        # Only upgrade a value-only entry to one that carries artifacts
+        if row is not None and (not files or row[0] == "files"):
+            return
+        size = len(json.dumps(value, default=str))
+        if not files:
+            self._insert(key, value, "value", size)
+            return
+        final = self._path(key, "files")
+        tmp = os.path.join(self._blobs, f"tmp-{uuid.uuid4().hex}")
+        try:
+            os.makedirs(tmp)
+            for name, src in files.items():
+                shutil.copyfile(src, os.path.join(tmp, name))
+                size += os.path.getsize(os.path.join(tmp, name))
+            os.makedirs(os.path.dirname(final), exist_ok=True)
+            os.rename(tmp, final)
+        except OSError:
+            # Lost a race with another writer (or disk error): keep whatever is there
+            shutil.rmtree(tmp, ignore_errors=True)
+            if not os.path.isdir(final):
+                return
+        self._insert(key, value, "files", size, replace=True)
+
+    # Return the cached value for key, computing and storing it on a miss.
+    # Values for which cacheable(value) is False are returned but not stored.
+    def memo(self, key: str, compute: Callable[[], Any],
+             cacheable: Callable[[Any], bool] = lambda v: True) -> Any:
+        hit = self.get(key)
+        if hit is not None:
+            return hit[0]
+        value = compute()
+        if cacheable(value):
+            self.put(key, value)
+        return value
+
+    # --- Arrays ---------------------------------------------------------------------
+
+    # Read-only memory map of a stored array, or None on a miss
+    def get_array(self, key: str) -> Optional[np.ndarray]:
+        if self._lookup(key) is None:
+            return None
+        try:
+            return np.load(self._path(key, "array"), mmap_mode="r")
+        except (OSError, ValueError):
+            return None
+
+    def put_array(self, key: str, arr: np.ndarray) -> None:
+        final = self._path(key, "array")
+        tmp = os.path.join(self._blobs, f"tmp-{uuid.uuid4().hex}.npy")
+        try:
+            np.save(tmp, arr)
+            os.makedirs(os.path.dirname(final), exist_ok=True)
+            os.replace(tmp, final)
+        except OSError:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return
+        self._insert(key, {"shape": list(arr.shape), "dtype": str(arr.dtype)}, "array",
+                     int(arr.nbytes), replace=True)
+
+    # Evict least recently used entries until the store is under target bytes.
+    # Workers still mapping an evicted array keep their pages until they drop it.
+    def gc(self, target_bytes: Optional[int] = None) -> Dict[str, int]:
+        target = int(self.max_bytes * 0.9) if target_bytes is None else target_bytes
+        db = self._db()
+        rows = db.execute("SELECT key, kind, size FROM entries ORDER BY accessed").fetchall()
+        total = sum(r[2] for r in rows)
+        evicted = freed = 0
+        for key, kind, size in rows:
+            if total <= target:
+                break
+            db.execute("DELETE FROM entries WHERE key = ?", (key,))
+            path = self._path(key, kind)
+            if kind == "files":
+                shutil.rmtree(path, ignore_errors=True)
+            elif kind == "array" and os.path.exists(path):
+                os.remove(path)
+            total -= size
+            freed += size
+            evicted += 1
+        return {"evicted": evicted, "freed_bytes": freed, "total_bytes": total}
+
+    # --- Batch jobs -----------------------------------------------------------------
+
+    def save_job(self, job_id: str, snapshot: Dict[str, Any]) -> None:
+        self._db().execute(
+            "INSERT INTO jobs (id, snapshot, updated) VALUES (?, ?, ?) "
+            "ON CONFLICT (id) DO UPDATE SET snapshot = excluded.snapshot, updated = excluded.updated",
+            (job_id, json.dumps(snapshot, default=str), time.time()))
+
+    # Append event `seq` and refresh the snapshot in one transaction
+    def add_job_event(self, job_id: str, seq: int, event: Dict[str, Any],
+                      snapshot: Dict[str, Any]) -> None:
+        db = self._db()
+        with db:
+            db.execute("BEGIN IMMEDIATE")
+            db.execute("INSERT OR REPLACE INTO job_events VALUES (?, ?, ?)",
+                       (job_id, seq, json.dumps(event, default=str)))
+            self.save_job(job_id, snapshot)
+
+    def job_snapshot(self, job_id: str) -> Optional[Dict[str, Any]]:
+        row = self._db().execute("SELECT snapshot, cancel FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        snapshot = json.loads(row[0])
+        snapshot["cancel_requested"] = bool(row[1])
+        return snapshot
+
+    def job_events(self, job_id: str, after: int = -1) -> List[Dict[str, Any]]:
+        rows = self._db().execute("SELECT seq, event FROM job_events WHERE job_id = ? AND seq > ? "
+                                  "ORDER BY seq", (job_id, after)).fetchall()
+        events = []
+        for seq, event in rows:
+            if seq != after + 1 + len(events):
+                break  # only hand out a contiguous run
+            events.append(json.loads(event))
+        return events
+
+    # (seq, event) of the latest stored event, or None
+    def last_job_event(self, job_id: str) -> Optional[Tuple[int, Dict[str, Any]]]:
+        row = self._db().execute("SELECT seq, event FROM job_events WHERE job_id = ? "
+                                 "ORDER BY seq DESC LIMIT 1", (job_id,)).fetchone()
+        return None if row is None else (row[0], json.loads(row[1]))
+
+    # Refresh `updated` of jobs whose owner is alive (queued jobs emit nothing)
+    def touch_jobs(self, job_ids: List[str]) -> None:
+        if job_ids:
+            self._db().execute(f"UPDATE jobs SET updated = ? WHERE id IN ({','.join('?' * len(job_ids))})",
+                               (time.time(), *job_ids))
+
+    def job_updated(self, job_id: str) -> Optional[float]:
+        row = self._db().execute("SELECT updated FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return None if row is None else row[0]
+
+    def request_cancel(self, job_id: str) -> None:
+        self._db().execute("UPDATE jobs SET cancel = 1 WHERE id = ?", (job_id,))
+
+    def cancel_requested(self, job_id: str) -> bool:
+        row = self._db().execute("SELECT cancel FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return bool(row and row[0])
+
+    # Forget jobs not updated since `before`: finished ones, and unfinished ones
+    # whose owner died (live owners keep theirs fresh with touch_jobs)
+    def prune_jobs(self, before: float) -> None:
+        db = self._db()
+        with db:
+            db.execute("BEGIN IMMEDIATE")
+            db.execute("DELETE FROM job_events WHERE job_id IN (SELECT id FROM jobs WHERE updated < ?)",
+                       (before,))
+            db.execute("DELETE FROM jobs WHERE updated < ?", (before,))
+
+
+_DEFAULT: Dict[str, SharedStore] = {}
+
+
+# Process-wide store configured by PRISM_SHARED_DIR (and PRISM_SHARED_MAX_BYTES);
+# None when not configured, which keeps every worker's state in-process as before.
+def shared_store() -> Optional[SharedStore]:
+    root = os.environ.get("PRISM_SHARED_DIR")
+    if not root:
+        return None
+    if root not in _DEFAULT:
+        _DEFAULT[root] = SharedStore(root, int(os.environ.get("PRISM_SHARED_MAX_BYTES", 2 * 1024 ** 3)))
+    return _DEFAULT[root]
@@ -1,12 +1,18 @@
 import pandas as pd
 import numpy as np
 import json
+import warnings
 from typing import Dict, Any, List, Tuple, Optional
 
 import os
+import shutil
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain_core.messages import HumanMessage, SystemMessage
 
+from agents.cache import ResultStore, code_version, default_store, file_digest, is_real_plan, json_digest
+from agents.instrument import attach, op_meter
+from agents.metrics import observed_post
+
 # Profile a CSV by sampling up to `sample_rows`: report row count, overall null-row %
 # and per-column stats (dtype, null%, unique count, numeric stats, sample values).
 def profile_tabular(path: str, sample_rows: int = 5000) -> Dict[str, Any]:
@@ -65,7 +71,6 @@ def _flatten_resp(x: Any) -> str:
 # Ask Gemini to propose a tabular cleaning plan, fallback to a basic plan on error
 def llm_make_tabular_plan(profile: dict, user_goal: str="prepare ML") -> dict:
     try:
-        import requests
 
         # Load API key from .env at repo root
         env_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), '.env')
@@ -82,7 +87,7 @@ def llm_make_tabular_plan(profile: dict, user_goal: str="prepare ML") -> dict:
         prompt = f"{_PLAN_PROMPT}\n\n{json.dumps({'user_goal': user_goal, 'profile': profile})}"
         payload = {'contents': [{'parts': [{'text': prompt}]}]}
 
-        response = requests.post(url, json=payload, timeout=30)
+        response = observed_post("tabular_plan", url, json=payload, timeout=30)
         if response.status_code == 200:
             result = response.json()
             txt = result['candidates'][0]['content']['parts'][0]['text']
@@ -126,35 +131,118 @@ def _cast(s: pd.Series, to: str) -> pd.Series:
     return s.astype("string")
 
 
-# Scale numeric Series based on method
-def _scale(s: pd.Series, m: str) -> pd.Series:
-    x = pd.to_numeric(s, errors="coerce").astype(float)
+# Selected columns as one float64 block (rows x cols, column-major). Numeric
+# columns are copied straight in; anything else is coerced, non-numbers -> NaN.
+def _float_block(df: pd.DataFrame, cols: List[str]) -> np.ndarray:
+    block = np.empty((len(df), len(cols)), dtype=np.float64, order="F")
+    for j, c in enumerate(cols):
+        s = df[c]
+        if not pd.api.types.is_numeric_dtype(s):
+            s = pd.to_numeric(s, errors="coerce")
+        block[:, j] = s.to_numpy(dtype=np.float64, na_value=np.nan)
+    return block
+
+
+# Per-column reduction of a float block: `fast` in one call over the whole block,
+# then `nan_aware` redoes just the columns that contain NaNs.
+def _per_column(x: np.ndarray, fast, nan_aware, nan_cols: Optional[np.ndarray] = None) -> np.ndarray:
+    if nan_cols is None:
+        nan_cols = np.isnan(x).any(axis=0)
+    out = fast(x)
+    if nan_cols.any():
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)  # all-NaN columns
+            out[..., nan_cols] = nan_aware(x[:, nan_cols])
+    return out
+
+
+# Scale every column of a float block in place. As before, NaNs become 0 for
+# minmax/standard, and a constant column is left unscaled.
+def _scale_block(x: np.ndarray, m: str) -> np.ndarray:
     m = m.lower()
-    if m == "minmax":
-        mn, mx = x.min(), x.max()
-        rng = mx - mn
-        return ((x - mn) / rng).fillna(0) if rng else x.fillna(0)
+    nan_cols = np.isnan(x).any(axis=0)
     if m == "log1p":
-        mn = x.min()
-        x = x - mn + 1 if mn < 0 else x
-        return np.log1p(x)
-    # Standard z-score scaling
-    mu, sd = x.mean(), x.std(ddof=0)
-    return ((x - mu) / sd).fillna(0) if sd else x.fillna(0)
-
-
-# Compute bounds for outlier detection using IQR or z-score
-def _bounds(s: pd.Series, method: str, k: float) -> Tuple[float, float]:
-    arr = pd.to_numeric(s, errors="coerce").dropna().astype(float)
+        mn = _per_column(x, lambda a: a.min(axis=0), lambda a: np.nanmin(a, axis=0), nan_cols)
+        shift = mn < 0
+        x -= np.where(shift, mn, 0)
+        x += shift
+        return np.log1p(x, out=x)
+    if m == "minmax":
+        center = _per_column(x, lambda a: a.min(axis=0), lambda a: np.nanmin(a, axis=0), nan_cols)
+        spread = _per_column(x, lambda a: a.max(axis=0), lambda a: np.nanmax(a, axis=0), nan_cols) - center
+        x -= center
+    else:
+        # Standard z-score: centre in place, then each variance is a single dot product
+        center = _per_column(x, lambda a: a.mean(axis=0), lambda a: np.nanmean(a, axis=0), nan_cols)
+        x -= center
+        spread = np.sqrt(_per_column(x, lambda a: np.einsum("ij,ij->j", a, a) / len(a),
+                                     lambda a: np.nanmean(a * a, axis=0), nan_cols))
+    scaled = spread != 0  # NaN spread (empty column) still scales, to all-NaN -> 0
+    x += np.where(scaled, 0, center)  # constant columns go back unchanged
+    x /= np.where(scaled, spread, 1)
+    if nan_cols.any():
+        x[np.isnan(x)] = 0
+    return x
+
+
+# Outlier bounds for every column of a float block (IQR or z-score), NaNs ignored
+def _block_bounds(x: np.ndarray, method: str, k: float) -> Tuple[np.ndarray, np.ndarray]:
     if method == "iqr":
-        q1, q3 = np.percentile(arr, [25, 75])
+        # Rows of x.T are contiguous, which is what the quantile partitioning wants
+        q1, q3 = _per_column(x, lambda a: np.percentile(a.T, [25, 75], axis=1),
+                             lambda a: np.nanpercentile(a, [25, 75], axis=0))
         iqr = q3 - q1
         return q1 - k * iqr, q3 + k * iqr
     # z-score method
-    m, sd = arr.mean(), arr.std(ddof=0)
+    m, sd = _per_column(x, lambda a: np.stack([a.mean(axis=0), a.std(axis=0)]),
+                        lambda a: np.stack([np.nanmean(a, axis=0), np.nanstd(a, axis=0)]))
     return m - k * sd, m + k * sd
 
 
+# Cap (clip to the bounds) or flag outliers in all `cols` at once. Capped
+# columns are written back whole when their dtype allows, cell-wise otherwise.
+def _cap_or_flag_outliers(df: pd.DataFrame, cols: List[str], method: str, k: float,
+                          action: str, suffix: str) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    x = _float_block(df, cols)
+    lo, hi = _block_bounds(x, method, k)
+    below, above = x < lo, x > hi
+    mask = below | above
+    counts = mask.sum(axis=0)
+    if action == "cap":
+        np.clip(x, lo, hi, out=x)
+        for j in np.flatnonzero(counts):
+            c, dtype = cols[j], df[cols[j]].dtype
+            if isinstance(dtype, np.dtype) and dtype.kind in "iuf":
+                df[c] = x[:, j].astype(dtype, copy=False) if dtype.kind == "f" else x[:, j]
+            else:
+                df.loc[below[:, j], c] = lo[j]
+                df.loc[above[:, j], c] = hi[j]
+    else:
+        df[[c + suffix for c in cols]] = mask
+    return lo, hi, counts
+
+
+# Remove outlier rows column by column: each column's bounds are computed on the
+# rows the previous columns kept, and the frame is filtered once at the end.
+def _remove_outliers(df: pd.DataFrame, cols: List[str], method: str, k: float):
+    x = _float_block(df, cols)
+    lo, hi = _block_bounds(x, method, k)
+    keep = np.ones(len(df), dtype=bool)
+    counts = np.zeros(len(cols), dtype=np.int64)
+    for j in range(len(cols)):
+        if counts[:j].any():
+            (lo[j],), (hi[j],) = _block_bounds(x[keep, j:j + 1], method, k)
+        out = keep & ((x[:, j] < lo[j]) | (x[:, j] > hi[j]))
+        counts[j] = out.sum()
+        keep &= ~out
+    return df.loc[keep], lo, hi, counts
+
+
+# Rows and shallow in-memory size of a frame, for the per-op metrics
+def _frame_size(df: pd.DataFrame) -> dict:
+    return {"rows": len(df), "bytes": int(df.memory_usage(index=True).sum())}
+
+
 # Apply the cleaning plan: drop, cast, impute, trim, parse dates, scale, handle outliers.
 def apply_tabular_plan(
     path: str,
@@ -166,6 +254,7 @@ def apply_tabular_plan(
 
     for step in plan.get("ops", []):
         op = step.get("op")
+        meter, n_before = op_meter(_frame_size, df), len(log)
         try:
             if op == "drop_cols":
                 cols = [c for c in step["cols"] if c in df]
@@ -209,15 +298,9 @@ def apply_tabular_plan(
                 method = step.get("method", "standard")
                 inplace = step.get("inplace", False)
                 suffix = step.get("suffix", "_scaled")
-                new_cols = []
-                for c in cols:
-                    scaled = _scale(df[c], method)
-                    if inplace:
-                        df[c] = scaled
-                        new_cols.append(c)
-                    else:
-                        df[c + suffix] = scaled
-                        new_cols.append(c + suffix)
+                new_cols = cols if inplace else [c + suffix for c in cols]
+                if cols:
+                    df[new_cols] = _scale_block(_float_block(df, cols), method)
                 log.append({
                     "op": op, "cols": cols,
                     "method": method, "inplace": inplace,
@@ -231,23 +314,15 @@ def apply_tabular_plan(
                 action = step.get("action", "cap")
                 suffix = step.get("suffix", "_outlier")
 
-                for c in cols:
-                    lo, hi = _bounds(df[c], method, k)
-                    mask = df[c].notna() & ((df[c] < lo) | (df[c] > hi))
-                    n = int(mask.sum())
-
-                    if action == "cap":
-                        df.loc[df[c] < lo, c] = lo
-                        df.loc[df[c] > hi, c] = hi
-                    elif action == "remove":
-                        df = df.loc[~mask]
-                    else:
-                        df[c + suffix] = mask
-
+                if cols and action == "remove":
+                    df, lo, hi, counts = _remove_outliers(df, cols, method, k)
+                elif cols:
+                    lo, hi, counts = _cap_or_flag_outliers(df, cols, method, k, action, suffix)
+                for j, c in enumerate(cols):
                     log.append({
                         "op": op, "col": c,
-                        "action": action, "num_outliers": n,
-                        "lower": lo, "upper": hi,
+                        "action": action, "num_outliers": int(counts[j]),
+                        "lower": float(lo[j]), "upper": float(hi[j]),
                         "status": "ok"
                     })
 
@@ -257,6 +332,8 @@ def apply_tabular_plan(
 
         except Exception as e:
             log.append({"op": op, "status": "error", "error": str(e)})
+        if meter:
+            attach(log, n_before, meter.stop(_frame_size(df)))
 
     # If requested, write the cleaned DataFrame back to CSV
     if out_path:
@@ -266,18 +343,47 @@ def apply_tabular_plan(
 
 
 # High-level orchestration: profile, plan, apply, and summarize.
+# With a ResultStore (or PRISM_CACHE_DIR set) each step is looked up by content
+# hash first, so unchanged files with unchanged plans skip straight to results.
 def run_structured_data_logic(
     path: str,
     user_goal: str = "prepare for ML",
     out_path: Optional[str] = None,
+    cache: Optional[ResultStore] = None,
 ) -> Tuple[dict, str, dict]:
-    prof = profile_tabular(path)
-    plan = llm_make_tabular_plan(prof, user_goal)
+    store = cache if cache is not None else default_store()
+    if store is None:
+        prof = profile_tabular(path)
+        plan = llm_make_tabular_plan(prof, user_goal)
+        return _apply_and_summarize(path, plan, out_path) + (prof,)
+
+    fh, ver = file_digest(path), code_version(__file__)
+    prof = store.memo(store.key("tabular_profile", fh, ver), lambda: profile_tabular(path))
+    plan = store.memo(store.key("tabular_plan", json_digest(prof), user_goal),
+                      lambda: llm_make_tabular_plan(prof, user_goal), is_real_plan)
+
+    key = store.key("tabular_apply", fh, json_digest(plan), ver)
+    hit = store.get(key)
+    # A hit without the CSV artifact can't serve a request that wants the file
+    if hit is not None and (out_path is None or hit[1] is not None):
+        (processed, summary), files = hit
+        if out_path:
+            shutil.copyfile(os.path.join(files, "cleaned.csv"), out_path)
+        return processed, summary, prof
+
+    processed, summary = _apply_and_summarize(path, plan, out_path)
+    store.put(key, [processed, summary], {"cleaned.csv": out_path} if out_path else None)
+    return processed, summary, prof
+
+
+def _apply_and_summarize(path: str, plan: dict, out_path: Optional[str]) -> Tuple[dict, str]:
     df, log = apply_tabular_plan(path, plan, out_path)
     summary = f"Applied {len(plan['ops'])} ops. Rows: {len(df)}. Cols: {df.shape[1]}."
+    # {col: first 5 values}, JSON-safe: dates as ISO strings, NaN/NaT as null
+    head = json.loads(df.head(5).to_json(orient="split", date_format="iso", index=False))
     processed = {
-        "cleaned_preview": df.head(5).to_dict("list"),
+        "cleaned_preview": {c: [row[i] for row in head["data"]] for i, c in enumerate(head["columns"])},
         "plan": plan,
         "execution_log": log
     }
-    return processed, summary, prof
+    return processed, summary
@@ -5,6 +5,13 @@ from collections import Counter
 from typing import List, Tuple, Dict, Any, Optional
 import json
 import os
+import random
+import tempfile
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import scipy.sparse as sp
 import pypdf
 from langdetect import detect
 from langchain_google_genai import ChatGoogleGenerativeAI
@@ -13,6 +20,10 @@ import nltk
 from nltk.corpus import stopwords
 from nltk.stem import WordNetLemmatizer
 
+from agents.cache import ResultStore, code_version, default_store, file_digest, is_real_plan, json_digest
+from agents.instrument import op_meter
+from agents.metrics import observed_post
+
 # Download NLTK data quietly at import time
 nltk.download('punkt', quiet=True)
 nltk.download('stopwords', quiet=True)
@@ -21,7 +32,21 @@ nltk.download('wordnet', quiet=True)
 
 # Profile a text file or PDF: count chars, words, average word length,
 # detect language, find top tokens and boilerplate ratio.
-def profile_text(path: str) -> Dict[str, Any]:
+# mode="exact" reads everything; mode="sampled" stays within a byte/time budget;
+# mode="auto" only samples when the document is larger than the byte budget.
+def profile_text(
+    path: str,
+    mode: str = "exact",
+    budget_bytes: int = 2_000_000,
+    time_budget_s: Optional[float] = None,
+    n_chunks: int = 32,
+    seed: int = 0,
+) -> Dict[str, Any]:
+    if mode == "auto":
+        mode = "sampled" if _source_size(path) > budget_bytes else "exact"
+    if mode == "sampled":
+        return _profile_text_sampled(path, budget_bytes, time_budget_s, n_chunks, seed)
+
     text = ""
     if path.lower().endswith(".pdf"):
         # Read all pages from PDF
@@ -53,7 +78,145 @@ def profile_text(path: str) -> Dict[str, Any]:
         "avg_word_len": avg_word_len,
         "language": lang,
         "top_tokens": freq,
-        "boilerplate_ratio": boilerplate_ratio
+        "boilerplate_ratio": boilerplate_ratio,
+        "profile_mode": "exact"
+    }
+
+
+# Size of the source used to decide between exact and sampled profiling:
+# bytes for plain text, pages for PDFs (scaled by a rough bytes-per-page guess).
+def _source_size(path: str) -> int:
+    if path.lower().endswith(".pdf"):
+        return len(pypdf.PdfReader(path).pages) * 4_000
+    return os.path.getsize(path)
+
+
+# Mergeable Misra-Gries heavy-hitters summary. Keeps at most `capacity` counters,
+# so memory is bounded by the sketch size instead of the vocabulary; every
+# reported count underestimates the true count by at most `error`.
+class _HeavyHitters:
+    def __init__(self, capacity: int = 256):
+        self.capacity = capacity
+        self.counts: Counter = Counter()
+        self.error = 0
+
+    def update(self, chunk_counts: Counter) -> None:
+        self.counts.update(chunk_counts)
+        if len(self.counts) <= self.capacity:
+            return
+        # Subtract the (capacity+1)-th largest count and drop non-positive entries
+        cut = sorted(self.counts.values(), reverse=True)[self.capacity]
+        self.error += cut
+        self.counts = Counter({w: c - cut for w, c in self.counts.items() if c > cut})
+
+    def most_common(self, k: int) -> List[Tuple[str, int]]:
+        return self.counts.most_common(k)
+
+
+# Yield up to `n_chunks` text chunks, one per equal-size stratum of the source,
+# each starting at a random offset inside its stratum. Plain text chunks are
+# aligned to line boundaries; PDFs are sampled one page per stratum.
+def _sample_chunks(path: str, budget_bytes: int, n_chunks: int, rng: random.Random):
+    if path.lower().endswith(".pdf"):
+        reader = pypdf.PdfReader(path)
+        n_pages = len(reader.pages)
+        strata = min(n_chunks, n_pages)
+        for i in range(strata):
+            lo, hi = i * n_pages // strata, (i + 1) * n_pages // strata
+            page = reader.pages[rng.randrange(lo, max(lo + 1, hi))]
+            yield (page.extract_text() or ""), n_pages, strata
+        return
+
+    size = os.path.getsize(path)
+    strata = max(1, min(n_chunks, size // 1024 or 1))
+    chunk_len = max(1024, budget_bytes // strata)
+    with open(path, "rb") as f:
+        for i in range(strata):
+            lo, hi = i * size // strata, (i + 1) * size // strata
+            start = lo + rng.randint(0, max(0, hi - lo - chunk_len))
+            f.seek(start)
+            raw = f.read(min(chunk_len, hi - start))
+            text = raw.decode("utf-8", errors="ignore")
+            # Drop the partial first/last lines so every sampled line is whole
+            if start > 0 and "\n" in text:
+                text = text.split("\n", 1)[1]
+            if start + len(raw) < size and "\n" in text:
+                text = text.rsplit("\n", 1)[0]
+            yield text, size, strata
+
+
+# Budgeted profile: reads stratified chunks until the byte/time budget is spent,
+# extrapolates counts to the whole document and reports how confident they are.
+def _profile_text_sampled(
+    path: str,
+    budget_bytes: int,
+    time_budget_s: Optional[float],
+    n_chunks: int,
+    seed: int,
+) -> Dict[str, Any]:
+    rng = random.Random(seed)
+    deadline = time.perf_counter() + time_budget_s if time_budget_s else None
+    hh = _HeavyHitters()
+    line_counts: Counter = Counter()
+    densities: List[float] = []
+    sampled_units = sampled_chars = sampled_words = word_chars = n_lines = read_bytes = 0
+    is_pdf = path.lower().endswith(".pdf")
+    total_units, strata, head = 0, 0, ""
+    timed_out = False
+
+    for text, total_units, strata in _sample_chunks(path, budget_bytes, n_chunks, rng):
+        words = re.findall(r"\w+", text)
+        if len(head) < 10_000:
+            head += text[:10_000 - len(head)]
+        hh.update(Counter(w.lower() for w in words))
+        # Hash lines instead of storing them; collisions only inflate repetition slightly
+        lines = text.splitlines()
+        line_counts.update(zlib.crc32(l.encode("utf-8", "ignore")) for l in lines)
+        n_lines += len(lines)
+        n_bytes = len(text.encode("utf-8", "ignore"))
+        n_units = 1 if is_pdf else n_bytes
+        read_bytes += n_bytes
+        sampled_units += n_units
+        sampled_chars += len(text)
+        sampled_words += len(words)
+        word_chars += sum(len(w) for w in words)
+        densities.append(len(words) / n_units if n_units else 0.0)
+        if deadline and time.perf_counter() > deadline:
+            timed_out = True
+            break
+        if is_pdf and read_bytes >= budget_bytes:
+            break
+
+    # Scale sample totals to the whole document (bytes for text, pages for PDF)
+    frac = min(1.0, sampled_units / total_units) if total_units else 1.0
+    scale = 1.0 / frac if frac else 1.0
+    repeats = sum(c for c in line_counts.values() if c > 1)
+
+    # Relative standard error of the word count from the spread of per-chunk densities
+    n = len(densities)
+    mean_d = sum(densities) / n if n else 0.0
+    var_d = sum((d - mean_d) ** 2 for d in densities) / (n - 1) if n > 1 else 0.0
+    words_rel_se = (var_d ** 0.5 / n ** 0.5 / mean_d) * (1 - frac) ** 0.5 if mean_d else 0.0
+
+    return {
+        "chars": int(round(sampled_chars * scale)),
+        "words": int(round(sampled_words * scale)),
+        "avg_word_len": word_chars / sampled_words if sampled_words else 0.0,
+        "language": detect(head) if sampled_words else "unknown",
+        "top_tokens": [(w, int(round(c * scale))) for w, c in hh.most_common(10)],
+        "boilerplate_ratio": repeats / n_lines if n_lines else 0.0,
+        "profile_mode": "sampled",
+        "confidence": {
+            "sampled_fraction": round(frac, 4),
+            "chunks_sampled": n,
+            "chunks_planned": strata,
+            "timed_out": timed_out,
+            "words_rel_stderr": round(words_rel_se, 4),
+            # Each reported top-token count may be low by at most this much
+            "top_tokens_max_undercount": int(round(hh.error * scale)),
+            # Lines repeated across unsampled regions are missed, so this is a lower bound
+            "boilerplate_ratio_is_lower_bound": frac < 1.0,
+        }
     }
 
 
@@ -77,7 +240,6 @@ def _flatten_resp(content: Any) -> str:
 # Ask Gemini to propose a sequence of text-cleaning operations given the profile.
 def llm_make_text_plan(profile: dict, user_goal: str = "prepare for NLP") -> dict:
     try:
-        import requests
 
         # Load API key from repo .env (not ideal for sharing)
         env_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), '.env')
@@ -92,7 +254,7 @@ def llm_make_text_plan(profile: dict, user_goal: str = "prepare for NLP") -> dic
         prompt = f"{_PLAN_PROMPT}\n\n{json.dumps({'profile': profile, 'user_goal': user_goal})}"
         payload = {'contents': [{'parts': [{'text': prompt}]}]}
 
-        response = requests.post(url, json=payload, timeout=30)
+        response = observed_post("text_plan", url, json=payload, timeout=30)
         if response.status_code == 200:
             result = response.json()
             txt = result['candidates'][0]['content']['parts'][0]['text']
@@ -131,6 +293,7 @@ def apply_text_plan(text: str, plan: dict) -> Tuple[str, List[dict]]:
 
     for step in plan.get("ops", []):
         op = step.get("op")
+        meter = op_meter(lambda: {"chars": len(text)})
         try:
             if op == "remove_boilerplate":
                 text = remove_boilerplate(text)
@@ -168,6 +331,8 @@ def apply_text_plan(text: str, plan: dict) -> Tuple[str, List[dict]]:
             log.append({"op": op, "status": "ok"})
         except Exception as e:
             log.append({"op": op, "status": "error", "error": str(e)})
+        if meter:
+            log[-1]["metrics"] = meter.stop({"chars": len(text)})
 
     return text, log
 
@@ -180,15 +345,257 @@ def load_raw_text(path: str) -> str:
     return Path(path).read_text(encoding="utf-8")
 
 
+# Vocabulary id reserved for tokens dropped by min_freq / unseen at encode time.
+UNK_TOKEN = "<unk>"
+
+# Vocab for the encode workers, installed once per process by the pool initializer.
+_WORKER_VOCAB: Dict[str, int] = {}
+
+
+# Map step of vocab building: whitespace tokens of one cleaned file, same split
+# that apply_text_plan uses for `tokenize`.
+def _count_file_tokens(path: str) -> Counter:
+    return Counter(Path(path).read_text(encoding="utf-8").split())
+
+
+def _init_encode_worker(vocab: Dict[str, int]) -> None:
+    global _WORKER_VOCAB
+    _WORKER_VOCAB = vocab
+
+
+def _encode_file(path: str) -> np.ndarray:
+    toks = Path(path).read_text(encoding="utf-8").split()
+    return np.fromiter((_WORKER_VOCAB.get(t, 0) for t in toks), dtype=np.int64, count=len(toks))
+
+
+# Token counts for every file in a batch, computed per file on a process pool.
+# Returns the merged counts and each file's token length.
+def _count_batch(paths: List[str], workers: Optional[int]) -> Tuple[Counter, List[int]]:
+    counts: Counter = Counter()
+    lengths: List[int] = []
+    if len(paths) > 1 and workers != 1:
+        with ProcessPoolExecutor(max_workers=workers) as ex:
+            per_file = ex.map(_count_file_tokens, paths, chunksize=max(1, len(paths) // 64))
+            for c in per_file:
+                counts.update(c)
+                lengths.append(sum(c.values()))
+    else:
+        for p in paths:
+            c = _count_file_tokens(p)
+            counts.update(c)
+            lengths.append(sum(c.values()))
+    return counts, lengths
+
+
+# Assign ids by descending frequency (ties broken alphabetically) so the same
+# batch always gets the same ids; id 0 is UNK_TOKEN.
+def _vocab_from_counts(counts: Counter, min_freq: int) -> Dict[str, int]:
+    vocab = {UNK_TOKEN: 0}
+    for tok, c in sorted(counts.items(), key=lambda kv: (-kv[1], kv[0])):
+        if c >= min_freq and tok not in vocab:
+            vocab[tok] = len(vocab)
+    return vocab
+
+
+# Build one vocabulary across a batch of cleaned text files.
+def build_vocab(paths: List[str], min_freq: int = 1, workers: Optional[int] = None) -> Dict[str, int]:
+    counts, _ = _count_batch(paths, workers)
+    return _vocab_from_counts(counts, min_freq)
+
+
+# Export a batch of cleaned text files as token ids for NLP consumers:
+#   <prefix>_tokens.npy   flat uint16/uint32 array of every document's ids
+#   <prefix>_offsets.npy  int64, document i spans tokens[offsets[i]:offsets[i+1]]
+#   <prefix>_vocab.json   id -> token list plus the source file of each document
+# Both arrays are plain .npy files, so np.load(..., mmap_mode="r") is zero-copy.
+def export_token_ids(
+    paths: List[str],
+    out_dir: str,
+    prefix: str = "corpus",
+    min_freq: int = 1,
+    workers: Optional[int] = None,
+) -> Dict[str, Any]:
+    os.makedirs(out_dir, exist_ok=True)
+    counts, lengths = _count_batch(paths, workers)
+    vocab = _vocab_from_counts(counts, min_freq)
+    dtype = np.uint16 if len(vocab) <= np.iinfo(np.uint16).max + 1 else np.uint32
+
+    # Lengths are known from the counting pass, so the output can be preallocated
+    offsets = np.zeros(len(paths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    tokens_path = os.path.join(out_dir, f"{prefix}_tokens.npy")
+    tokens = np.lib.format.open_memmap(tokens_path, mode="w+", dtype=dtype, shape=(int(offsets[-1]),))
+
+    if len(paths) > 1 and workers != 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_encode_worker,
+                                 initargs=(vocab,)) as ex:
+            for i, ids in enumerate(ex.map(_encode_file, paths)):
+                tokens[offsets[i]:offsets[i + 1]] = ids
+    else:
+        _init_encode_worker(vocab)
+        for i, p in enumerate(paths):
+            tokens[offsets[i]:offsets[i + 1]] = _encode_file(p)
+    tokens.flush()
+    del tokens
+
+    offsets_path = os.path.join(out_dir, f"{prefix}_offsets.npy")
+    np.save(offsets_path, offsets)
+    vocab_path = os.path.join(out_dir, f"{prefix}_vocab.json")
+    with open(vocab_path, "w", encoding="utf-8") as f:
+        json.dump({
+            "tokens": list(vocab),
+            "unk_id": 0,
+            "dtype": np.dtype(dtype).name,
+            "documents": [os.path.basename(p) for p in paths]
+        }, f, ensure_ascii=False)
+
+    return {
+        "tokens": tokens_path,
+        "offsets": offsets_path,
+        "vocab": vocab_path,
+        "vocab_size": len(vocab),
+        "num_tokens": int(offsets[-1]),
+        "num_documents": len(paths)
+    }
+
+
+# Load an export written by export_token_ids without copying the token array.
+# Returns (tokens memmap, offsets, id -> token list, document names).
+def load_token_ids(out_dir: str, prefix: str = "corpus") -> Tuple[np.ndarray, np.ndarray, List[str], List[str]]:
+    tokens = np.load(os.path.join(out_dir, f"{prefix}_tokens.npy"), mmap_mode="r")
+    offsets = np.load(os.path.join(out_dir, f"{prefix}_offsets.npy"))
+    with open(os.path.join(out_dir, f"{prefix}_vocab.json"), encoding="utf-8") as f:
+        meta = json.load(f)
+    return tokens, offsets, meta["tokens"], meta["documents"]
+
+
+# Hashed column ids for every word n-gram of one document. CRC32 is stable
+# across processes and runs (unlike hash()), so exports from different batches
+# share the same feature space.
+def _hash_ngrams(tokens: List[str], ngram_range: Tuple[int, int], n_features: int) -> np.ndarray:
+    lo, hi = ngram_range
+    ids = [
+        zlib.crc32(" ".join(tokens[i:i + n]).encode("utf-8")) % n_features
+        for n in range(lo, hi + 1)
+        for i in range(len(tokens) - n + 1)
+    ]
+    return np.asarray(ids, dtype=np.int64)
+
+
+MAX_HASH_FEATURES = 2 ** 24  # keeps column ids int32-safe and df/idf vectors small
+MAX_NGRAM = 5
+
+
+# Export hashed n-gram features for a batch of cleaned text files as a CSR
+# matrix (one row per document) saved with scipy's compressed .npz format.
+# Documents are streamed one at a time; apart from the output itself, memory is
+# bounded by n_features (the document-frequency vector), not the vocabulary.
+# weighting="count" keeps raw counts, "tfidf" applies smoothed idf + L2 norm.
+def export_text_features(
+    paths: List[str],
+    out_dir: str,
+    prefix: str = "corpus",
+    n_features: int = 2 ** 20,
+    ngram_range: Tuple[int, int] = (1, 1),
+    weighting: str = "tfidf",
+) -> Dict[str, Any]:
+    n_features = int(n_features)
+    ngram_range = (int(ngram_range[0]), int(ngram_range[1]))
+    if not 1 <= n_features <= MAX_HASH_FEATURES:
+        raise ValueError(f"n_features must be in 1..{MAX_HASH_FEATURES}, got {n_features}")
+    if not 1 <= ngram_range[0] <= ngram_range[1] <= MAX_NGRAM:
+        raise ValueError(f"ngram_range must satisfy 1 <= lo <= hi <= {MAX_NGRAM}, got {ngram_range}")
+    if weighting not in ("tfidf", "count"):
+        raise ValueError(f"weighting must be 'tfidf' or 'count', got {weighting!r}")
+    os.makedirs(out_dir, exist_ok=True)
+    doc_freq = np.zeros(n_features, dtype=np.int64)
+    indptr = [0]
+    indices: List[np.ndarray] = []
+    data: List[np.ndarray] = []
+
+    for p in paths:
+        toks = Path(p).read_text(encoding="utf-8").split()
+        cols, counts = np.unique(_hash_ngrams(toks, ngram_range, n_features), return_counts=True)
+        doc_freq[cols] += 1
+        indices.append(cols.astype(np.int32))
+        data.append(counts.astype(np.float32))
+        indptr.append(indptr[-1] + len(cols))
+
+    mat = sp.csr_matrix(
+        (
+            np.concatenate(data) if data else np.zeros(0, np.float32),
+            np.concatenate(indices) if indices else np.zeros(0, np.int32),
+            np.asarray(indptr, dtype=np.int64)
+        ),
+        shape=(len(paths), n_features)
+    )
+
+    idf_path = None
+    if weighting == "tfidf":
+        # Same smoothing as scikit-learn's TfidfTransformer(smooth_idf=True)
+        idf = (np.log((1 + len(paths)) / (1 + doc_freq)) + 1).astype(np.float32)
+        mat.data *= idf[mat.indices]
+        norms = np.sqrt(np.asarray(mat.multiply(mat).sum(axis=1)).ravel())
+        norms[norms == 0] = 1
+        mat.data /= np.repeat(norms, np.diff(mat.indptr)).astype(np.float32)
+        idf_path = os.path.join(out_dir, f"{prefix}_idf.npy")
+        np.save(idf_path, idf)
+
+    matrix_path = os.path.join(out_dir, f"{prefix}_features.npz")
+    sp.save_npz(matrix_path, mat, compressed=True)
+    meta_path = os.path.join(out_dir, f"{prefix}_features.json")
+    with open(meta_path, "w", encoding="utf-8") as f:
+        json.dump({
+            "n_features": n_features,
+            "ngram_range": list(ngram_range),
+            "weighting": weighting,
+            "hash": "crc32",
+            "documents": [os.path.basename(p) for p in paths]
+        }, f)
+
+    return {
+        "matrix": matrix_path,
+        "meta": meta_path,
+        "idf": idf_path,
+        "shape": list(mat.shape),
+        "nnz": int(mat.nnz)
+    }
+
+
 # Orchestrate profiling, planning, cleaning, and return results.
+# With a ResultStore (or PRISM_CACHE_DIR set) unchanged files reuse their cached
+# profile, plan and cleaned text.
 def run_text_data_logic(
     file_path: str,
-    user_goal: str = "prepare for NLP"
+    user_goal: str = "prepare for NLP",
+    profile_mode: str = "exact",
+    cache: Optional[ResultStore] = None
 ) -> Tuple[Dict[str, Any], str, str]:
-    prof = profile_text(file_path)
-    plan = llm_make_text_plan(prof, user_goal)
-    raw = load_raw_text(file_path)
-    cleaned, log = apply_text_plan(raw, plan)
+    store = cache if cache is not None else default_store()
+    if store is None:
+        prof = profile_text(file_path, mode=profile_mode)
+        plan = llm_make_text_plan(prof, user_goal)
+        cleaned, log = apply_text_plan(load_raw_text(file_path), plan)
+    else:
+        fh, ver = file_digest(file_path), code_version(__file__)
+        prof = store.memo(store.key("text_profile", fh, profile_mode, ver),
+                          lambda: profile_text(file_path, mode=profile_mode))
+        plan = store.memo(store.key("text_plan", json_digest(prof), user_goal),
+                          lambda: llm_make_text_plan(prof, user_goal), is_real_plan)
+        key = store.key("text_apply", fh, json_digest(plan), ver)
+        hit = store.get(key)
+        if hit is not None and hit[1] is not None:
+            log = hit[0]
+            cleaned = Path(hit[1], "cleaned.txt").read_text(encoding="utf-8")
+        else:
+            cleaned, log = apply_text_plan(load_raw_text(file_path), plan)
+            with tempfile.NamedTemporaryFile("w", encoding="utf-8", suffix=".txt", delete=False) as tmp:
+                tmp.write(cleaned)
+            try:
+                store.put(key, log, {"cleaned.txt": tmp.name})
+            finally:
+                os.remove(tmp.name)
+
     preview = cleaned[:500]  # first 500 chars for preview
     summary = f"Applied {len(plan['ops'])} ops; final length {len(cleaned)} chars."
     return (
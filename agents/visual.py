@@ -1,43 +1,91 @@
 
 import os
 import io
+import shutil
+import tempfile
 import uuid
 import json
-from typing import Any, Dict, List, Tuple
+import time
+import hashlib
+import threading
+import contextvars
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Tuple
 
 import numpy as np
 import cv2
+from PIL import Image
+
+from agents.cache import ResultStore, code_version, default_store, file_digest, is_real_plan, json_digest
+from agents.instrument import attach, op_meter
+from agents.metrics import observed_post
 
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain_core.messages import HumanMessage
-from tensorflow.keras.preprocessing.image import ImageDataGenerator
+
+# Reduced-resolution decode flags; JPEG decodes these natively via DCT scaling.
+_REDUCED_FLAGS = {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2,
+                  4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+
+# Read (width, height, format) from the file header without decoding pixels. EXIF
+# orientations 5-8 are swapped to match what cv2.imread returns. None if unknown.
+def _header_info(src: Any) -> Any:
+    try:
+        with Image.open(src) as im:
+            w, h = im.size
+            if im.getexif().get(0x0112, 1) in (5, 6, 7, 8):
+                w, h = h, w
+            return w, h, im.format
+    except Exception:
+        return None
+    finally:
+        if isinstance(src, io.BytesIO):
+            src.seek(0)
 
 # Get basic stats about the image—size, dimensions, aspect ratio, and pixel stats.
 # Works with file paths or in-memory bytes.
-def profile_image(path_or_buffer: Any) -> Dict[str, Any]:
+# Dimensions come from the header. With precision="fast" (default) pixel stats use
+# a 1/2, 1/4 or 1/8 scale decode that keeps the short side >= min_side. Block
+# averaging preserves the mean, so |mean error| <= 1 grey level plus 255 x the
+# fraction of edge pixels dropped by the scaled decode; std is a lower bound
+# (variance inside each factor x factor block is averaged away).
+# Both are reported under "stats_precision". precision="full" decodes everything.
+def profile_image(path_or_buffer: Any, precision: str="fast", min_side: int=256) -> Dict[str, Any]:
     file_size = 0
     img = None
+    data = None
 
     # Handle disk path vs. BytesIO
     if isinstance(path_or_buffer, str):
         file_size = os.path.getsize(path_or_buffer)  # file size in bytes
-        img = cv2.imread(path_or_buffer)              # load with OpenCV
     elif isinstance(path_or_buffer, io.BytesIO):
-        # read all bytes, decode to OpenCV image
-        file_bytes = np.asarray(bytearray(path_or_buffer.read()), dtype=np.uint8)
-        file_size = len(file_bytes)
-        img = cv2.imdecode(file_bytes, cv2.IMREAD_COLOR)
-        path_or_buffer.seek(0)  # rewind buffer
+        # read all bytes for OpenCV
+        data = np.frombuffer(path_or_buffer.getvalue(), dtype=np.uint8)
+        file_size = len(data)
+    else:
+        raise ValueError("Could not read the image.")
+
+    header = _header_info(path_or_buffer)
+    size = header[:2] if header else None
+    factor = 1
+    if size and precision != "full":
+        while factor < 8 and min(size) // (factor * 2) >= min_side:
+            factor *= 2
+    flag = _REDUCED_FLAGS[factor]
+    img = cv2.imread(path_or_buffer, flag) if data is None else cv2.imdecode(data, flag)
     # If nothing loaded, bail out
     if img is None:
         raise ValueError("Could not read the image.")
 
-    h, w = img.shape[:2]
+    # factor > 1 only when the header gave the full size
+    w, h = size if size else img.shape[1::-1]
     stats = {
         "width": w,
         "height": h,
         "aspect_ratio": round(w / h, 3) if h > 0 else 0,
-        "file_size_bytes": file_size
+        "file_size_bytes": file_size,
+        "format": header[2] if header else None
     }
 
     # If color image, compute per-channel mean/std
@@ -49,15 +97,136 @@ def profile_image(path_or_buffer: Any) -> Dict[str, Any]:
         # grayscale fallback
         stats["mean_pixel"] = [float(round(img.mean(), 2))]
         stats["std_pixel"]  = [float(round(img.std(), 2))]
+
+    covered = min(1.0, img.shape[0] * img.shape[1] * factor * factor / float(w * h)) if w * h else 1.0
+    stats["stats_precision"] = {
+        "decode_scale": 1 / factor,
+        "mean_max_abs_error": 0.0 if factor == 1 else round(1.0 + 255 * (1 - covered), 2),
+        "std_is_lower_bound": factor > 1
+    }
     return stats
 
+# --- Dataset-level profiling ------------------------------------------------
+# Every image becomes a small mergeable partial (fixed-bin histograms, format
+# counts, per-channel Welford count/mean/M2), so partials from worker processes
+# combine in any order into one dataset summary for llm_make_visual_plan.
+
+# Fixed histogram edges (pixels) so partials from different workers line up.
+_SIZE_BINS = [0, 64, 128, 256, 512, 1024, 2048, 4096, 8192]
+_ASPECT_BINS = [0, 0.5, 0.75, 0.9, 1.1, 1.34, 1.8, 2.5]
+_IMAGE_EXTS = (".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff", ".webp")
+
+def _bin(value: float, edges: List[float]) -> int:
+    # Index of the bin containing value; the last bin is open-ended
+    i = 0
+    while i + 1 < len(edges) and value >= edges[i + 1]:
+        i += 1
+    return i
+
+def _empty_partial() -> Dict[str, Any]:
+    return {"n": 0, "failed": 0, "formats": {}, "bytes": 0,
+            "width_hist": [0] * len(_SIZE_BINS), "height_hist": [0] * len(_SIZE_BINS),
+            "aspect_hist": [0] * len(_ASPECT_BINS),
+            "w_min": None, "w_max": None, "h_min": None, "h_max": None,
+            "px": 0, "mean": None, "m2": None}
+
+def _merge_partials(a: Dict[str, Any], b: Dict[str, Any]) -> Dict[str, Any]:
+    out = _empty_partial()
+    out["n"], out["failed"], out["bytes"] = a["n"] + b["n"], a["failed"] + b["failed"], a["bytes"] + b["bytes"]
+    out["formats"] = dict(a["formats"])
+    for k, v in b["formats"].items():
+        out["formats"][k] = out["formats"].get(k, 0) + v
+    for k in ("width_hist", "height_hist", "aspect_hist"):
+        out[k] = [x + y for x, y in zip(a[k], b[k])]
+    for k, pick in (("w_min", min), ("h_min", min), ("w_max", max), ("h_max", max)):
+        vals = [v for v in (a[k], b[k]) if v is not None]
+        out[k] = pick(vals) if vals else None
+    # Chan et al. parallel variance merge, weighted by pixel count
+    if a["mean"] is None or b["mean"] is None:
+        src = a if b["mean"] is None else b
+        out["px"], out["mean"], out["m2"] = src["px"], src["mean"], src["m2"]
+    else:
+        n = a["px"] + b["px"]
+        ma, mb = np.asarray(a["mean"]), np.asarray(b["mean"])
+        delta = mb - ma
+        out["px"] = n
+        out["mean"] = (ma + delta * b["px"] / n).tolist()
+        out["m2"] = (np.asarray(a["m2"]) + np.asarray(b["m2"]) + delta ** 2 * a["px"] * b["px"] / n).tolist()
+    return out
+
+def _image_partial(path: str) -> Dict[str, Any]:
+    part = _empty_partial()
+    try:
+        prof = profile_image(path)
+    except Exception:
+        part["failed"] = 1
+        return part
+    w, h = prof["width"], prof["height"]
+    part["n"], part["bytes"] = 1, prof["file_size_bytes"]
+    fmt = prof.get("format") or os.path.splitext(path)[1].lstrip(".").upper()
+    part["formats"] = {fmt: 1}
+    part["width_hist"][_bin(w, _SIZE_BINS)] += 1
+    part["height_hist"][_bin(h, _SIZE_BINS)] += 1
+    if h:
+        part["aspect_hist"][_bin(w / h, _ASPECT_BINS)] += 1
+    part["w_min"] = part["w_max"] = w
+    part["h_min"] = part["h_max"] = h
+    part["px"] = w * h
+    part["mean"] = prof["mean_pixel"]
+    part["m2"] = [sd ** 2 * w * h for sd in prof["std_pixel"]]
+    return part
+
+def _profile_image_chunk(paths: List[str]) -> Dict[str, Any]:
+    acc = _empty_partial()
+    for p in paths:
+        acc = _merge_partials(acc, _image_partial(p))
+    return acc
+
+# Profile a whole batch (list of paths) or directory of images on a process pool
+# and return a JSON-friendly summary to pass as llm_make_visual_plan(dataset_info=...).
+def profile_image_dataset(paths_or_dir: Any, workers: int=None, chunk: int=64) -> Dict[str, Any]:
+    if isinstance(paths_or_dir, str):
+        paths = sorted(
+            os.path.join(root, fn)
+            for root, _, files in os.walk(paths_or_dir)
+            for fn in files if fn.lower().endswith(_IMAGE_EXTS)
+        )
+    else:
+        paths = list(paths_or_dir)
+
+    chunks = [paths[i:i + chunk] for i in range(0, len(paths), chunk)]
+    acc = _empty_partial()
+    if len(chunks) > 1 and workers != 1:
+        with ProcessPoolExecutor(max_workers=workers) as ex:
+            for part in ex.map(_profile_image_chunk, chunks):
+                acc = _merge_partials(acc, part)
+    else:
+        for c in chunks:
+            acc = _merge_partials(acc, _profile_image_chunk(c))
+
+    def hist(counts, edges):
+        return {"edges": edges, "counts": counts}
+    std = (np.sqrt(np.asarray(acc["m2"]) / acc["px"]).round(2).tolist()
+           if acc["px"] else None)
+    return {
+        "num_images": acc["n"],
+        "num_unreadable": acc["failed"],
+        "formats": acc["formats"],
+        "total_bytes": acc["bytes"],
+        "width": {"min": acc["w_min"], "max": acc["w_max"], "histogram": hist(acc["width_hist"], _SIZE_BINS)},
+        "height": {"min": acc["h_min"], "max": acc["h_max"], "histogram": hist(acc["height_hist"], _SIZE_BINS)},
+        "aspect_ratio": {"histogram": hist(acc["aspect_hist"], _ASPECT_BINS)},
+        # Pixel-weighted per-channel (BGR) stats across the whole dataset
+        "channel_mean": np.round(acc["mean"], 2).tolist() if acc["mean"] is not None else None,
+        "channel_std": std
+    }
+
 # Ask Gemini to plan preprocessing steps given your image stats and goal.
 def llm_make_visual_plan(profile: dict,
                          user_goal: str="prepare for ML",
                          dataset_info: dict=None) -> Dict[str, Any]:
     """Generates a visual plan using Gemini."""
     try:
-        import requests
         import os
         # Load API key from .env at repo root (not ideal for shareable code)
         env_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), '.env')
@@ -95,7 +264,7 @@ NO MARKDOWN. ONLY JSON."""
         headers = {'Content-Type': 'application/json'}
         payload = {'contents': [{'parts': [{'text': prompt}]}]}
 
-        response = requests.post(url, json=payload, headers=headers, timeout=30)
+        response = observed_post("visual_plan", url, json=payload, headers=headers, timeout=30)
         if response.status_code == 200:
             result = response.json()
             txt = result['candidates'][0]['content']['parts'][0]['text']
@@ -132,7 +301,6 @@ NO MARKDOWN. ONLY JSON."""
 def llm_explain_step(step: Dict[str, Any], profile: dict, user_goal: str) -> str:
     """Critical, educational explanation for one preprocessing step."""
     try:
-        import requests
         # load key again—ugh, duplicate logic
         env_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), '.env')
         with open(env_path, 'r') as f:
@@ -149,7 +317,7 @@ You are a fair AI instructor. Context:
 - Step: {json.dumps(step)}
 Task: 1) What it does 2) Critical consideration 3) ML impact."""
         payload = {'contents': [{'parts': [{'text': prompt}]}]}
-        response = requests.post(url, json=payload, timeout=30)
+        response = observed_post("explain_step", url, json=payload, timeout=30)
         if response.status_code == 200:
             result = response.json()
             return result['candidates'][0]['content']['parts'][0]['text']
@@ -157,21 +325,24 @@ Task: 1) What it does 2) Critical consideration 3) ML impact."""
             raise Exception(f"API Error: {response.text}")
 
     except Exception:
-        # fallback explanations for common ops
-        op = step.get('op', 'unknown')
-        if op == 'resize':
-            return f"Resize to {step.get('width',224)}x{step.get('height',224)} to standardize input size."
-        if op == 'denoise':
-            return f"Denoise ({step.get('method','gaussian')}) reduces noise for cleaner input."
-        if op == 'normalize':
-            return f"Normalize ({step.get('method','minmax')}) scales pixels for stable training."
-        if op == 'augment':
-            if step.get('mode') == 'ml_training':
-                return (f"ML augment: {step.get('num_variants',6)} random variants "
-                        f"(rot±{step.get('rotation_range',0)}°, zoom±{step.get('zoom_range',0)}) "
-                        "to boost model robustness.")
-            return "Augment applies fixed transforms to preview results deterministically."
-        return f"No explanation available for op: {op}"
+        return fallback_explanation(step)
+
+# Canned explanations for common ops, used when the LLM is unavailable
+def fallback_explanation(step: Dict[str, Any]) -> str:
+    op = step.get('op', 'unknown')
+    if op == 'resize':
+        return f"Resize to {step.get('width',224)}x{step.get('height',224)} to standardize input size."
+    if op == 'denoise':
+        return f"Denoise ({step.get('method','gaussian')}) reduces noise for cleaner input."
+    if op == 'normalize':
+        return f"Normalize ({step.get('method','minmax')}) scales pixels for stable training."
+    if op == 'augment':
+        if step.get('mode') == 'ml_training':
+            return (f"ML augment: {step.get('num_variants',6)} random variants "
+                    f"(rot±{step.get('rotation_range',0)}°, zoom±{step.get('zoom_range',0)}) "
+                    "to boost model robustness.")
+        return "Augment applies fixed transforms to preview results deterministically."
+    return f"No explanation available for op: {op}"
 
 # Each op implementation. Notice we unify names and add fallback methods.
 def op_resize(img: np.ndarray, width: int, height: int, interp: str="INTER_AREA") -> np.ndarray:
@@ -189,7 +360,12 @@ def op_denoise(img: np.ndarray, method: str="gaussian", ksize: int=5) -> np.ndar
         return cv2.bilateralFilter(img, d=ksize, sigmaColor=ksize*2, sigmaSpace=ksize*2)
     return img  # unknown method—no change
 
-def op_normalize(img: np.ndarray, method: str="minmax") -> np.ndarray:
+def op_normalize(img: np.ndarray, method: str="minmax", stats: Dict[str, Any]=None,
+                 out: np.ndarray=None) -> np.ndarray:
+    # With dataset `stats` (see compute_dataset_norm_stats) use the shared
+    # per-channel statistics instead of this image's own
+    if stats is not None:
+        return _normalize_with_stats(img, method, stats, out)
     f = img.astype("float32")
     if method == "minmax":
         mn, mx = f.min(), f.max()
@@ -202,6 +378,45 @@ def op_normalize(img: np.ndarray, method: str="minmax") -> np.ndarray:
         return norm.astype("float32")  # preserve floats for ML
     return img
 
+def _normalize_with_stats(img: np.ndarray, method: str, stats: Dict[str, Any],
+                          out: np.ndarray=None) -> np.ndarray:
+    # Per-channel affine map x * scale + offset. uint8 input goes through a
+    # 256-entry LUT (one pass, no float copy of the input); other dtypes are
+    # scaled in place inside a single float32 buffer, which may be `out`.
+    c = 1 if img.ndim == 2 else img.shape[2]
+    if method == "minmax":
+        lo, hi = np.float32(stats["min"][:c]), np.float32(stats["max"][:c])
+        rng = hi - lo
+        scale = np.float32(255) / np.where(rng > 0, rng, 1).astype(np.float32)
+        offset = -lo * scale
+    elif method == "zscore":
+        sd = np.float32(stats["std"][:c])
+        scale = 1 / np.where(sd > 0, sd, 1).astype(np.float32)
+        offset = -np.float32(stats["mean"][:c]) * scale
+    else:
+        return img
+
+    if img.dtype == np.uint8:
+        lut = np.arange(256, dtype=np.float32)[:, None] * scale + offset
+        if method == "minmax":
+            lut = lut.clip(0, 255).round().astype(np.uint8)
+        lut = lut.reshape(1, 256, c) if c > 1 else lut.reshape(1, 256)
+        if out is not None:
+            out[...] = cv2.LUT(img, lut)
+            return out
+        return cv2.LUT(img, lut)
+
+    f = out if out is not None and out.dtype == np.float32 else np.empty(img.shape, np.float32)
+    np.multiply(img, scale, out=f, casting="unsafe")
+    f += offset
+    if method == "minmax":
+        np.clip(f, 0, 255, out=f)
+        if out is not None and out.dtype == np.uint8:
+            out[...] = f
+            return out
+        return f.astype(np.uint8)
+    return f
+
 # Wrapper that picks deterministic vs ML training augment
 def op_augment(img: np.ndarray, aug_args: Dict[str, Any]) -> List[Tuple[np.ndarray, str]]:
     """
@@ -214,117 +429,1193 @@ def op_augment(img: np.ndarray, aug_args: Dict[str, Any]) -> List[Tuple[np.ndarr
     return [(op_augment_deterministic(img, aug_args), "deterministic")]
 
 def op_augment_deterministic(img: np.ndarray, aug_args: Dict[str, Any]) -> np.ndarray:
-    # Fixed transforms so preview == actual output
-    h, w = img.shape[:2]
-    # Rotation
-    rot = aug_args.get("rotation", 0)
-    if rot:
-        M = cv2.getRotationMatrix2D((w/2, h/2), rot, 1)
-        img = cv2.warpAffine(img, M, (w, h))
-    # Zoom
-    zoom = aug_args.get("zoom", 1.0)
-    if zoom > 0 and zoom != 1.0:
-        img = cv2.resize(img, None, fx=zoom, fy=zoom, interpolation=cv2.INTER_LINEAR)
-        h, w = img.shape[:2]
-    # Shifts
-    h_shift, v_shift = aug_args.get("h_shift", 0), aug_args.get("v_shift", 0)
-    if h_shift or v_shift:
-        M = np.float32([[1, 0, h_shift*w], [0, 1, v_shift*h]])
-        img = cv2.warpAffine(img, M, (w, h))
-    # Flips
-    if aug_args.get("h_flip"):
-        img = cv2.flip(img, 1)
-    if aug_args.get("v_flip"):
-        img = cv2.flip(img, 0)
-    return img
+    # Fixed transforms so preview == actual output; rotation, zoom, shift and
+    # flips are folded into one matrix so the image is resampled only once
+    return _apply_affine(img, [dict(aug_args, op="augment")])
+
+# Keras fill_mode names -> OpenCV border modes (same edge behaviour as scipy.ndimage).
+_FILL_MODES = {
+    "nearest": cv2.BORDER_REPLICATE,
+    "constant": cv2.BORDER_CONSTANT,
+    "reflect": cv2.BORDER_REFLECT,
+    "wrap": cv2.BORDER_WRAP,
+}
+
+def _range(value: Any, default_lo: float, default_hi: float) -> Tuple[float, float]:
+    # Accept a scalar (symmetric around the default) or an explicit [lo, hi] pair
+    if isinstance(value, (list, tuple)) and len(value) == 2:
+        return float(value[0]), float(value[1])
+    return default_lo - float(value), default_hi + float(value)
+
+def sample_augment_matrices(shape: Tuple[int, int], aug_args: Dict[str, Any], n: int,
+                            rng: np.random.Generator) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Draw `n` random transforms at once with the same distributions as Keras'
+    ImageDataGenerator and fold each one (rotation, shift, shear, zoom, flips)
+    into a single 2x3 matrix in OpenCV (x, y) order mapping output -> input pixels.
+    Returns (matrices[n, 2, 3], brightness[n]).
+    """
+    h, w = shape
+    zeros, ones = np.zeros(n), np.ones(n)
+
+    rot = aug_args.get("rotation_range") or 0
+    theta = np.deg2rad(rng.uniform(-rot, rot, n)) if rot else zeros
+    hs = aug_args.get("height_shift_range") or 0
+    tx = rng.uniform(-hs, hs, n) * (h if abs(hs) < 1 else 1) if hs else zeros
+    ws = aug_args.get("width_shift_range") or 0
+    ty = rng.uniform(-ws, ws, n) * (w if abs(ws) < 1 else 1) if ws else zeros
+    sh = aug_args.get("shear_range") or 0
+    shear = np.deg2rad(rng.uniform(-sh, sh, n)) if sh else zeros
+    zr = aug_args.get("zoom_range") or 0
+    if zr:
+        lo, hi = _range(zr, 1.0, 1.0)
+        zx, zy = rng.uniform(lo, hi, n), rng.uniform(lo, hi, n)
+    else:
+        zx, zy = ones, ones
+    hflip = rng.random(n) < 0.5 if aug_args.get("horizontal_flip") else np.zeros(n, bool)
+    vflip = rng.random(n) < 0.5 if aug_args.get("vertical_flip") else np.zeros(n, bool)
+    br = aug_args.get("brightness_range")
+    brightness = rng.uniform(*_range(br, 1.0, 1.0), n) if br else ones
+
+    # Keras composes rotation @ shift @ shear @ zoom in (row, col) coordinates
+    def stack(rows):
+        m = np.zeros((n, 3, 3))
+        for i, row in enumerate(rows):
+            for j, v in enumerate(row):
+                m[:, i, j] = v
+        return m
+    c, s_ = np.cos(theta), np.sin(theta)
+    M = stack([[c, -s_, zeros], [s_, c, zeros], [zeros, zeros, ones]])
+    M = M @ stack([[ones, zeros, tx], [zeros, ones, ty], [zeros, zeros, ones]])
+    M = M @ stack([[ones, -np.sin(shear), zeros], [zeros, np.cos(shear), zeros], [zeros, zeros, ones]])
+    M = M @ stack([[zx, zeros, zeros], [zeros, zy, zeros], [zeros, zeros, ones]])
+    ox, oy = h / 2 - 0.5, w / 2 - 0.5
+    offset = np.array([[1, 0, ox], [0, 1, oy], [0, 0, 1]])
+    reset = np.array([[1, 0, -ox], [0, 1, -oy], [0, 0, 1]])
+    M = offset @ M @ reset
+
+    # Flips happen after the affine in Keras, so they compose on the output side
+    F = np.tile(np.eye(3), (n, 1, 1))
+    F[vflip, 0, 0], F[vflip, 0, 2] = -1, h - 1
+    F[hflip, 1, 1], F[hflip, 1, 2] = -1, w - 1
+    M = M @ F
+
+    # Swap (row, col) -> OpenCV (x, y)
+    P = np.array([[0, 1, 0], [1, 0, 0], [0, 0, 1]], dtype=float)
+    return (P @ M @ P)[:, :2, :].astype(np.float32), brightness
 
 def op_augment_ml_training(img: np.ndarray, aug_args: Dict[str, Any]) -> List[Tuple[np.ndarray, str]]:
     """
-    Random augmentations using ImageDataGenerator.
-    Converts BGR→RGB, scales if needed, then creates variants.
+    Random augmentations matching ImageDataGenerator's option set, without TensorFlow.
+    All variant parameters are sampled up front from one seeded generator
+    (aug_args["seed"]), then each variant is a single warpAffine plus brightness.
     """
-    img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-    params = {}
-    # Map front-end args to datagen params
-    for key in ["rotation_range", "zoom_range", "width_shift_range", "height_shift_range", "shear_range", "brightness_range"]:
-        if aug_args.get(key):
-            params[key] = aug_args[key]
-    for flip in ["horizontal_flip", "vertical_flip"]:
-        if aug_args.get(flip):
-            params[flip] = True
-    params["fill_mode"] = aug_args.get("fill_mode", "nearest")
-
-    if not params:
+    keys = ["rotation_range", "zoom_range", "width_shift_range", "height_shift_range",
+            "shear_range", "brightness_range", "horizontal_flip", "vertical_flip"]
+    if not any(aug_args.get(k) for k in keys):
         return [(img, "original")]
 
-    datagen = ImageDataGenerator(**params)
-    # Ensure data in 0–255 uint8
-    img_for_datagen = img_rgb.copy().astype("uint8")
-    batch = img_for_datagen.astype("float32")[None]
+    n = int(aug_args.get("num_variants", 6))
+    rng = np.random.default_rng(aug_args.get("seed"))
+    h, w = img.shape[:2]
+    mats, brightness = sample_augment_matrices((h, w), aug_args, n, rng)
+    border = _FILL_MODES.get(aug_args.get("fill_mode", "nearest"), cv2.BORDER_REPLICATE)
+    cval = float(aug_args.get("cval", 0))
 
     variants = []
-    for i in range(aug_args.get("num_variants", 6)):
+    for i in range(n):
         try:
-            aug = next(datagen.flow(batch, batch_size=1))[0].astype("uint8")
-            bgr = cv2.cvtColor(aug, cv2.COLOR_RGB2BGR)
-            desc = f"ml_aug_{i+1}"
-            variants.append((bgr, desc))
-        except:
+            aug = cv2.warpAffine(img, mats[i], (w, h),
+                                 flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP,
+                                 borderMode=border, borderValue=(cval, cval, cval))
+            if brightness[i] != 1.0:
+                aug = (cv2.convertScaleAbs(aug, alpha=float(brightness[i])) if aug.dtype == np.uint8
+                       else aug * np.float32(brightness[i]))
+            variants.append((aug, f"ml_aug_{i+1}"))
+        except Exception:
             continue
     return variants or [(img, "original")]
 
+# --- Compiled plans -------------------------------------------------------
+# A plan is compiled once into stages shared by apply_visual_plan and the preview
+# path. Consecutive geometric ops (resize, deterministic augment) collapse into a
+# single "affine" stage whose matrices are composed and applied with one warp.
+
+# Interpolations warpAffine supports; INTER_AREA only exists for cv2.resize.
+_WARP_INTERPS = {"INTER_NEAREST", "INTER_LINEAR", "INTER_CUBIC", "INTER_LANCZOS4"}
+
+def _is_geometric(step: Dict[str, Any]) -> bool:
+    op = step.get("op")
+    return op == "resize" or (op == "augment" and step.get("mode") != "ml_training")
+
+def _odd_ksize(k: Any) -> int:
+    # Blur kernels must be odd and positive
+    k = int(k)
+    return k + 1 if k % 2 == 0 else max(1, k)
+
+def compile_visual_plan(plan: Dict[str, Any]) -> List[Dict[str, Any]]:
+    stages: List[Dict[str, Any]] = []
+    for step in plan.get("ops", []):
+        op = step.get("op", "")
+        if _is_geometric(step):
+            if stages and stages[-1]["kind"] == "affine":
+                stages[-1]["steps"].append(step)
+            else:
+                stages.append({"kind": "affine", "steps": [step]})
+        elif op == "denoise":
+            stages.append({"kind": "denoise", "steps": [step],
+                           "method": step.get("method", "gaussian"),
+                           "ksize": _odd_ksize(step.get("ksize", 5))})
+        elif op == "normalize":
+            stages.append({"kind": "normalize", "steps": [step],
+                           "method": step.get("method", "minmax"),
+                           "stats": step_norm_stats(step)})
+        elif op == "augment":
+            stages.append({"kind": "augment", "steps": [step],
+                           "args": {k: v for k, v in step.items() if k != "op"}})
+        else:
+            stages.append({"kind": "unknown", "steps": [step]})
+    return stages
+
+def _step_affine(step: Dict[str, Any], w: int, h: int) -> Tuple[np.ndarray, int, int, bool]:
+    # Forward 3x3 matrix (input -> output pixel coords) for one geometric op, its
+    # output size, and whether it exposes out-of-image area (rotation/shift).
+    M = np.eye(3)
+    if step.get("op") == "resize":
+        W, H = int(step.get("width", 224)), int(step.get("height", 224))
+        sx, sy = W / w, H / h
+        M[0, 0], M[0, 2] = sx, 0.5 * sx - 0.5
+        M[1, 1], M[1, 2] = sy, 0.5 * sy - 0.5
+        return M, W, H, False
+
+    exposes = False
+    rot = step.get("rotation", 0)
+    if rot:
+        M = np.vstack([cv2.getRotationMatrix2D((w/2, h/2), rot, 1), [0, 0, 1]]) @ M
+        exposes = True
+    zoom = step.get("zoom", 1.0)
+    if zoom > 0 and zoom != 1.0:
+        # Same size/mapping as cv2.resize(fx=zoom, fy=zoom)
+        w, h = int(round(w * zoom)), int(round(h * zoom))
+        M = np.array([[zoom, 0, 0.5*zoom - 0.5], [0, zoom, 0.5*zoom - 0.5], [0, 0, 1]]) @ M
+    h_shift, v_shift = step.get("h_shift", 0), step.get("v_shift", 0)
+    if h_shift or v_shift:
+        M = np.array([[1, 0, h_shift*w], [0, 1, v_shift*h], [0, 0, 1]]) @ M
+        exposes = True
+    if step.get("h_flip"):
+        M = np.array([[-1, 0, w - 1], [0, 1, 0], [0, 0, 1]]) @ M
+    if step.get("v_flip"):
+        M = np.array([[1, 0, 0], [0, -1, h - 1], [0, 0, 1]]) @ M
+    return M, w, h, exposes
+
+def _apply_affine(img: np.ndarray, steps: List[Dict[str, Any]]) -> np.ndarray:
+    h, w = img.shape[:2]
+    M, W, H, exposes = np.eye(3), w, h, False
+    interp, shrink_interp = "INTER_LINEAR", "INTER_AREA"
+    for step in steps:
+        S, W, H, e = _step_affine(step, W, H)
+        M, exposes = S @ M, exposes or e
+        if step.get("op") == "resize":
+            interp = shrink_interp = step.get("interp", "INTER_AREA")
+
+    # Axis-aligned scale (+ flips) is exactly what cv2.resize does, and resize
+    # keeps INTER_AREA's anti-aliasing for downscales
+    sx, sy = M[0, 0], M[1, 1]
+    if (abs(M[0, 1]) < 1e-9 and abs(M[1, 0]) < 1e-9 and sx and sy
+            and abs(abs(sx) - W / w) < 1e-9 and abs(abs(sy) - H / h) < 1e-9):
+        ex = 0.5 * abs(sx) - 0.5 if sx > 0 else W - 0.5 - 0.5 * abs(sx)
+        ey = 0.5 * abs(sy) - 0.5 if sy > 0 else H - 0.5 - 0.5 * abs(sy)
+        if abs(M[0, 2] - ex) < 1e-6 and abs(M[1, 2] - ey) < 1e-6:
+            out = img if (W, H) == (w, h) else cv2.resize(
+                img, (W, H), interpolation=getattr(cv2, interp, cv2.INTER_AREA))
+            if sx < 0 and sy < 0:
+                return cv2.flip(out, -1)
+            if sx < 0:
+                return cv2.flip(out, 1)
+            if sy < 0:
+                return cv2.flip(out, 0)
+            return out
+
+    # A downscale folded into a rotated/shifted warp would be point-sampled and
+    # alias, so shrink with resize's area filter first and warp by the remainder
+    # (exactly resize-then-warp when the resize comes first in the plan)
+    px, py = (min(1.0, float(np.hypot(M[0, i], M[1, i]))) for i in (0, 1))
+    if px < 1 or py < 1:
+        pw, ph = max(1, int(round(w * px))), max(1, int(round(h * py)))
+        img = cv2.resize(img, (pw, ph), interpolation=getattr(cv2, shrink_interp, cv2.INTER_AREA))
+        fx, fy = pw / w, ph / h
+        P = np.array([[fx, 0, 0.5 * fx - 0.5], [0, fy, 0.5 * fy - 0.5], [0, 0, 1]])
+        M = M @ np.linalg.inv(P)
+
+    flags = getattr(cv2, interp) if interp in _WARP_INTERPS else cv2.INTER_LINEAR
+    border = cv2.BORDER_CONSTANT if exposes else cv2.BORDER_REPLICATE
+    return cv2.warpAffine(img, M[:2], (W, H), flags=flags, borderMode=border)
+
+# Pixels and bytes of an image, for the per-op metrics
+def _image_size(img: np.ndarray) -> Dict[str, int]:
+    return {"pixels": int(img.shape[0] * img.shape[1]), "bytes": int(img.nbytes)}
+
+def run_compiled_plan(img: np.ndarray, stages: List[Dict[str, Any]], variant: int=-1):
+    """
+    Execute compiled stages, yielding (stage, results, error) after each one.
+    `results` is a list of (image, description) - several for ML augmentation,
+    whose `variant`-th entry is carried into the next stage. On error the
+    stage is skipped and the image passes through unchanged. With
+    instrumentation on, each stage dict gets a "metrics" entry before it is yielded.
+    """
+    for stage in stages:
+        kind = stage["kind"]
+        meter = op_meter(_image_size, img)
+        try:
+            if kind == "affine":
+                img = _apply_affine(img, stage["steps"])
+                results = [(img, "deterministic")]
+            elif kind == "denoise":
+                img = op_denoise(img, stage["method"], stage["ksize"])
+                results = [(img, kind)]
+            elif kind == "normalize":
+                img = op_normalize(img, stage["method"], stage.get("stats"))
+                results = [(img, kind)]
+            elif kind == "augment":
+                results = op_augment(img, stage["args"])
+                img = results[variant][0]
+            else:
+                results = []
+            if meter:
+                stage["metrics"] = meter.stop(_image_size(img))
+            yield stage, results, None
+        except Exception as e:
+            if meter:
+                stage["metrics"] = meter.stop(_image_size(img))
+            yield stage, [], str(e)
+
+# Run the plan's ops on a decoded image in memory. Returns the files the plan
+# wants written as (filename, array) pairs, the per-step log and the final filename;
+# nothing touches the disk here so decode/compute/encode can run as separate stages.
+def _run_visual_ops(img: np.ndarray, plan: Dict[str, Any]) -> Tuple[List[Tuple[str, np.ndarray]], List[Dict[str, Any]], str]:
+    outputs, logs, final_fn = [], [], ""
+    last_stage_start = 0  # index into outputs where the latest producing stage began
+    for stage, results, err in run_compiled_plan(img, compile_visual_plan(plan)):
+        steps = stage["steps"]
+        n_before, metrics = len(logs), stage.pop("metrics", None)
+        if err is not None:
+            for step in steps:
+                logs.append({"op":step.get("op", ""), "status":"error", "error":err})
+            attach(logs, n_before, metrics)
+            continue
+        kind = stage["kind"]
+        if kind == "unknown":
+            logs.append({"op":steps[0].get("op", ""), "status":"skip", "reason":"unknown"})
+            continue
+        last_stage_start = len(outputs)
+        if kind == "augment":
+            for aug_img, desc in results:
+                fn = f"{uuid.uuid4().hex}_{desc}.png"
+                outputs.append((fn, aug_img))
+                logs.append({"op":f"augment_{desc}", "status":"ok", "output":fn})
+                final_fn = fn
+            attach(logs, n_before, metrics)
+            continue
+
+        # One output per stage; fused geometric ops share the last op's file
+        step = steps[-1]
+        op = step.get("op", "")
+        if op == "normalize" and step.get("method") == "zscore":
+            fn = f"{uuid.uuid4().hex}_normalize_zscore.npy"
+        elif op == "augment":
+            fn = f"{uuid.uuid4().hex}_deterministic.png"
+        else:
+            fn = f"{uuid.uuid4().hex}_{op}.png"
+        outputs.append((fn, results[0][0]))
+        fused = {"fused": len(steps)} if len(steps) > 1 else {}
+        for s_ in steps:
+            name = "augment_deterministic" if s_.get("op") == "augment" else s_.get("op", "")
+            entry = {"op":name, "status":"ok", **fused}
+            if s_ is step:
+                entry["output"] = fn
+            logs.append(entry)
+        attach(logs, n_before, metrics)
+        final_fn = fn
+
+    # save="final": keep only the last producing stage (all its ML variants)
+    if output_policy(plan)["save"] == "final":
+        keep = {fn for fn, _ in outputs[last_stage_start:]}
+        outputs = outputs[last_stage_start:]
+        for entry in logs:
+            if entry.get("output") not in keep:
+                entry.pop("output", None)
+    return outputs, logs, final_fn
+
+# Output policy from the plan's optional "output" block:
+#   save:       "all" (a file per step, the default) or "final" (final outputs only)
+#   format:     "files" (PNG / .npy per output) or "shards" (batch N x H x W x C arrays)
+#   shard_size: images per shard file (1.._MAX_SHARD_SIZE; larger is capped, since
+#               each shard is preallocated at full size)
+_MAX_SHARD_SIZE = 4096
+
+def output_policy(plan: Dict[str, Any]) -> Dict[str, Any]:
+    out = plan.get("output") or {}
+    shard_size = int(out.get("shard_size", 256))
+    if shard_size < 1:
+        raise ValueError(f"output.shard_size must be at least 1, got {shard_size}")
+    return {
+        "save": out.get("save", "all"),
+        "format": out.get("format", "files"),
+        "shard_size": min(shard_size, _MAX_SHARD_SIZE),
+    }
+
+class ShardWriter:
+    """
+    Packs same-shape outputs into fixed-size .npy shards (N x H x W x C) instead
+    of one image file each. Each shard is a preallocated memmap filled row by row;
+    a new shard starts when one fills up or the shape/dtype changes. close() writes
+    <prefix>_index.json mapping every output name to its (shard, row).
+    Safe to call add() from several encode threads.
+    """
+    def __init__(self, out_dir: str, shard_size: int=256, prefix: str="shard"):
+        self.out_dir, self.shard_size, self.prefix = out_dir, shard_size, prefix
+        self.shards: List[Dict[str, Any]] = []
+        self.entries: List[Dict[str, Any]] = []
+        self._open = {}  # (shape, dtype) -> [memmap, shard index, rows used]
+        self._lock = threading.Lock()
+
+    def add(self, source: str, name: str, arr: np.ndarray) -> None:
+        key = (arr.shape, arr.dtype.str)
+        with self._lock:
+            cur = self._open.get(key)
+            if cur is None or cur[2] == self.shard_size:
+                if cur is not None:
+                    self._finish(cur)
+                fn = f"{self.prefix}_{len(self.shards):05d}.npy"
+                mm = np.lib.format.open_memmap(os.path.join(self.out_dir, fn), mode="w+",
+                                               dtype=arr.dtype, shape=(self.shard_size,) + arr.shape)
+                self.shards.append({"file": fn, "shape": None, "dtype": arr.dtype.name})
+                cur = self._open[key] = [mm, len(self.shards) - 1, 0]
+            mm, shard, row = cur
+            cur[2] += 1
+        mm[row] = arr  # rows are reserved under the lock, copies run in parallel
+        with self._lock:
+            self.entries.append({"source": source, "output": name, "shard": shard, "row": row})
+
+    def _finish(self, cur) -> None:
+        mm, shard, rows = cur
+        cur[0] = None  # the open-shard entry must not keep the mapping alive
+        mm.flush()
+        info = self.shards[shard]
+        info["shape"] = [rows] + list(mm.shape[1:])
+        if rows < self.shard_size:
+            # Trim the partially filled shard (at most one per shape) into a new
+            # file, then swap it in once the mapping of the old one is gone
+            path = os.path.join(self.out_dir, info["file"])
+            tmp = path[:-len(".npy")] + ".trim.npy"
+            np.save(tmp, mm[:rows])
+            del mm
+            os.replace(tmp, path)
+
+    def close(self) -> str:
+        with self._lock:
+            for cur in self._open.values():
+                self._finish(cur)
+            self._open = {}
+            index_path = os.path.join(self.out_dir, f"{self.prefix}_index.json")
+            with open(index_path, "w") as f:
+                json.dump({"shards": self.shards,
+                           "entries": sorted(self.entries, key=lambda e: (e["shard"], e["row"]))}, f)
+        return index_path
+
+# --- Dataset-global normalization -------------------------------------------
+# Pass 1 streams the batch on a thread pool, running each image through the ops
+# that precede normalize and merging per-channel count/mean/M2/min/max. The stats
+# are saved as a JSON artifact and pass 2 applies them with op_normalize(stats=...).
+
+def _ops_before_normalize(plan: Dict[str, Any]) -> List[Dict[str, Any]]:
+    ops = []
+    for step in plan.get("ops", []):
+        if step.get("op") == "normalize":
+            break
+        # Random ML variants don't change the statistics enough to be worth computing
+        if step.get("op") == "augment" and step.get("mode") == "ml_training":
+            continue
+        ops.append(step)
+    return ops
+
+def _run_prefix(img: np.ndarray, ops: List[Dict[str, Any]]) -> np.ndarray:
+    for _, results, _ in run_compiled_plan(img, compile_visual_plan({"ops": ops})):
+        if results:
+            img = results[-1][0]
+    return img
+
+def _channel_stats(img: np.ndarray) -> Dict[str, Any]:
+    c = 1 if img.ndim == 2 else img.shape[2]
+    flat = img.reshape(-1, c)
+    mean, std = cv2.meanStdDev(img)
+    n = flat.shape[0]
+    return {"n": n, "mean": mean.ravel()[:c].astype(float), "m2": (std.ravel()[:c] ** 2) * n,
+            "min": flat.min(0).astype(float), "max": flat.max(0).astype(float), "images": 1}
+
+def _merge_channel_stats(a: Dict[str, Any], b: Dict[str, Any]) -> Dict[str, Any]:
+    if a is None:
+        return b
+    n = a["n"] + b["n"]
+    delta = b["mean"] - a["mean"]
+    return {"n": n, "mean": a["mean"] + delta * b["n"] / n,
+            "m2": a["m2"] + b["m2"] + delta ** 2 * a["n"] * b["n"] / n,
+            "min": np.minimum(a["min"], b["min"]), "max": np.maximum(a["max"], b["max"]),
+            "images": a["images"] + b["images"]}
+
+def compute_dataset_norm_stats(paths: List[str], plan: Dict[str, Any]=None,
+                               workers: int=None) -> Dict[str, Any]:
+    prefix = _ops_before_normalize(plan or {})
+
+    def one(path):
+        img = cv2.imread(path)
+        return None if img is None else _channel_stats(_run_prefix(img, prefix))
+
+    acc = None
+    with ThreadPoolExecutor(workers or min(32, os.cpu_count() or 4)) as ex:
+        for part in ex.map(one, paths):
+            if part is not None:
+                acc = _merge_channel_stats(acc, part)
+    if acc is None:
+        raise ValueError("No readable images to compute normalization stats.")
+    return {
+        "scope": "dataset",
+        "images": acc["images"],
+        "pixels": int(acc["n"]),
+        "mean": acc["mean"].tolist(),
+        "std": np.sqrt(acc["m2"] / acc["n"]).tolist(),
+        "min": acc["min"].tolist(),
+        "max": acc["max"].tolist(),
+    }
+
+def save_norm_stats(stats: Dict[str, Any], path: str) -> str:
+    with open(path, "w") as f:
+        json.dump(stats, f, indent=2)
+    return path
+
+def load_norm_stats(path: str) -> Dict[str, Any]:
+    with open(path) as f:
+        return json.load(f)
+
+# Plans name saved stats with "stats_path", which is a file name inside the
+# server's PRISM_NORM_STATS_DIR (default norm_stats), never a filesystem path.
+def norm_stats_dir() -> str:
+    return os.environ.get("PRISM_NORM_STATS_DIR", "norm_stats")
+
+def resolve_stats_path(name: str) -> str:
+    root = os.path.realpath(norm_stats_dir())
+    path = os.path.realpath(os.path.join(root, str(name)))
+    if os.path.dirname(path) != root:
+        raise ValueError(f"stats_path must name a file in {norm_stats_dir()}")
+    return path
+
+# The stats a normalize step applies: inline "stats", else its named stats file
+def step_norm_stats(step: Dict[str, Any]) -> Any:
+    stats = step.get("stats")
+    if stats is None and step.get("stats_path"):
+        stats = load_norm_stats(resolve_stats_path(step["stats_path"]))
+    return stats
+
+# Resolve the stats of every normalize step once for the whole batch: named
+# stats files are loaded, and scope="dataset" steps with none are computed. New
+# dataset stats go to <out_dir>/norm_stats.json and, for reuse by later plans,
+# to the stats dir as <digest>.json (recorded as the step's stats_path).
+def prepare_dataset_normalize(paths: List[str], plan: Dict[str, Any], out_dir: str,
+                              workers: int=None) -> Dict[str, Any]:
+    ops = []
+    for s in plan.get("ops", []):
+        if s.get("op") == "normalize" and s.get("stats") is None and s.get("stats_path"):
+            s = dict(s, stats=step_norm_stats(s))
+        ops.append(s)
+    pending = [s for s in ops
+               if s.get("op") == "normalize" and s.get("scope") == "dataset" and s.get("stats") is None]
+    if pending:
+        stats = compute_dataset_norm_stats(paths, plan, workers)
+        save_norm_stats(stats, os.path.join(out_dir, "norm_stats.json"))
+        os.makedirs(norm_stats_dir(), exist_ok=True)
+        name = f"{json_digest(stats)}.json"
+        save_norm_stats(stats, os.path.join(norm_stats_dir(), name))
+        ops = [dict(s, stats=stats, stats_path=name) if any(s is p for p in pending) else s
+               for s in ops]
+    return dict(plan, ops=ops)
+
+# --- Near-duplicate index ----------------------------------------------------
+# 64-bit perceptual hashes computed for the whole batch with array ops, then a
+# BK-tree over Hamming distance finds every earlier image within `threshold`
+# bits. Greedy leader clustering: the first image of a cluster is kept.
+
+def _hash_thumb(path: str, size: Tuple[int, int]) -> Any:
+    # A 1/8-scale grayscale decode is plenty for a 9x8 or 32x32 thumbnail
+    img = cv2.imread(path, cv2.IMREAD_REDUCED_GRAYSCALE_8)
+    if img is None or min(img.shape) < max(size):
+        img = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+    if img is None:
+        return None
+    return cv2.resize(img, size, interpolation=cv2.INTER_AREA).astype(np.float32)
+
+def _dct_matrix(n: int) -> np.ndarray:
+    k = np.arange(n)
+    m = np.cos(np.pi * (2 * k[None, :] + 1) * k[:, None] / (2 * n)) * np.sqrt(2 / n)
+    m[0] /= np.sqrt(2)
+    return m.astype(np.float32)
+
+def _pack_bits(bits: np.ndarray) -> List[int]:
+    # (N, 64) bools -> python ints, most significant bit first
+    packed = np.packbits(bits.reshape(len(bits), -1), axis=1)
+    return [int.from_bytes(row.tobytes(), "big") for row in packed]
+
+def perceptual_hashes(paths: List[str], method: str="dhash", workers: int=None) -> List[Any]:
+    """
+    dHash: sign of horizontal gradients on a 9x8 thumbnail.
+    pHash: sign vs median of the low 8x8 DCT block of a 32x32 thumbnail.
+    Returns one int per path (None if unreadable).
+    """
+    size = (9, 8) if method == "dhash" else (32, 32)
+    with ThreadPoolExecutor(workers or min(32, os.cpu_count() or 4)) as ex:
+        thumbs = list(ex.map(lambda p: _hash_thumb(p, size), paths))
+    ok = [i for i, t in enumerate(thumbs) if t is not None]
+    hashes: List[Any] = [None] * len(paths)
+    if not ok:
+        return hashes
+    stack = np.stack([thumbs[i] for i in ok])
+    if method == "dhash":
+        bits = stack[:, :, 1:] > stack[:, :, :-1]
+    else:
+        D = _dct_matrix(32)
+        low = np.einsum("ij,njk,lk->nil", D, stack, D)[:, :8, :8].reshape(len(ok), 64)
+        med = np.median(low[:, 1:], axis=1, keepdims=True)  # DC term skews the median
+        bits = low > med
+    for i, h in zip(ok, _pack_bits(bits)):
+        hashes[i] = h
+    return hashes
+
+class BKTree:
+    """Burkhard-Keller tree over Hamming distance for radius queries on int hashes."""
+    def __init__(self):
+        self.root = None  # [hash, item, {distance: child}]
+
+    def add(self, h: int, item: Any) -> None:
+        if self.root is None:
+            self.root = [h, item, {}]
+            return
+        node = self.root
+        while True:
+            d = (h ^ node[0]).bit_count()
+            child = node[2].get(d)
+            if child is None:
+                node[2][d] = [h, item, {}]
+                return
+            node = child
+
+    def query(self, h: int, radius: int) -> List[Tuple[int, Any]]:
+        found, stack = [], [self.root] if self.root else []
+        while stack:
+            node = stack.pop()
+            d = (h ^ node[0]).bit_count()
+            if d <= radius:
+                found.append((d, node[1]))
+            for cd, child in node[2].items():
+                if d - radius <= cd <= d + radius:
+                    stack.append(child)
+        return sorted(found, key=lambda x: x[0])
+
+def find_near_duplicates(paths: List[str], method: str="dhash", threshold: int=5,
+                         workers: int=None) -> Dict[str, Any]:
+    hashes = perceptual_hashes(paths, method, workers)
+    tree = BKTree()
+    duplicate_of: Dict[int, int] = {}
+    clusters: Dict[int, List[Tuple[int, int]]] = {}
+    for i, h in enumerate(hashes):
+        if h is None:
+            continue
+        hits = tree.query(h, threshold)
+        if hits:
+            d, rep = hits[0]
+            duplicate_of[i] = rep
+            clusters[rep].append((i, d))
+        else:
+            tree.add(h, i)
+            clusters[i] = []
+    return {
+        "method": method,
+        "threshold": threshold,
+        "hashes": [f"{h:016x}" if h is not None else None for h in hashes],
+        "duplicate_of": duplicate_of,
+        # Only clusters that actually contain duplicates
+        "clusters": [
+            {"keep": os.path.basename(paths[rep]),
+             "duplicates": [{"file": os.path.basename(paths[i]), "distance": d} for i, d in members]}
+            for rep, members in clusters.items() if members
+        ],
+    }
+
+# Write queued outputs: .npy keeps float arrays, everything else becomes a uint8 PNG.
+def _write_outputs(out_dir: str, outputs: List[Tuple[str, np.ndarray]]) -> None:
+    for fn, arr in outputs:
+        if fn.endswith(".npy"):
+            np.save(os.path.join(out_dir, fn), arr)
+        else:
+            save_img = arr.clip(0,255).astype("uint8") if arr.dtype != np.uint8 else arr
+            cv2.imwrite(os.path.join(out_dir, fn), save_img)
+
 # Execute the plan: save images or .npy for floats, log each step.
+# Honours output.save="final"; sharded output is a batch feature (apply_visual_plan_batch).
+# Very large images run tiled (see wants_tiled), which writes the final output only.
 def apply_visual_plan(path: str, plan: Dict[str, Any], out_dir: str) -> Tuple[str, List[Dict[str, Any]]]:
     os.makedirs(out_dir, exist_ok=True)
+    if wants_tiled(plan, path):
+        return _run_tiled(path, plan, out_dir)
     img = cv2.imread(path)
     if img is None:
         return "", [{"op": "load", "status": "error", "error": "Could not read image"}]
-    logs, final_fn = [], ""
-    for step in plan.get("ops", []):
-        op = step.get("op", "")
-        try:
-            if op == "resize":
-                img = op_resize(img, step["width"], step["height"], step.get("interp","INTER_AREA"))
-            elif op == "denoise":
-                img = op_denoise(img, step.get("method","gaussian"), step.get("ksize",5))
-            elif op == "normalize":
-                img = op_normalize(img, step.get("method","minmax"))
-            elif op == "augment":
-                aug_params = {k:v for k,v in step.items() if k!="op"}
-                results = op_augment(img, aug_params)
-                for aug_img, desc in results:
-                    fn = f"{uuid.uuid4().hex}_{desc}.png"
-                    cv2.imwrite(os.path.join(out_dir, fn), aug_img)
-                    logs.append({"op":f"{op}_{desc}", "status":"ok", "output":fn})
-                    final_fn = fn
-                img = results[-1][0]  # continue with last variant
-                continue
-            else:
-                logs.append({"op":op, "status":"skip", "reason":"unknown"})
+    outputs, logs, final_fn = _run_visual_ops(img, plan)
+    _write_outputs(out_dir, outputs)
+    return final_fn, logs
+
+# --- Tiled execution for very large images ------------------------------------
+# Each tile-safe op is one pass from a memory-mapped source to a memory-mapped
+# destination, one output tile at a time, so the working set is a tile plus its
+# halo regardless of image size. Source .npy files are mapped directly; other
+# formats are decoded once into a scratch .npy first (OpenCV cannot decode a
+# region), which is the only step whose memory grows with the image.
+
+_TILE_SAFE_OPS = ("resize", "denoise", "normalize")
+_WARP_INTERPS = ("INTER_LINEAR", "INTER_CUBIC", "INTER_LANCZOS4")
+
+def _tiles(h: int, w: int, tile: int, tile_w: int=None):
+    tile_w = tile_w or tile
+    for y in range(0, h, tile):
+        for x in range(0, w, tile_w):
+            yield y, min(y + tile, h), x, min(x + tile_w, w)
+
+def _scratch_memmap(scratch: str, shape: Tuple[int, ...], dtype: Any) -> np.ndarray:
+    fn = os.path.join(scratch, f"{uuid.uuid4().hex}.npy")
+    return np.lib.format.open_memmap(fn, mode="w+", dtype=dtype, shape=shape)
+
+def _area_axis(a: np.ndarray, axis: int, lo: float, f: float, n: int) -> np.ndarray:
+    # Mean of `a` over [lo + j*f, lo + (j+1)*f) along `axis` for j < n, partly
+    # covered edge pixels weighted by their overlap (INTER_AREA's downscale rule)
+    a = np.moveaxis(np.asarray(a, dtype=np.float64), axis, 0)
+    csum = np.concatenate([np.zeros((1,) + a.shape[1:]), np.cumsum(a, axis=0)])
+    edges = lo + np.arange(n + 1) * f
+    i = np.minimum(np.floor(edges).astype(int), len(a) - 1)
+    at = csum[i] + (edges - i).reshape((-1,) + (1,) * (a.ndim - 1)) * a[i]
+    return np.moveaxis((at[1:] - at[:-1]) / f, 0, axis)
+
+def _tiled_resize(src: np.ndarray, dst: np.ndarray, tile: int, interp: str) -> None:
+    h, w = src.shape[:2]
+    H, W = dst.shape[:2]
+    fx, fy = w / W, h / H  # source pixels per output pixel
+    aligned = fx == int(fx) and fy == int(fy) and fx >= 1 and fy >= 1
+    area = interp == "INTER_AREA" and fx >= 1 and fy >= 1
+    # Size output tiles so each reads about a tile of source
+    ty, tx = max(1, min(tile, int(tile / max(fy, 1)))), max(1, min(tile, int(tile / max(fx, 1))))
+    for y0, y1, x0, x1 in _tiles(H, W, ty, tx):
+        if aligned:
+            # Integer downscale: tile edges land on source pixels, so the tile
+            # resize is exactly the global one (including INTER_AREA averaging)
+            region = np.asarray(src[y0*h//H:y1*h//H, x0*w//W:x1*w//W])
+            dst[y0:y1, x0:x1] = cv2.resize(region, (x1 - x0, y1 - y0),
+                                           interpolation=getattr(cv2, interp, cv2.INTER_AREA))
+            continue
+        if area:
+            # Fractional downscale: average over the exact source span of the tile;
+            # the pixels it only partly covers at each edge are the halo
+            sy0, sy1 = y0 * h // H, min(h, -(-y1 * h // H))
+            sx0, sx1 = x0 * w // W, min(w, -(-x1 * w // W))
+            region = np.asarray(src[sy0:sy1, sx0:sx1])
+            out = _area_axis(region, 1, x0 * fx - sx0, fx, x1 - x0)
+            out = _area_axis(out, 0, y0 * fy - sy0, fy, y1 - y0)
+            if np.issubdtype(dst.dtype, np.integer):
+                info = np.iinfo(dst.dtype)
+                out = np.clip(np.rint(out), info.min, info.max)
+            dst[y0:y1, x0:x1] = out.astype(dst.dtype)
+            continue
+        if interp == "INTER_NEAREST":
+            # Same pick as resize: source pixel floor(x / (W / w))
+            ys = np.minimum(np.floor(np.arange(y0, y1) * (1 / (H / h))).astype(int), h - 1)
+            xs = np.minimum(np.floor(np.arange(x0, x1) * (1 / (W / w))).astype(int), w - 1)
+            region = np.asarray(src[ys[0]:ys[-1] + 1, xs[0]:xs[-1] + 1])
+            dst[y0:y1, x0:x1] = region[ys - ys[0]][:, xs - xs[0]]
+            continue
+        # Interpolating resize: sample from the source window plus a 4px halo
+        # (enough for Lanczos), with the global mapping shifted into the window.
+        # An INTER_AREA upscale is done bilinearly here (OpenCV uses a slightly
+        # sharper kernel for it, within a few grey levels).
+        sy0 = max(0, int(np.floor((y0 + 0.5) * fy - 0.5)) - 4)
+        sy1 = min(h, int(np.ceil((y1 + 0.5) * fy - 0.5)) + 5)
+        sx0 = max(0, int(np.floor((x0 + 0.5) * fx - 0.5)) - 4)
+        sx1 = min(w, int(np.ceil((x1 + 0.5) * fx - 0.5)) + 5)
+        region = np.asarray(src[sy0:sy1, sx0:sx1])
+        M = np.float32([[fx, 0, (x0 + 0.5) * fx - 0.5 - sx0],
+                        [0, fy, (y0 + 0.5) * fy - 0.5 - sy0]])
+        flag = getattr(cv2, interp) if interp in _WARP_INTERPS else cv2.INTER_LINEAR
+        dst[y0:y1, x0:x1] = cv2.warpAffine(region, M, (x1 - x0, y1 - y0),
+                                           flags=flag | cv2.WARP_INVERSE_MAP,
+                                           borderMode=cv2.BORDER_REPLICATE)
+
+def _tiled_filter(src: np.ndarray, dst: np.ndarray, tile: int, halo: int, fn) -> None:
+    # Filter each tile with `halo` extra pixels of context and keep the centre;
+    # at the image edge the window is clipped and OpenCV's own border applies,
+    # exactly as it would for the whole image
+    h, w = src.shape[:2]
+    for y0, y1, x0, x1 in _tiles(h, w, tile):
+        sy0, sx0 = max(0, y0 - halo), max(0, x0 - halo)
+        region = np.asarray(src[sy0:min(h, y1 + halo), sx0:min(w, x1 + halo)])
+        dst[y0:y1, x0:x1] = fn(region)[y0 - sy0:y1 - sy0, x0 - sx0:x1 - sx0]
+
+def _tiled_stats(src: np.ndarray, tile: int) -> Dict[str, Any]:
+    acc = None
+    h, w = src.shape[:2]
+    for y0, y1, x0, x1 in _tiles(h, w, tile):
+        acc = _merge_channel_stats(acc, _channel_stats(np.asarray(src[y0:y1, x0:x1])))
+    return acc
+
+def _pooled_norm_stats(acc: Dict[str, Any]) -> Dict[str, Any]:
+    # Per-image normalize uses one mean/std/min/max over all channels; pool the
+    # per-channel accumulators into that and repeat it for every channel
+    c = len(acc["mean"])
+    mean = float(acc["mean"].mean())
+    m2 = float(acc["m2"].sum() + (acc["n"] * (acc["mean"] - mean) ** 2).sum())
+    std = (m2 / (acc["n"] * c)) ** 0.5
+    return {"mean": [mean] * c, "std": [std] * c,
+            "min": [float(acc["min"].min())] * c, "max": [float(acc["max"].max())] * c}
+
+def _tiled_write_image(cur: np.ndarray, out_path: str, tile: int, scratch: str,
+                       stretch: bool=False) -> None:
+    # Convert to uint8 tile by tile into a scratch memmap and encode from that;
+    # OpenCV's encoders read the rows straight from the mapping. stretch=True
+    # maps min..max to 0..255 (as the preview does for zscore output) instead of clipping.
+    if cur.dtype == np.uint8:
+        save = cur
+    else:
+        h, w = cur.shape[:2]
+        lo, scale = 0.0, 1.0
+        if stretch:
+            acc = _tiled_stats(cur, tile)
+            lo, hi = float(acc["min"].min()), float(acc["max"].max())
+            scale = 255 / (hi - lo if hi > lo else 1)
+        save = _scratch_memmap(scratch, cur.shape, np.uint8)
+        for y0, y1, x0, x1 in _tiles(h, w, tile):
+            part = (np.asarray(cur[y0:y1, x0:x1], dtype=np.float32) - lo) * scale
+            save[y0:y1, x0:x1] = np.clip(part, 0, 255)
+        save.flush()
+    if not cv2.imwrite(out_path, save):
+        raise ValueError(f"Could not encode {os.path.basename(out_path)}")
+
+def apply_visual_plan_tiled(path: str, plan: Dict[str, Any], out_path: str,
+                            tile: int=1024, scratch_dir: str=None,
+                            stretch: bool=False) -> Tuple[str, List[Dict[str, Any]]]:
+    """
+    Run a plan made of tile-safe ops (resize, denoise, normalize) over a very large
+    image in tiles. out_path ending in .npy is written as a memmap; an image
+    extension is encoded from the final memmap (see _tiled_write_image for
+    `stretch`). Other ops are logged as skipped.
+    """
+    scratch = tempfile.mkdtemp(prefix="tiles_", dir=scratch_dir)
+    logs: List[Dict[str, Any]] = []
+    try:
+        if path.lower().endswith(".npy"):
+            cur = np.load(path, mmap_mode="r")
+        else:
+            img = cv2.imread(path)
+            if img is None:
+                return "", [{"op": "load", "status": "error", "error": "Could not read image"}]
+            cur = _scratch_memmap(scratch, img.shape, img.dtype)
+            cur[...] = img
+            del img
+
+        for step in plan.get("ops", []):
+            op = step.get("op", "")
+            if op not in _TILE_SAFE_OPS:
+                logs.append({"op": op, "status": "skip", "reason": "not tile-safe"})
                 continue
+            meter, n_before = op_meter(_image_size, cur), len(logs)
+            try:
+                h, w = cur.shape[:2]
+                if op == "resize":
+                    W, H = int(step["width"]), int(step["height"])
+                    dst = _scratch_memmap(scratch, (H, W) + cur.shape[2:], cur.dtype)
+                    _tiled_resize(cur, dst, tile, step.get("interp", "INTER_AREA"))
+                elif op == "denoise":
+                    method, k = step.get("method", "gaussian"), _odd_ksize(step.get("ksize", 5))
+                    dst = _scratch_memmap(scratch, cur.shape, cur.dtype)
+                    _tiled_filter(cur, dst, tile, k // 2 + 1, lambda r: op_denoise(r, method, k))
+                else:
+                    method = step.get("method", "minmax")
+                    stats = step_norm_stats(step)
+                    if stats is None:
+                        stats = _pooled_norm_stats(_tiled_stats(cur, tile))
+                    dtype = np.float32 if method == "zscore" else np.uint8
+                    dst = _scratch_memmap(scratch, cur.shape, dtype)
+                    _tiled_filter(cur, dst, tile, 0, lambda r: op_normalize(r, method, stats))
+                dst.flush()
+                cur = dst
+                logs.append({"op": op, "status": "ok",
+                             "tiles": len(list(_tiles(*cur.shape[:2], tile)))})
+            except Exception as e:
+                logs.append({"op": op, "status": "error", "error": str(e)})
+            if meter:
+                attach(logs, n_before, meter.stop(_image_size(cur)))
+
+        if out_path.lower().endswith(".npy"):
+            out = np.lib.format.open_memmap(out_path, mode="w+", dtype=cur.dtype, shape=cur.shape)
+            h, w = cur.shape[:2]
+            for y0, y1, x0, x1 in _tiles(h, w, tile):
+                out[y0:y1, x0:x1] = cur[y0:y1, x0:x1]
+            out.flush()
+            del out
+        else:
+            _tiled_write_image(cur, out_path, tile, scratch, stretch)
+        del cur
+        return os.path.basename(out_path), logs
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+# Plans choose the execution mode with an optional "tiled" key: true always tiles
+# (ops that are not tile-safe are skipped), false never does, and the default
+# "auto" tiles images of at least PRISM_TILED_MIN_PIXELS pixels (100M) when every
+# op is tile-safe. "tile_size" sets the tile edge (1024).
+def _pixel_count(src: Any) -> int:
+    try:
+        if isinstance(src, str) and src.lower().endswith(".npy"):
+            shape = np.load(src, mmap_mode="r").shape
+            return int(shape[0] * shape[1])
+        with Image.open(src) as im:  # reads the header only
+            return im.width * im.height
+    except Image.DecompressionBombError:
+        return 2 ** 62  # past Pillow's own limit, so certainly large
+    except Exception:
+        return 0
+
+def wants_tiled(plan: Dict[str, Any], src: Any) -> bool:
+    mode = plan.get("tiled", "auto")
+    if mode != "auto":
+        return bool(mode)
+    ops = plan.get("ops", [])
+    if not ops or any(s.get("op") not in _TILE_SAFE_OPS for s in ops):
+        return False
+    return _pixel_count(src) >= int(os.environ.get("PRISM_TILED_MIN_PIXELS", 100_000_000))
+
+# apply_visual_plan's tiled path: one final output named like the in-memory one
+def _run_tiled(path: str, plan: Dict[str, Any], out_dir: str) -> Tuple[str, List[Dict[str, Any]]]:
+    safe = [s for s in plan.get("ops", []) if s.get("op") in _TILE_SAFE_OPS]
+    last = safe[-1] if safe else {}
+    if last.get("op") == "normalize" and last.get("method") == "zscore":
+        fn = f"{uuid.uuid4().hex}_normalize_zscore.npy"
+    else:
+        fn = f"{uuid.uuid4().hex}_{last.get('op', 'load')}.png"
+    final_fn, logs = apply_visual_plan_tiled(path, plan, os.path.join(out_dir, fn),
+                                             int(plan.get("tile_size", 1024)), out_dir)
+    for entry in reversed(logs):
+        if entry.get("status") == "ok":
+            entry["output"] = final_fn
+            break
+    return final_fn, logs
+
+# --- Streaming augmentation loader ----------------------------------------------
+# Training jobs can consume ML augmentation directly instead of materialising
+# num_variants PNGs per image: AugmentedImageLoader runs the plan on worker
+# processes and yields ready batches, with every random draw seeded from
+# (seed, epoch, image index, stage) so an epoch replays exactly.
 
-            # Save result file
-            if op == "normalize" and step.get("method") == "zscore":
-                fn = f"{uuid.uuid4().hex}_normalize_zscore.npy"
-                np.save(os.path.join(out_dir, fn), img)
+def _expand_variants(img: np.ndarray, stages: List[Dict[str, Any]]) -> List[np.ndarray]:
+    # Like run_compiled_plan, but every ML variant continues through the stages
+    # after the augment, so all of them come out fully processed
+    for i, stage in enumerate(stages):
+        if stage["kind"] == "augment":
+            out: List[np.ndarray] = []
+            for variant, _ in op_augment(img, stage["args"]):
+                out.extend(_expand_variants(variant, stages[i + 1:]))
+            return out
+        for _, results, _ in run_compiled_plan(img, [stage]):
+            if results:
+                img = results[-1][0]
+    return [img]
+
+def _load_augmented_batch(task: Tuple[List[Tuple[int, str]], Dict[str, Any], int, int, Any]) -> Tuple[List[np.ndarray], List[str]]:
+    items, plan, seed, epoch, variants = task
+    images, sources = [], []
+    for idx, path in items:
+        img = cv2.imread(path)
+        if img is None:
+            continue
+        stages = compile_visual_plan(plan)
+        for k, stage in enumerate(stages):
+            if stage["kind"] == "augment" and stage["args"].get("mode") == "ml_training":
+                ss = np.random.SeedSequence([seed, epoch, idx, k])
+                stage["args"] = dict(stage["args"], seed=int(ss.generate_state(1)[0]))
+                if variants is not None:
+                    stage["args"]["num_variants"] = variants
+        for out in _expand_variants(img, stages):
+            images.append(out)
+            sources.append(os.path.basename(path))
+    return images, sources
+
+class AugmentedImageLoader:
+    """
+    Iterable over (batch, sources) for one epoch at a time.
+    batch is an N x H x W x C array when every output has the same shape (plans
+    normally start with a resize), otherwise a list of arrays; sources names
+    the input file of each row. Each source image contributes
+    `variants_per_image` augmented rows (default 1, overriding num_variants).
+    Batches are built on `num_workers` processes (0 = in-process) with up to
+    `prefetch` batches per worker queued ahead. Call set_epoch() between epochs
+    to get new, reproducible draws.
+    """
+    def __init__(self, paths: List[str], plan: Dict[str, Any], batch_size: int=32,
+                 num_workers: int=None, prefetch: int=2, shuffle: bool=True,
+                 seed: int=0, variants_per_image: Any=1):
+        self.paths, self.plan = list(paths), plan
+        self.batch_size, self.prefetch, self.shuffle = batch_size, prefetch, shuffle
+        self.num_workers = min(4, os.cpu_count() or 1) if num_workers is None else num_workers
+        self.seed, self.variants, self.epoch = seed, variants_per_image, 0
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    def __len__(self) -> int:
+        return -(-len(self.paths) // self.batch_size)
+
+    def _tasks(self):
+        order = np.arange(len(self.paths))
+        if self.shuffle:
+            order = np.random.default_rng([self.seed, self.epoch]).permutation(order)
+        for i in range(0, len(order), self.batch_size):
+            items = [(int(j), self.paths[j]) for j in order[i:i + self.batch_size]]
+            yield (items, self.plan, self.seed, self.epoch, self.variants)
+
+    @staticmethod
+    def _collate(images: List[np.ndarray]) -> Any:
+        if images and all(im.shape == images[0].shape and im.dtype == images[0].dtype for im in images):
+            return np.stack(images)
+        return images
+
+    def __iter__(self):
+        if self.num_workers == 0:
+            for task in self._tasks():
+                images, sources = _load_augmented_batch(task)
+                yield self._collate(images), sources
+            return
+
+        with ProcessPoolExecutor(max_workers=self.num_workers) as ex:
+            tasks = self._tasks()
+            pending = deque()
+            for task in tasks:
+                pending.append(ex.submit(_load_augmented_batch, task))
+                if len(pending) >= self.num_workers * self.prefetch:
+                    break
+            while pending:
+                images, sources = pending.popleft().result()
+                nxt = next(tasks, None)
+                if nxt is not None:
+                    pending.append(ex.submit(_load_augmented_batch, nxt))
+                yield self._collate(images), sources
+
+# Batch executor: run the plan over many files with decode, compute and encode as
+# overlapping thread-pool stages (OpenCV releases the GIL inside imread/ops/imwrite).
+# At most `max_in_flight` decoded images exist at once; a slot is taken before
+# decode and given back once the image's outputs are written.
+# With output.format="shards" the outputs go into ShardWriter shards instead of
+# PNG/.npy files and the log "output" names are keys into the shard index.
+# With file output, images that wants_tiled() picks run tiled on the compute pool.
+# Returns per-file (final_fn, logs) in input order plus throughput stats.
+def apply_visual_plan_batch(paths: List[str],
+                            plan: Dict[str, Any],
+                            out_dir: str,
+                            workers: int=None,
+                            max_in_flight: int=None,
+                            on_result: Callable[[int, str, List[Dict[str, Any]], float], None]=None,
+                            cancel: threading.Event=None,
+                            names: List[str]=None) -> Tuple[List[Tuple[str, List[Dict[str, Any]]]], Dict[str, Any]]:
+    """
+    on_result(index, final_fn, logs, seconds) is called from a pool thread as each
+    image finishes (or fails / is skipped). Setting `cancel` stops feeding new
+    images; ones already in flight complete and the rest are logged as cancelled.
+    `names` are the inputs' original file names, recorded as shard index sources
+    and in dedupe logs (default: the paths' basenames).
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    names = names or [os.path.basename(p) for p in paths]
+    workers = workers or min(32, os.cpu_count() or 4)
+    max_in_flight = max_in_flight or 2 * workers
+    # Optional near-duplicate pass: plan["dedupe"] = {"method", "threshold", "action"}
+    dedupe = plan.get("dedupe")
+    dup_report, skip = None, {}
+    if dedupe:
+        opts = dedupe if isinstance(dedupe, dict) else {}
+        dup_report = find_near_duplicates(paths, opts.get("method", "dhash"),
+                                          int(opts.get("threshold", 5)), workers)
+        if opts.get("action", "skip") == "skip":
+            skip = dup_report["duplicate_of"]
+    plan = prepare_dataset_normalize([p for i, p in enumerate(paths) if i not in skip],
+                                     plan, out_dir, workers)
+    policy = output_policy(plan)
+    shards = ShardWriter(out_dir, policy["shard_size"]) if policy["format"] == "shards" else None
+    slots = threading.BoundedSemaphore(max_in_flight)
+    busy = {"decode": 0.0, "compute": 0.0, "encode": 0.0}
+    failed, cancelled = [], []
+    lock = threading.Lock()
+    results: List[Tuple[str, List[Dict[str, Any]]]] = [("", [])] * len(paths)
+    started: Dict[int, float] = {}
+
+    def done(i, final_fn, logs):
+        results[i] = (final_fn, logs)
+        if on_result is not None:
+            on_result(i, final_fn, logs, time.perf_counter() - started.get(i, time.perf_counter()))
+
+    def timed(stage, fn, *args):
+        t0 = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            with lock:
+                busy[stage] += time.perf_counter() - t0
+
+    def fail(i, stage, err):
+        failed.append(i)
+        slots.release()
+        done(i, "", [{"op": stage, "status": "error", "error": err}])
+
+    # Pool threads don't inherit context variables; carry the caller's (the
+    # request's instrumentation level) into every stage
+    def spawn(pool, fn, *args):
+        pool.submit(contextvars.copy_context().run, fn, *args)
+
+    def write_shards(source, outputs):
+        for fn, arr in outputs:
+            shards.add(source, fn, arr)
+
+    def encode(i, outputs, logs, final_fn):
+        try:
+            if shards is not None:
+                timed("encode", write_shards, names[i], outputs)
             else:
-                fn = f"{uuid.uuid4().hex}_{op}.png"
-                save_img = img.clip(0,255).astype("uint8") if img.dtype != np.uint8 else img
-                cv2.imwrite(os.path.join(out_dir, fn), save_img)
-            logs.append({"op":op, "status":"ok", "output":fn})
-            final_fn = fn
+                timed("encode", _write_outputs, out_dir, outputs)
         except Exception as e:
-            logs.append({"op":op, "status":"error", "error":str(e)})
-    return final_fn, logs
+            fail(i, "save", str(e))
+            return
+        slots.release()
+        done(i, final_fn, logs)
+
+    def compute(i, img):
+        try:
+            outputs, logs, final_fn = timed("compute", _run_visual_ops, img, plan)
+            spawn(encode_pool, encode, i, outputs, logs, final_fn)
+        except Exception as e:
+            fail(i, "compute", str(e))
+
+    def tiled(i, path):
+        try:
+            final_fn, logs = timed("compute", _run_tiled, path, plan, out_dir)
+        except Exception as e:
+            fail(i, "compute", str(e))
+            return
+        slots.release()
+        done(i, final_fn, logs)
+
+    def decode(i, path):
+        try:
+            if shards is None and wants_tiled(plan, path):
+                spawn(compute_pool, tiled, i, path)
+                return
+            img = timed("decode", cv2.imread, path)
+            if img is None:
+                fail(i, "load", "Could not read image")
+                return
+            spawn(compute_pool, compute, i, img)
+        except Exception as e:
+            fail(i, "load", str(e))
+
+    t0 = time.perf_counter()
+    # Pools exit in reverse order (decode, compute, encode), so every stage can
+    # still hand work to the next one while it drains.
+    with ThreadPoolExecutor(workers, thread_name_prefix="img-encode") as encode_pool, \
+         ThreadPoolExecutor(workers, thread_name_prefix="img-compute") as compute_pool, \
+         ThreadPoolExecutor(workers, thread_name_prefix="img-decode") as decode_pool:
+        for i, path in enumerate(paths):
+            if i in skip:
+                done(i, "", [{"op": "dedupe", "status": "skip",
+                              "duplicate_of": names[skip[i]]}])
+                continue
+            slots.acquire()
+            if cancel is not None and cancel.is_set():
+                slots.release()
+                cancelled.append(i)
+                done(i, "", [{"op": "batch", "status": "skip", "reason": "cancelled"}])
+                continue
+            started[i] = time.perf_counter()
+            spawn(decode_pool, decode, i, path)
+    if shards is not None:
+        shards.close()
+    wall = time.perf_counter() - t0
+
+    stats = {
+        "images": len(paths),
+        "errors": len(failed),
+        "seconds": round(wall, 3),
+        "images_per_sec": round(len(paths) / wall, 2) if wall > 0 else 0.0,
+        "workers": workers,
+        "max_in_flight": max_in_flight,
+        "skipped_duplicates": len(skip),
+        "cancelled": len(cancelled),
+        # Fraction of each stage's thread time spent busy over the run
+        "stage_utilization": {
+            k: round(v / (wall * workers), 3) if wall > 0 else 0.0 for k, v in busy.items()
+        }
+    }
+    if dup_report is not None:
+        stats["duplicate_clusters"] = dup_report["clusters"]
+    return results, stats
+
+# Profile and plan one image, through `cache` when given. Uses the same entries
+# as run_visual_data_logic, so either path warms the other.
+def plan_image(path: str, user_goal: str, dataset_info: dict=None,
+               cache: ResultStore=None) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    if cache is None:
+        prof = profile_image(path)
+        return prof, llm_make_visual_plan(prof, user_goal, dataset_info)
+    prof = cache.memo(cache.key("image_profile", file_digest(path), code_version(__file__)),
+                      lambda: profile_image(path))
+    plan = cache.memo(cache.key("image_plan", json_digest(prof), user_goal, json_digest(dataset_info),
+                                code_version(__file__)),
+                      lambda: llm_make_visual_plan(prof, user_goal, dataset_info), is_real_plan)
+    return prof, plan
 
 # Higher-level: run profiling, get plan, explanations, apply plan.
+# With a ResultStore (or PRISM_CACHE_DIR set) unchanged images reuse their cached
+# profile, plan, explanations and output files (copied back into out_dir).
 def run_visual_data_logic(file_path: str,
                           user_goal: str="prepare for ML",
-                          out_dir: str="cleaned_uploads") -> Tuple[Dict[str, Any], str]:
-    prof = profile_image(file_path)
-    plan_dict = llm_make_visual_plan(prof, user_goal)
-    expls = [llm_explain_step(s, prof, user_goal) for s in plan_dict.get("ops", [])]
-    fn, log = apply_visual_plan(file_path, plan_dict, out_dir)
+                          out_dir: str="cleaned_uploads",
+                          dataset_info: dict=None,
+                          cache: ResultStore=None) -> Tuple[Dict[str, Any], str]:
+    store = cache if cache is not None else default_store()
+    if store is None:
+        prof = profile_image(file_path)
+        plan_dict = llm_make_visual_plan(prof, user_goal, dataset_info)
+        expls = [llm_explain_step(s, prof, user_goal) for s in plan_dict.get("ops", [])]
+        fn, log = apply_visual_plan(file_path, plan_dict, out_dir)
+    else:
+        fh, ver = file_digest(file_path), code_version(__file__)
+        prof, plan_dict = plan_image(file_path, user_goal, dataset_info, cache=store)
+        ops = plan_dict.get("ops", [])
+        # Canned fallbacks (LLM unavailable) are returned but not cached
+        expls = store.memo(store.key("image_explain", json_digest(plan_dict), json_digest(prof), user_goal, ver),
+                           lambda: [llm_explain_step(s, prof, user_goal) for s in ops],
+                           lambda ex: not any(e == fallback_explanation(s) for s, e in zip(ops, ex)))
+        key = store.key("image_apply", fh, json_digest(plan_dict), ver)
+        hit = store.get(key)
+        if hit is not None:
+            (fn, log), files = hit
+            os.makedirs(out_dir, exist_ok=True)
+            for name in os.listdir(files) if files else []:
+                shutil.copyfile(os.path.join(files, name), os.path.join(out_dir, name))
+        else:
+            fn, log = apply_visual_plan(file_path, plan_dict, out_dir)
+            outputs = {e["output"]: os.path.join(out_dir, e["output"]) for e in log if e.get("output")}
+            store.put(key, [fn, log], outputs or None)
+
     summary = f"Applied {len(log)} ops; final image = {fn}"
     return {
         "profile": prof,
@@ -334,41 +1625,56 @@ def run_visual_data_logic(file_path: str,
         "preprocessed_image": fn
     }, summary
 
+# Decode preview bytes. With a store that keeps arrays (SharedStore), the pixels
+# are cached memory-mapped under the bytes' hash: every plan edit re-previews the
+# same upload, and any worker then maps the one decoded copy instead of decoding.
+def _decode_for_preview(img_bytes: bytes, cache: Any = None) -> Any:
+    if cache is None or not hasattr(cache, "get_array"):
+        return cv2.imdecode(np.frombuffer(img_bytes, np.uint8), cv2.IMREAD_COLOR)
+    key = cache.key("preview_decoded", hashlib.blake2b(img_bytes, digest_size=20).hexdigest())
+    img = cache.get_array(key)
+    if img is None:
+        img = cv2.imdecode(np.frombuffer(img_bytes, np.uint8), cv2.IMREAD_COLOR)
+        if img is not None:
+            cache.put_array(key, img)
+    return img
+
+def _preview_tiled(img_bytes: bytes, plan: Dict[str, Any]) -> bytes:
+    scratch = tempfile.mkdtemp(prefix="preview_")
+    try:
+        src = os.path.join(scratch, "src")
+        with open(src, "wb") as f:
+            f.write(img_bytes)
+        out = os.path.join(scratch, "preview.png")
+        fn, logs = apply_visual_plan_tiled(src, plan, out, int(plan.get("tile_size", 1024)),
+                                           scratch, stretch=True)
+        if not fn:
+            raise ValueError("Could not decode image for preview.")
+        with open(out, "rb") as f:
+            return f.read()
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
 # For quick frontend preview: apply plan in memory and return PNG bytes.
-def process_for_preview(img_bytes: bytes, plan: Dict[str, Any]) -> bytes:
+# Very large images go through the tiled path instead (see wants_tiled).
+# Uses the same compiled stages as apply_visual_plan, taking the first ML variant.
+def process_for_preview(img_bytes: bytes, plan: Dict[str, Any], cache: Any = None) -> bytes:
     try:
-        img = cv2.imdecode(np.frombuffer(img_bytes, np.uint8), cv2.IMREAD_COLOR)
+        if wants_tiled(plan, io.BytesIO(img_bytes)):
+            return _preview_tiled(img_bytes, plan)
+        img = _decode_for_preview(img_bytes, cache)
         if img is None:
             raise ValueError("Could not decode image for preview.")
-        for s in plan.get("ops", []):
-            opn = s.get("op")
-            try:
-                if opn == "resize":
-                    img = cv2.resize(img,
-                                     (s.get("width",224), s.get("height",224)),
-                                     interpolation=getattr(cv2, s.get("interp","INTER_AREA")))
-                elif opn == "denoise":
-                    k = s.get("ksize",5)
-                    k = k+1 if k % 2 == 0 else max(1, k)  # ensure valid kernel
-                    img = (cv2.GaussianBlur(img,(k,k),0) if s.get("method","gaussian")=="gaussian"
-                           else cv2.medianBlur(img,k) if s.get("method")=="median"
-                           else cv2.bilateralFilter(img,k,k*2,k*2))
-                elif opn == "normalize":
-                    f = img.astype("float32")
-                    if s.get("method","minmax") == "minmax":
-                        mn,mx = f.min(),f.max()
-                        img = ((f-mn)/(mx-mn if mx>mn else 1)*255).clip(0,255).astype("uint8")
-                    else:
-                        norm = (f-f.mean())/(f.std() or 1)
-                        img = (((norm-norm.min())/(norm.max()-norm.min() if norm.max()>norm.min() else 1)*255)).clip(0,255).astype("uint8")
-                elif opn == "augment":
-                    # reuse op_augment logic—just take first variant for preview
-                    img = op_augment(img, {k:v for k,v in s.items() if k!="op"})[0][0]
-            except:
-                continue
+        for stage, results, err in run_compiled_plan(img, compile_visual_plan(plan), variant=0):
+            if results:
+                img = results[0][0]
+        if img.dtype != np.uint8:
+            # zscore output is float; stretch to 0-255 for display
+            mn, mx = float(img.min()), float(img.max())
+            img = ((img - mn) / (mx - mn if mx > mn else 1) * 255).clip(0,255).astype("uint8")
         _, buf = cv2.imencode('.png', img)
         return buf.tobytes()
     except:
         # if preview fails, return original
         _, buf = cv2.imencode('.png', cv2.imdecode(np.frombuffer(img_bytes,np.uint8), cv2.IMREAD_COLOR))
-        return buf.tobytes()
\ No newline at end of file
+        return buf.tobytes()
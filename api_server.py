@@ -1,12 +1,15 @@
 import os
 import uuid
 import json
-import zipfile
-import io
+import time
+import shutil
+from contextlib import ExitStack
 from typing import List
-from fastapi import FastAPI, File, UploadFile, Form, HTTPException
-from fastapi.responses import JSONResponse, StreamingResponse, Response
+from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Request
+from fastapi.responses import JSONResponse, StreamingResponse, Response, FileResponse
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
+from starlette.routing import Match
 from dotenv import load_dotenv
 
 # Load .env at startup so API keys and configs are available
@@ -15,13 +18,22 @@ load_dotenv()
 # Bring in our data-processing agents
 from agents.structured import run_structured_data_logic
 from agents.text import run_text_data_logic
+import agents.visual
 from agents.visual import (
-    profile_image,
-    llm_make_visual_plan,
-    apply_visual_plan,
+    profile_image_dataset,
+    plan_image,
     process_for_preview,
     llm_explain_step,
 )
+from batch_jobs import apply_batch, data_type_for, get_job, inline_batch, job_counts, submit_job
+from retention import ResultRetention
+from admission import AdmissionController, AdmissionRejected, estimate_cost, image_dims
+from agents.cache import code_version, file_digest
+from agents.shared import shared_store
+from agents.instrument import PROFILE_KINDS, capture_profile, find_profile, instrumented
+from agents.metrics import (
+    Counter, Gauge, Histogram, SIZE_BUCKETS, render, request_labels, set_request_label
+)
 
 # Create FastAPI app
 app = FastAPI()
@@ -33,17 +45,179 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Profile-Id", "X-Batch-Id", "Content-Range", "Accept-Ranges"],
 )
 
 # Ensure our temp and output dirs exist
 os.makedirs("temp_uploads", exist_ok=True)
 os.makedirs("cleaned_uploads", exist_ok=True)
 
+# With PRISM_SHARED_DIR set, all workers share one store for profiles, plans,
+# decoded preview images and the batch job registry; otherwise state is per worker.
+shared = shared_store()
+
+# Batch results expire after PRISM_RESULT_TTL_S without access and are evicted
+# oldest-first beyond PRISM_RESULT_QUOTA_BYTES; running jobs are never touched.
+retention = ResultRetention.from_env(
+    is_busy=lambda batch_id: (job := get_job(batch_id)) is not None and not job.finished
+)
+
+
+# Memory/CPU budget shared by all requests; previews are admitted ahead of batches.
+admission = AdmissionController.from_env()
+
+
+@app.exception_handler(AdmissionRejected)
+async def admission_rejected_handler(request: Request, exc: AdmissionRejected):
+    return JSONResponse({"detail": f"Server busy: {exc.reason}", "retry_after": exc.retry_after_s},
+                        status_code=429, headers={"Retry-After": str(exc.retry_after_s)})
+
+
+@app.on_event("startup")
+def start_retention():
+    retention.start()
+
+
+@app.on_event("shutdown")
+def stop_retention():
+    retention.stop()
+
+
+# --- Operational metrics, scraped from /metrics ------------------------------------
+REQUEST_LATENCY = Histogram("prism_http_request_seconds", "Request latency by endpoint and data type",
+                            ("endpoint", "method", "status", "data_type"))
+IN_FLIGHT = Gauge("prism_http_requests_in_flight", "Requests currently being handled", ("endpoint",))
+BATCH_FILES = Histogram("prism_batch_files", "Files per batch request", ("endpoint", "data_type"),
+                        buckets=SIZE_BUCKETS)
+UPLOAD_BYTES = Counter("prism_upload_bytes_total", "Uploaded bytes by endpoint", ("endpoint",))
+JOBS = Gauge("prism_batch_jobs", "Batch jobs known to the server by status", ("status",),
+             fn=lambda: {(k,): v for k, v in job_counts().items()})
+# As of the last retention sweep (every PRISM_RETENTION_INTERVAL_S), so scrapes never walk the trees
+DISK_USAGE = Gauge("prism_disk_usage_bytes", "Bytes on disk under the working directories", ("dir",),
+                   fn=lambda: {(d,): retention.last_sweep[k]
+                               for d, k in (("temp_uploads", "temp_bytes"), ("cleaned_uploads", "result_bytes"))
+                               if k in retention.last_sweep})
+ADMISSION_MEMORY = Gauge("prism_admission_memory_bytes", "Reserved memory and total budget", ("kind",),
+                         fn=lambda: {("in_use",): admission.memory_in_use,
+                                     ("budget",): admission.memory_budget})
+ADMISSION_QUEUED = Gauge("prism_admission_queued", "Requests waiting for capacity", ("priority",),
+                         fn=lambda: {(p,): n for p, n in admission.snapshot()["queued"].items()})
+ADMISSIONS = Gauge("prism_admissions", "Admission outcomes since start by priority",
+                   ("priority", "outcome"),
+                   fn=lambda: {(p, o): n for p, c in admission.counts.items() for o, n in c.items()})
+
+
+# Endpoint label = the route's path template, so ids in the path don't explode cardinality
+def _route_template(scope) -> str:
+    for route in app.router.routes:
+        if route.matches(scope)[0] == Match.FULL:
+            return getattr(route, "path", "other")
+    return "unmatched"
+
+
+class MetricsMiddleware:
+    """Plain ASGI middleware: latency, status and in-flight count per endpoint."""
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        endpoint = _route_template(scope)
+        labels = {"data_type": ""}
+        token = request_labels.set(labels)
+        status = [500]
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        IN_FLIGHT.inc(endpoint=endpoint)
+        t0 = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            IN_FLIGHT.dec(endpoint=endpoint)
+            REQUEST_LATENCY.observe(time.perf_counter() - t0, endpoint=endpoint, method=scope["method"],
+                                    status=status[0], data_type=labels["data_type"])
+            request_labels.reset(token)
+
+
+app.add_middleware(MetricsMiddleware)
+
+
+# Map an upload's extension to the data-type label used in metrics
+def _data_type(ext: str) -> str:
+    if ext == "csv":
+        return "csv"
+    if ext in ("txt", "md", "pdf"):
+        return "text"
+    if ext in ("png", "jpg", "jpeg"):
+        return "image"
+    return "other"
+
+
+# Optional per-request diagnostics. `instrument` ("time" or "mem") adds a metrics
+# block to every execution_log entry; `profile` ("cprofile" or "pyinstrument")
+# records the request and returns its id in the X-Profile-Id header, to be
+# fetched from /profiles/{id}.
+def _diagnostics(stack: ExitStack, instrument: str, profile: str):
+    if instrument and instrument != "off":
+        stack.enter_context(instrumented(instrument))
+    return stack.enter_context(capture_profile(profile or None))
+
+
+# Run blocking work (agents, batch apply) on the threadpool so the event loop keeps
+# accepting requests and the admission queue can put previews ahead of batches.
+# Diagnostics are entered in that thread, so profiles cover the work itself.
+# Returns (result, profile capture or None).
+async def _run_blocking(instrument: str, profile: str, fn, *args, **kwargs):
+    def run():
+        with ExitStack() as stack:
+            cap = _diagnostics(stack, instrument, profile)
+            return fn(*args, **kwargs), cap
+    return await run_in_threadpool(run)
+
+
+def _check_diagnostics(instrument: str, profile: str) -> None:
+    if instrument not in ("", "off", "time", "mem"):
+        raise HTTPException(status_code=400, detail=f"Unknown instrument level '{instrument}'")
+    if profile and profile not in PROFILE_KINDS:
+        raise HTTPException(status_code=400, detail=f"Unknown profiler '{profile}'")
+
+
+# (size, image dims) per upload for the admission cost estimate; dims come from
+# the image header, so nothing is decoded before the request is admitted
+def _upload_shapes(files: List[UploadFile], data_type: str) -> List[tuple]:
+    shapes = []
+    for f in files:
+        size = f.size
+        if size is None:
+            size = f.file.seek(0, os.SEEK_END)
+            f.file.seek(0)
+        shapes.append((size, image_dims(f.file) if data_type == "image" else None))
+    return shapes
+
+
+async def _admit(files: List[UploadFile], data_type: str, priority: str, plan=None, ext: str = ""):
+    cost = estimate_cost(data_type, _upload_shapes(files, data_type), plan, ext)
+    return await admission.acquire(cost, priority)
+
+
+def _tag(response: Response, cap) -> Response:
+    if cap is not None:
+        response.headers["X-Profile-Id"] = cap.id
+    return response
+
 
 @app.post("/generate-plan")
 async def generate_plan_endpoint(
     file: UploadFile = File(...),
-    user_goal: str = Form(...)
+    user_goal: str = Form(...),
+    instrument: str = Form("off"),
+    profile: str = Form("")
 ):
     """
     1. Save the uploaded file to temp_uploads.
@@ -51,178 +225,330 @@ async def generate_plan_endpoint(
     3. Run the appropriate 'run_*_logic' to get profile & plan.
     4. Return JSON with profile, plan, and a preview/log.
     """
+    _check_diagnostics(instrument, profile)
     tmp_path = os.path.join("temp_uploads", f"{uuid.uuid4()}_{file.filename}")
     ext = file.filename.rsplit(".", 1)[-1].lower() if "." in file.filename else ""
 
-    # Write upload to disk
-    with open(tmp_path, "wb") as f:
-        f.write(await file.read())
+    set_request_label("data_type", _data_type(ext))
+    ticket = await _admit([file], _data_type(ext), "interactive", ext=ext)
 
     try:
-        if ext == "csv":
-            # Structured data path
-            processed, _, profile = run_structured_data_logic(tmp_path, user_goal=user_goal)
-            return JSONResponse({
-                "profile": profile,
-                "plan": processed.get("plan", {}),
-                "data_type": "csv",
-                "execution_log": processed.get("execution_log", []),
-                "cleaned_preview": processed.get("cleaned_preview", {})
-            })
-
-        elif ext in ("txt", "md", "pdf"):
-            # Text data path
-            processed, _, _ = run_text_data_logic(tmp_path, user_goal=user_goal)
-            return JSONResponse({
-                "profile": processed.get("profile", {}),
-                "plan": processed.get("plan", {}),
-                "data_type": "text",
-                "execution_log": processed.get("execution_log", []),
-                "cleaned_preview": processed.get("cleaned_preview", "")
-            })
-
-        elif ext in ("png", "jpg", "jpeg"):
-            # Image data path: profile & plan only, no execution yet
-            prof = profile_image(tmp_path)
-            plan = llm_make_visual_plan(prof, user_goal)
-            return JSONResponse({
+        # Write upload to disk
+        with open(tmp_path, "wb") as f:
+            data = await file.read()
+            UPLOAD_BYTES.inc(len(data), endpoint="/generate-plan")
+            f.write(data)
+
+        def plan_file():
+            if ext == "csv":
+                # Structured data path
+                processed, _, prof = run_structured_data_logic(tmp_path, user_goal=user_goal, cache=shared)
+                return {
+                    "profile": prof,
+                    "plan": processed.get("plan", {}),
+                    "data_type": "csv",
+                    "execution_log": processed.get("execution_log", []),
+                    "cleaned_preview": processed.get("cleaned_preview", {})
+                }
+
+            elif ext in ("txt", "md", "pdf"):
+                # Text data path
+                processed, _, _ = run_text_data_logic(tmp_path, user_goal=user_goal, cache=shared)
+                return {
+                    "profile": processed.get("profile", {}),
+                    "plan": processed.get("plan", {}),
+                    "data_type": "text",
+                    "execution_log": processed.get("execution_log", []),
+                    "cleaned_preview": processed.get("cleaned_preview", "")
+                }
+
+            elif ext in ("png", "jpg", "jpeg"):
+                # Image data path: profile & plan only, no execution yet
+                prof, plan = plan_image(tmp_path, user_goal, cache=shared)
+                return {
+                    "profile": prof,
+                    "plan": plan,
+                    "data_type": "image"
+                }
+
+            else:
+                # Unsupported file types
+                raise HTTPException(status_code=400, detail="Unsupported file type")
+
+        body, cap = await _run_blocking(instrument, profile, plan_file)
+        return _tag(JSONResponse(body), cap)
+
+    finally:
+        # Clean up the temp file no matter what
+        admission.release(ticket)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+@app.post("/generate-dataset-plan")
+async def generate_dataset_plan_endpoint(
+    files: List[UploadFile] = File(...),
+    user_goal: str = Form(...)
+):
+    """
+    Plan for a whole image batch with one LLM call:
+    1. Save every upload to temp_uploads.
+    2. Profile the batch on a process pool (size/format mix, channel stats).
+    3. Plan from the first readable image's profile plus the dataset summary.
+    """
+    set_request_label("data_type", "image")
+    BATCH_FILES.observe(len(files), endpoint="/generate-dataset-plan", data_type="image")
+    ticket = await _admit(files, "image", "batch")
+    tmp_paths = []
+    try:
+        for f in files:
+            tmp_path = os.path.join("temp_uploads", f"{uuid.uuid4()}_{f.filename}")
+            with open(tmp_path, "wb") as fo:
+                data = await f.read()
+                UPLOAD_BYTES.inc(len(data), endpoint="/generate-dataset-plan")
+                fo.write(data)
+            tmp_paths.append(tmp_path)
+
+        def plan_dataset():
+            if shared is None:
+                dataset_info = profile_image_dataset(tmp_paths)
+            else:
+                key = shared.key("image_dataset_profile", [file_digest(p) for p in tmp_paths],
+                                 code_version(agents.visual.__file__))
+                dataset_info = shared.memo(key, lambda: profile_image_dataset(tmp_paths))
+            if not dataset_info["num_images"]:
+                raise HTTPException(status_code=400, detail="No readable images in batch")
+            for tmp_path in tmp_paths:
+                try:
+                    prof, plan = plan_image(tmp_path, user_goal, dataset_info, cache=shared)
+                    break
+                except ValueError:
+                    continue  # unreadable upload: plan from the next one
+            else:
+                raise HTTPException(status_code=400, detail="No readable images in batch")
+            return {
                 "profile": prof,
+                "dataset_info": dataset_info,
                 "plan": plan,
                 "data_type": "image"
-            })
+            }
 
-        else:
-            # Unsupported file types
-            raise HTTPException(status_code=400, detail="Unsupported file type")
+        return JSONResponse(await run_in_threadpool(plan_dataset))
 
     finally:
-        # Clean up the temp file no matter what
-        if os.path.exists(tmp_path):
-            os.remove(tmp_path)
+        admission.release(ticket)
+        for tmp_path in tmp_paths:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+# Save a batch's uploads to temp_uploads/<batch_id>, keeping their original names
+# for the outputs. The retention sweeper leaves the dir alone while the batch is busy.
+async def _save_uploads(files: List[UploadFile], endpoint: str, batch_id: str) -> List[tuple]:
+    items = []
+    os.makedirs(os.path.join("temp_uploads", batch_id), exist_ok=True)
+    for f in files:
+        tmp_path = os.path.join("temp_uploads", batch_id, f"{uuid.uuid4()}_{f.filename}")
+        with open(tmp_path, "wb") as fo:
+            data = await f.read()
+            UPLOAD_BYTES.inc(len(data), endpoint=endpoint)
+            fo.write(data)
+        items.append((f.filename, tmp_path))
+    return items
+
+
+_ZIP_NAMES = {"csv": "processed_csv", "text": "processed_text", "image": "processed_images"}
 
 
 @app.post("/apply-plan")
 async def apply_plan_endpoint(
     files: List[UploadFile] = File(...),
-    plan: str = Form(...)
+    plan: str = Form(...),
+    instrument: str = Form("off"),
+    profile: str = Form("")
 ):
     """
     1. Parse user-provided JSON plan.
     2. Save all uploads to temp, apply the plan per file.
-    3. Collect logs/previews and save outputs to cleaned_uploads/<batch_id>.
-    4. Zip results and stream back to client.
+    3. Save outputs to cleaned_uploads/<batch_id> and build its archive.
+    4. Return the archive (X-Batch-Id names it for later re-downloads).
+    For progress events and cancellation use /apply-plan/jobs instead.
     """
+    _check_diagnostics(instrument, profile)
     plan_dict = json.loads(plan)
+    # File type is decided by the first file's extension
+    data_type = data_type_for(files[0].filename)
+    set_request_label("data_type", data_type)
+    BATCH_FILES.observe(len(files), endpoint="/apply-plan", data_type=data_type)
+    # Outside the try below so a rejection stays a 429
+    ticket = await _admit(files, data_type, "batch", plan_dict, files[0].filename.rsplit(".", 1)[-1].lower())
     batch_id = uuid.uuid4().hex
     out_dir = os.path.join("cleaned_uploads", batch_id)
-    os.makedirs(out_dir, exist_ok=True)
 
     try:
-        # Determine file type by first file’s extension
-        first_file = files[0]
-        ext = first_file.filename.rsplit(".", 1)[-1].lower() if "." in first_file.filename else ""
-
-        if ext == "csv":
-            # Batch CSV processing
-            results = []
-            from agents.structured import apply_tabular_plan
-            import pandas as pd
-
-            for f in files:
-                tmp_path = os.path.join("temp_uploads", f"{uuid.uuid4()}_{f.filename}")
-                with open(tmp_path, "wb") as fo:
-                    fo.write(await f.read())
-
-                df, log = apply_tabular_plan(tmp_path, plan_dict)
-                out_path = os.path.join(out_dir, f"processed_{f.filename}")
-                df.to_csv(out_path, index=False)
-
-                results.append({
-                    "filename": f.filename,
-                    "execution_log": log,
-                    "preview": df.head(10).to_dict("records"),
-                    "shape": df.shape
-                })
-                os.remove(tmp_path)
-
-            # Zip all processed CSVs for download
-            zip_buffer = io.BytesIO()
-            with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zf:
-                for root, _, csv_files in os.walk(out_dir):
-                    for csv_file in csv_files:
-                        zf.write(os.path.join(root, csv_file), csv_file)
-            zip_buffer.seek(0)
-            return StreamingResponse(
-                zip_buffer,
-                media_type="application/zip",
-                headers={"Content-Disposition": f"attachment; filename=processed_csv_{batch_id}.zip"}
-            )
-
-        elif ext in ("txt", "md", "pdf"):
-            # Batch text processing
-            results = []
-            from agents.text import load_raw_text, apply_text_plan
-
-            for f in files:
-                tmp_path = os.path.join("temp_uploads", f"{uuid.uuid4()}_{f.filename}")
-                with open(tmp_path, "wb") as fo:
-                    fo.write(await f.read())
-
-                raw_text = load_raw_text(tmp_path)
-                cleaned_text, log = apply_text_plan(raw_text, plan_dict)
-                out_path = os.path.join(out_dir, f"processed_{f.filename}")
-                with open(out_path, "w", encoding="utf-8") as out_f:
-                    out_f.write(cleaned_text)
-
-                results.append({
-                    "filename": f.filename,
-                    "execution_log": log,
-                    "preview": cleaned_text[:1000],
-                    "original_length": len(raw_text),
-                    "cleaned_length": len(cleaned_text)
-                })
-                os.remove(tmp_path)
-
-            # Zip all processed text files
-            zip_buffer = io.BytesIO()
-            with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zf:
-                for root, _, text_files in os.walk(out_dir):
-                    for text_file in text_files:
-                        zf.write(os.path.join(root, text_file), text_file)
-            zip_buffer.seek(0)
-            return StreamingResponse(
-                zip_buffer,
-                media_type="application/zip",
-                headers={"Content-Disposition": f"attachment; filename=processed_text_{batch_id}.zip"}
-            )
-
-        else:
-            # Assume image batch if not CSV or text
-            for f in files:
-                tmp_path = os.path.join("temp_uploads", f"{uuid.uuid4()}_{f.filename}")
-                with open(tmp_path, "wb") as fo:
-                    fo.write(await f.read())
-
-                # Apply image plan, saving variants to out_dir
-                apply_visual_plan(tmp_path, plan_dict, out_dir=out_dir)
-                os.remove(tmp_path)
-
-            # Zip all processed images
-            zip_buffer = io.BytesIO()
-            with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zf:
-                for root, _, image_files in os.walk(out_dir):
-                    for image_file in image_files:
-                        zf.write(os.path.join(root, image_file), image_file)
-            zip_buffer.seek(0)
-            return StreamingResponse(
-                zip_buffer,
-                media_type="application/zip",
-                headers={"Content-Disposition": f"attachment; filename=processed_images_{batch_id}.zip"}
-            )
+        os.makedirs(out_dir, exist_ok=True)
+        # Pinned against this worker's sweeps, recorded as running for the others'
+        with retention.pinned(batch_id), inline_batch(batch_id, data_type, len(files)):
+            try:
+                items = await _save_uploads(files, "/apply-plan", batch_id)
+                summary, cap = await _run_blocking(instrument, profile, apply_batch,
+                                                   items, plan_dict, out_dir, strict=True)
+            finally:
+                shutil.rmtree(os.path.join("temp_uploads", batch_id), ignore_errors=True)
+            await run_in_threadpool(retention.finalize, batch_id, data_type, summary=summary)
+
+        # Same archive stays downloadable from /batches/{batch_id}/download
+        return _tag(_archive_response(batch_id), cap)
 
     except Exception as e:
         # Surface any unexpected errors as HTTP 500
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        admission.release(ticket)
+
+
+@app.post("/apply-plan/jobs", status_code=202)
+async def create_apply_job_endpoint(
+    files: List[UploadFile] = File(...),
+    plan: str = Form(...)
+):
+    """
+    Queue a batch and return immediately. Progress is streamed from
+    /apply-plan/jobs/{job_id}/events as server-sent events:
+      queued, started, file (one per input: status, execution_log, timing and
+      shape/preview/output), done (status completed|cancelled|failed + summary).
+    DELETE the job to cancel; download the (possibly partial) zip when done.
+    """
+    try:
+        plan_dict = json.loads(plan)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="plan is not valid JSON")
+    data_type = data_type_for(files[0].filename)
+    set_request_label("data_type", data_type)
+    BATCH_FILES.observe(len(files), endpoint="/apply-plan/jobs", data_type=data_type)
+
+    # The job holds its reservation until it finishes, so queued batches count too
+    ticket = await _admit(files, data_type, "batch", plan_dict, files[0].filename.rsplit(".", 1)[-1].lower())
+    job_id = uuid.uuid4().hex
+    temp_dir = os.path.join("temp_uploads", job_id)
+
+    def on_exit(job):
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        admission.release(ticket)
+
+    try:
+        items = await _save_uploads(files, "/apply-plan/jobs", job_id)
+        job = submit_job(items, plan_dict, retention.root,
+                         finalize=lambda j: retention.finalize(j.id, j.data_type, j.status, j.summary),
+                         on_exit=on_exit, job_id=job_id)
+    except Exception:
+        on_exit(None)
+        raise
+    base = f"/apply-plan/jobs/{job.id}"
+    return JSONResponse({"job_id": job.id, "status": job.status, "total": len(items),
+                         "events": f"{base}/events", "download": f"{base}/download"},
+                        status_code=202)
+
+
+def _job_or_404(job_id: str):
+    job = get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+@app.get("/apply-plan/jobs/{job_id}")
+async def apply_job_status_endpoint(job_id: str):
+    return JSONResponse(_job_or_404(job_id).snapshot())
+
+
+@app.get("/apply-plan/jobs/{job_id}/events")
+async def apply_job_events_endpoint(job_id: str, request: Request):
+    """SSE stream; reconnecting clients resume after their Last-Event-ID."""
+    job = _job_or_404(job_id)
+    try:
+        last_id = int(request.headers.get("last-event-id", -1))
+    except ValueError:
+        last_id = -1
+    return StreamingResponse(job.stream(last_id), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.delete("/apply-plan/jobs/{job_id}")
+async def cancel_apply_job_endpoint(job_id: str):
+    """Stop starting new files; in-flight files finish and stay in the download."""
+    job = _job_or_404(job_id)
+    if not job.finished:
+        job.cancel.set()
+    return JSONResponse(job.snapshot())
+
+
+@app.get("/apply-plan/jobs/{job_id}/download")
+async def apply_job_download_endpoint(job_id: str):
+    job = _job_or_404(job_id)
+    if not job.finished:
+        raise HTTPException(status_code=409, detail=f"Job is {job.status}")
+    return _archive_response(job.id)
+
+
+# --- Batch results by id ---------------------------------------------------------
+# Downloads are FileResponses over pre-built files, so Range / If-Range / HEAD
+# work for resuming; every access pushes the batch's expiry back.
+
+def _batch_meta_or_404(batch_id: str) -> dict:
+    meta = retention.meta(batch_id)
+    if meta is None:
+        raise HTTPException(status_code=404, detail="Batch not found or expired")
+    retention.touch(batch_id)
+    return meta
+
+
+def _archive_response(batch_id: str) -> FileResponse:
+    meta = _batch_meta_or_404(batch_id)
+    return FileResponse(
+        retention.archive_path(batch_id),
+        media_type="application/zip",
+        filename=f"{_ZIP_NAMES.get(meta['data_type'], 'processed')}_{batch_id}.zip",
+        headers={"X-Batch-Id": batch_id},
+    )
+
+
+@app.get("/batches/{batch_id}")
+async def batch_manifest_endpoint(batch_id: str):
+    """Files, sizes, status and expiry of a finished batch."""
+    return JSONResponse(_batch_meta_or_404(batch_id))
+
+
+@app.api_route("/batches/{batch_id}/download", methods=["GET", "HEAD"])
+async def batch_download_endpoint(batch_id: str):
+    return _archive_response(batch_id)
+
+
+@app.api_route("/batches/{batch_id}/files/{name}", methods=["GET", "HEAD"])
+async def batch_file_endpoint(batch_id: str, name: str):
+    _batch_meta_or_404(batch_id)
+    path = retention.file_path(batch_id, name)
+    if path is None:
+        raise HTTPException(status_code=404, detail="File not found in batch")
+    return FileResponse(path, filename=name)
+
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    """Prometheus text exposition of the counters, gauges and histograms above."""
+    return Response(content=render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/profiles/{profile_id}")
+async def download_profile_endpoint(profile_id: str):
+    """
+    Download a profile recorded with profile=cprofile (.prof, open with
+    snakeviz or pstats) or profile=pyinstrument (.html).
+    """
+    path = find_profile(profile_id)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return FileResponse(path, filename=os.path.basename(path))
 
 
 @app.post("/preview-image")
@@ -234,13 +560,21 @@ async def preview_image_endpoint(
     For frontend previews: take raw bytes + plan JSON,
     apply deterministic transforms in-memory, return PNG bytes.
     """
+    set_request_label("data_type", "image")
     try:
         plan_dict = json.loads(plan)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="plan is not valid JSON")
+    ticket = await _admit([file], "image", "interactive", plan_dict)
+    try:
         image_bytes = await file.read()
-        processed_bytes = process_for_preview(image_bytes, plan_dict)
+        UPLOAD_BYTES.inc(len(image_bytes), endpoint="/preview-image")
+        processed_bytes = await run_in_threadpool(process_for_preview, image_bytes, plan_dict, cache=shared)
         return Response(content=processed_bytes, media_type="image/png")
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        admission.release(ticket)
 
 
 @app.post("/explain-step")
@@ -256,7 +590,7 @@ async def explain_step_endpoint(
     try:
         step_dict = json.loads(step)
         profile_dict = json.loads(profile)
-        explanation = llm_explain_step(step_dict, profile_dict, user_goal)
+        explanation = await run_in_threadpool(llm_explain_step, step_dict, profile_dict, user_goal)
         return JSONResponse({"explanation": explanation})
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -0,0 +1,481 @@
+import os
+import json
+import time
+import uuid
+import asyncio
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+from agents.structured import apply_tabular_plan
+from agents.text import (
+    MAX_HASH_FEATURES, MAX_NGRAM, load_raw_text, apply_text_plan, export_token_ids, export_text_features
+)
+from agents.visual import apply_visual_plan_batch
+from agents.shared import SharedStore, shared_store
+
+# Batch apply with per-file progress. /apply-plan runs apply_batch() inline;
+# /apply-plan/jobs queues the same work as a BatchJob whose events (one per
+# finished file, then a final "done") are streamed to clients as server-sent
+# events. Cancelling a job stops it from starting new files; files
+# already being processed finish and the partial output stays downloadable
+# (archives and their lifetime are handled by retention.py).
+#
+# With a shared store (PRISM_SHARED_DIR) every job's snapshot and events are also
+# written there, so with several API workers any of them can report on, stream
+# or cancel a job that another one is running (see RemoteJob). Inline /apply-plan
+# batches are recorded there too while they run (see inline_batch), so another
+# worker's retention sweep sees them as busy.
+
+Emit = Callable[[Dict[str, Any]], None]
+TEXT_EXTS = ("txt", "md", "pdf")
+
+
+def data_type_for(filename: str) -> str:
+    ext = filename.rsplit(".", 1)[-1].lower() if "." in filename else ""
+    if ext == "csv":
+        return "csv"
+    if ext in TEXT_EXTS:
+        return "text"
+    return "image"  # anything else is treated as an image batch, as before
+
+
+# Integer from a client plan, clamped to lo..hi
+def _client_int(value: Any, lo: int, hi: int) -> int:
+    return max(lo, min(int(value), hi))
+
+
+# Pool size requested in a client plan, clamped to 1..cpu_count (None = default)
+def _client_workers(value: Any) -> Optional[int]:
+    if value is None:
+        return None
+    return _client_int(value, 1, os.cpu_count() or 1)
+
+
+def _file_status(log: List[Dict[str, Any]]) -> str:
+    if any(e.get("status") == "error" for e in log):
+        return "error"
+    if log and all(e.get("status") == "skip" for e in log):
+        return "cancelled" if log[0].get("reason") == "cancelled" else "skipped"
+    return "ok"
+
+
+def _csv_batch(items, plan, out_dir, emit, cancel, strict) -> None:
+    for i, (name, path) in enumerate(items):
+        if cancel is not None and cancel.is_set():
+            emit({"type": "file", "index": i, "filename": name, "status": "cancelled"})
+            continue
+        t0 = time.perf_counter()
+        try:
+            df, log = apply_tabular_plan(path, plan)
+            df.to_csv(os.path.join(out_dir, f"processed_{name}"), index=False)
+        except Exception as e:
+            if strict:
+                raise
+            emit({"type": "file", "index": i, "filename": name, "status": "error", "error": str(e),
+                  "seconds": round(time.perf_counter() - t0, 4)})
+            continue
+        emit({
+            "type": "file", "index": i, "filename": name, "status": _file_status(log),
+            "seconds": round(time.perf_counter() - t0, 4),
+            "execution_log": log,
+            "shape": list(df.shape),
+            "preview": json.loads(df.head(10).to_json(orient="records", date_format="iso")),
+        })
+
+
+def _text_batch(items, plan, out_dir, emit, cancel, strict) -> None:
+    processed_paths = []
+    for i, (name, path) in enumerate(items):
+        if cancel is not None and cancel.is_set():
+            emit({"type": "file", "index": i, "filename": name, "status": "cancelled"})
+            continue
+        t0 = time.perf_counter()
+        try:
+            raw_text = load_raw_text(path)
+            cleaned_text, log = apply_text_plan(raw_text, plan)
+            out_path = os.path.join(out_dir, f"processed_{name}")
+            with open(out_path, "w", encoding="utf-8") as out_f:
+                out_f.write(cleaned_text)
+        except Exception as e:
+            if strict:
+                raise
+            emit({"type": "file", "index": i, "filename": name, "status": "error", "error": str(e),
+                  "seconds": round(time.perf_counter() - t0, 4)})
+            continue
+        processed_paths.append(out_path)
+        emit({
+            "type": "file", "index": i, "filename": name, "status": _file_status(log),
+            "seconds": round(time.perf_counter() - t0, 4),
+            "execution_log": log,
+            "preview": cleaned_text[:1000],
+            "original_length": len(raw_text),
+            "cleaned_length": len(cleaned_text),
+        })
+    if cancel is not None and cancel.is_set():
+        return
+
+    # Optional token-id export: one vocab + flat id arrays for the whole batch
+    token_export = plan.get("token_export")
+    if token_export and processed_paths:
+        opts = token_export if isinstance(token_export, dict) else {}
+        export_token_ids(
+            processed_paths, out_dir,
+            min_freq=int(opts.get("min_freq", 1)),
+            workers=_client_workers(opts.get("workers"))
+        )
+
+    # Optional hashed n-gram / TF-IDF matrix saved next to the cleaned files
+    feature_export = plan.get("feature_export")
+    if feature_export and processed_paths:
+        opts = feature_export if isinstance(feature_export, dict) else {}
+        lo, hi = opts.get("ngram_range", (1, 1))
+        lo = _client_int(lo, 1, MAX_NGRAM)
+        export_text_features(
+            processed_paths, out_dir,
+            n_features=_client_int(opts.get("n_features", 2 ** 20), 1, MAX_HASH_FEATURES),
+            ngram_range=(lo, _client_int(hi, lo, MAX_NGRAM)),
+            weighting=opts.get("weighting", "tfidf")
+        )
+
+
+def _image_batch(items, plan, out_dir, emit, cancel, strict) -> Dict[str, Any]:
+    def on_result(i, final_fn, logs, seconds):
+        emit({"type": "file", "index": i, "filename": items[i][0], "status": _file_status(logs),
+              "seconds": round(seconds, 4), "execution_log": logs, "output": final_fn})
+
+    _, stats = apply_visual_plan_batch([p for _, p in items], plan, out_dir=out_dir,
+                                       on_result=on_result, cancel=cancel,
+                                       names=[name for name, _ in items])
+    return stats
+
+
+# Apply `plan` to [(original filename, saved path), ...], writing into out_dir.
+# The first file's extension picks the agent. emit() receives one "file" event
+# per input; strict=True re-raises the first per-file CSV/text error instead.
+def apply_batch(items: List[Tuple[str, str]], plan: Dict[str, Any], out_dir: str,
+                emit: Optional[Emit] = None, cancel: Optional[threading.Event] = None,
+                strict: bool = False) -> Dict[str, Any]:
+    os.makedirs(out_dir, exist_ok=True)
+    data_type = data_type_for(items[0][0]) if items else "image"
+    counts = {"ok": 0, "error": 0, "skipped": 0, "cancelled": 0}
+    lock = threading.Lock()
+
+    def counted(event: Dict[str, Any]) -> None:
+        with lock:
+            counts[event["status"]] += 1
+            event["completed"] = sum(counts.values())
+            event["total"] = len(items)
+            if emit is not None:
+                emit(event)
+
+    t0 = time.perf_counter()
+    batch = {"csv": _csv_batch, "text": _text_batch, "image": _image_batch}[data_type]
+    stats = batch(items, plan, out_dir, counted, cancel, strict)
+    summary = {"data_type": data_type, "total": len(items), **counts,
+               "seconds": round(time.perf_counter() - t0, 3)}
+    if stats:
+        summary["stats"] = stats
+    return summary
+
+
+# --- Background jobs ----------------------------------------------------------------
+
+MAX_JOBS = int(os.environ.get("PRISM_MAX_JOBS", "2"))  # batches processed concurrently
+JOB_TTL_S = 3600  # finished jobs are forgotten (not their files) after this long
+_runner = ThreadPoolExecutor(MAX_JOBS, thread_name_prefix="batch-job")
+_jobs: Dict[str, "BatchJob"] = {}
+_jobs_lock = threading.Lock()
+_CANCEL_POLL_S = 0.5
+_HEARTBEAT_S = 30  # how often a worker refreshes its unfinished jobs in the shared store
+STALE_S = 300  # an unfinished job not refreshed for this long has lost its worker
+_heartbeat: Optional[threading.Thread] = None
+_inline: Dict[str, int] = {}  # batch id -> running inline /apply-plan batches with that id
+
+
+# Keep this worker's queued and running jobs (and inline batches) fresh in the
+# shared store, so other workers can tell them apart from jobs whose worker died
+# (see RemoteJob)
+def _heartbeat_loop(store: SharedStore) -> None:
+    while True:
+        time.sleep(_HEARTBEAT_S)
+        with _jobs_lock:
+            ids = [j.id for j in _jobs.values() if not j.finished] + list(_inline)
+        try:
+            store.touch_jobs(ids)
+        except Exception as e:
+            print(f"Job heartbeat failed: {e}")
+
+
+# Caller holds _jobs_lock
+def _start_heartbeat(store: SharedStore) -> None:
+    global _heartbeat
+    if _heartbeat is None:
+        _heartbeat = threading.Thread(target=_heartbeat_loop, args=(store,),
+                                      name="job-heartbeat", daemon=True)
+        _heartbeat.start()
+
+
+class _SharedCancel(threading.Event):
+    """
+    Cancel flag mirrored in the shared store: set() records the request for the
+    owning worker, and is_set() picks up requests made on other workers
+    (polling the store at most every _CANCEL_POLL_S).
+    """
+    def __init__(self, store: SharedStore, job_id: str):
+        super().__init__()
+        self._store = store
+        self._job_id = job_id
+        self._checked = 0.0
+
+    def set(self) -> None:
+        super().set()
+        self._store.request_cancel(self._job_id)
+
+    def is_set(self) -> bool:
+        if super().is_set():
+            return True
+        now = time.monotonic()
+        if now - self._checked >= _CANCEL_POLL_S:
+            self._checked = now
+            if self._store.cancel_requested(self._job_id):
+                super().set()
+        return super().is_set()
+
+
+class BatchJob:
+    """
+    One queued /apply-plan batch. Events are appended from the worker thread and
+    fanned out to any number of SSE listeners, each woken on its own event loop;
+    an event's id is its index, so a reconnecting client resumes via Last-Event-ID.
+    """
+    def __init__(self, items: List[Tuple[str, str]], plan: Dict[str, Any], out_root: str,
+                 finalize: Optional[Callable[["BatchJob"], None]] = None,
+                 on_exit: Optional[Callable[["BatchJob"], None]] = None,
+                 store: Optional[SharedStore] = None, job_id: Optional[str] = None):
+        self.id = job_id or uuid.uuid4().hex
+        self.items = items
+        self.plan = plan
+        self.out_dir = os.path.join(out_root, self.id)
+        self.data_type = data_type_for(items[0][0]) if items else "image"
+        self.status = "queued"
+        self._finalize = finalize
+        self._on_exit = on_exit
+        self.summary: Optional[Dict[str, Any]] = None
+        self.created = time.time()
+        self.finished_at: Optional[float] = None
+        self._store = store
+        self.cancel = _SharedCancel(store, self.id) if store is not None else threading.Event()
+        self.events: List[Dict[str, Any]] = []
+        self._listeners: List[Tuple[asyncio.AbstractEventLoop, asyncio.Event]] = []
+        self._lock = threading.Lock()
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("completed", "cancelled", "failed")
+
+    def emit(self, event: Dict[str, Any]) -> None:
+        with self._lock:
+            self.events.append(event)
+            if self._store is not None:
+                self._store.add_job_event(self.id, len(self.events) - 1, event, self.snapshot())
+            listeners = list(self._listeners)
+        for loop, wake in listeners:
+            try:
+                loop.call_soon_threadsafe(wake.set)
+            except RuntimeError:  # listener's loop already closed
+                pass
+
+    def snapshot(self) -> Dict[str, Any]:
+        done = [e for e in self.events if e.get("type") == "file"]
+        status = "cancelling" if self.cancel.is_set() and not self.finished else self.status
+        return {"job_id": self.id, "status": status, "data_type": self.data_type,
+                "total": len(self.items), "completed": len(done),
+                "errors": sum(e["status"] == "error" for e in done),
+                "created": self.created, "finished_at": self.finished_at, "summary": self.summary}
+
+    def run(self) -> None:
+        try:
+            if self.cancel.is_set():
+                self.status = "cancelled"
+            else:
+                self.status = "running"
+                self.emit({"type": "started", "total": len(self.items)})
+                self.summary = apply_batch(self.items, self.plan, self.out_dir, self.emit, self.cancel)
+                self.status = "cancelled" if self.cancel.is_set() else "completed"
+            if self._finalize is not None:
+                self._finalize(self)  # e.g. pre-build the download archive
+            self.emit({"type": "done", "status": self.status, "summary": self.summary})
+        except Exception as e:
+            self.status = "failed"
+            self.emit({"type": "done", "status": "failed", "error": str(e)})
+        finally:
+            self.finished_at = time.time()
+            if self._store is not None:
+                self._store.save_job(self.id, self.snapshot())
+            for _, path in self.items:
+                if os.path.exists(path):
+                    os.remove(path)
+            if self._on_exit is not None:
+                self._on_exit(self)  # e.g. hand back the admission reservation
+
+    # Server-sent events from event `last_id + 1` on, until the job finishes
+    async def stream(self, last_id: int = -1, keepalive_s: float = 15.0) -> AsyncIterator[str]:
+        listener = (asyncio.get_running_loop(), asyncio.Event())
+        wake = listener[1]
+        with self._lock:
+            self._listeners.append(listener)
+        try:
+            nxt = last_id + 1
+            while True:
+                wake.clear()
+                pending = self.events[nxt:]
+                for event in pending:
+                    yield f"id: {nxt}\nevent: {event['type']}\ndata: {json.dumps(event, default=str)}\n\n"
+                    nxt += 1
+                # Done, including a client resuming from the "done" event's id
+                if self.events and self.events[-1]["type"] == "done" and nxt >= len(self.events):
+                    return
+                try:
+                    await asyncio.wait_for(wake.wait(), keepalive_s)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+        finally:
+            with self._lock:
+                self._listeners.remove(listener)
+
+
+class RemoteJob:
+    """
+    Read-only view of a job run by another worker, backed by the shared store.
+    Offers what the endpoints use from BatchJob: snapshot, stream and cancel.
+    """
+    def __init__(self, job_id: str, store: SharedStore):
+        self.id = job_id
+        self._store = store
+        self.cancel = _SharedCancel(store, job_id)
+
+    def snapshot(self) -> Dict[str, Any]:
+        snap = self._store.job_snapshot(self.id) or {"job_id": self.id, "status": "unknown"}
+        if snap["status"] in ("queued", "running") and self._stale():
+            snap["status"] = "lost"
+        if snap.pop("cancel_requested", False) and snap["status"] in ("queued", "running"):
+            snap["status"] = "cancelling"
+        return snap
+
+    # The owning worker stopped refreshing the job (it died mid-run)
+    def _stale(self) -> bool:
+        updated = self._store.job_updated(self.id)
+        return updated is None or time.time() - updated > STALE_S
+
+    @property
+    def status(self) -> str:
+        return self.snapshot()["status"]
+
+    @property
+    def data_type(self) -> str:
+        return self.snapshot().get("data_type", "image")
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("completed", "cancelled", "failed", "lost")
+
+    # Same SSE framing as BatchJob.stream, polling the store for new events
+    async def stream(self, last_id: int = -1, keepalive_s: float = 15.0,
+                     poll_s: float = 0.25) -> AsyncIterator[str]:
+        nxt, idle = last_id + 1, 0.0
+        while True:
+            pending = self._store.job_events(self.id, nxt - 1)
+            for event in pending:
+                yield f"id: {nxt}\nevent: {event['type']}\ndata: {json.dumps(event, default=str)}\n\n"
+                nxt += 1
+            if pending and pending[-1]["type"] == "done":
+                return
+            if not pending:
+                last = self._store.last_job_event(self.id)
+                if last is not None and last[1]["type"] == "done" and nxt > last[0]:
+                    return  # resumed from (or past) the "done" event
+            idle = 0.0 if pending else idle + poll_s
+            if idle >= keepalive_s:
+                idle = 0.0
+                if self._stale():
+                    event = {"type": "done", "status": "lost", "error": "the worker running this job stopped"}
+                    yield f"id: {nxt}\nevent: done\ndata: {json.dumps(event)}\n\n"
+                    return
+                yield ": keep-alive\n\n"
+            await asyncio.sleep(poll_s)
+
+
+def _prune() -> None:
+    cutoff = time.time() - JOB_TTL_S
+    with _jobs_lock:
+        for job_id in [j.id for j in _jobs.values() if j.finished and j.finished_at < cutoff]:
+            del _jobs[job_id]
+    store = shared_store()
+    if store is not None:
+        store.prune_jobs(cutoff)
+
+
+def submit_job(items: List[Tuple[str, str]], plan: Dict[str, Any], out_root: str,
+               finalize: Optional[Callable[[BatchJob], None]] = None,
+               on_exit: Optional[Callable[[BatchJob], None]] = None,
+               job_id: Optional[str] = None) -> BatchJob:
+    _prune()
+    store = shared_store()
+    job = BatchJob(items, plan, out_root, finalize, on_exit, store, job_id)
+    with _jobs_lock:
+        _jobs[job.id] = job
+        if store is not None:
+            _start_heartbeat(store)
+    job.emit({"type": "queued", "job_id": job.id, "total": len(items), "data_type": job.data_type})
+    _runner.submit(job.run)
+    return job
+
+
+# Record a batch run inside its /apply-plan request as a running job in the shared
+# store (kept fresh by the heartbeat), so other workers see it busy via get_job and
+# their retention sweeps leave its uploads and outputs alone. On exit it is saved
+# as finished with a final "done" event. No-op without a shared store.
+@contextmanager
+def inline_batch(batch_id: str, data_type: str, total: int):
+    store = shared_store()
+    if store is None:
+        yield
+        return
+    snapshot = {"job_id": batch_id, "status": "running", "data_type": data_type, "total": total,
+                "completed": 0, "errors": 0, "created": time.time(), "finished_at": None,
+                "summary": None}
+    with _jobs_lock:
+        _inline[batch_id] = _inline.get(batch_id, 0) + 1
+        _start_heartbeat(store)
+    store.save_job(batch_id, snapshot)
+    status = "failed"
+    try:
+        yield
+        status = "completed"
+    finally:
+        with _jobs_lock:
+            _inline[batch_id] -= 1
+            if not _inline[batch_id]:
+                del _inline[batch_id]
+        snapshot.update(status=status, finished_at=time.time())
+        store.add_job_event(batch_id, 0, {"type": "done", "status": status}, snapshot)
+
+
+# A job of this worker, or (with a shared store) a view of one run by another
+def get_job(job_id: str):
+    job = _jobs.get(job_id)
+    if job is None:
+        store = shared_store()
+        if store is not None and store.job_snapshot(job_id) is not None:
+            return RemoteJob(job_id, store)
+    return job
+
+
+# Jobs of this worker by status (each worker reports its own on /metrics)
+def job_counts() -> Dict[str, int]:
+    counts: Dict[str, int] = {}
+    for job in list(_jobs.values()):
+        counts[job.status] = counts.get(job.status, 0) + 1
+    return counts
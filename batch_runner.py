@@ -0,0 +1,266 @@
+import os
+import sys
+import json
+import time
+import threading
+from concurrent.futures import BrokenExecutor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+from dotenv import load_dotenv
+
+from agents.cache import is_real_plan
+from agents.instrument import call_instrumented, level_name
+
+# Load .env variables (e.g., API keys) at startup
+load_dotenv()
+
+# Fan-out batch runner for the data-team workflow. The compiled graph in
+# main_app handles one file per invocation; this runs a whole directory with the
+# same routing, but splits each file into profile -> plan -> apply so the
+# CPU-bound steps run on a process pool while LLM planning runs on its own
+# thread pool. Finished files are appended to a JSONL checkpoint, so a rerun
+# with the same checkpoint skips them and resumes where an interrupted run stopped.
+# Files applied with an offline fallback plan (LLM unavailable) are checkpointed
+# as "fallback" and, like errors, processed again on the next run.
+
+# Extensions the router knows about; anything else is ignored in batch mode
+_BATCH_EXTS = (".csv", ".pdf", ".txt", ".md", ".jpg", ".jpeg", ".png")
+
+
+# Same routing as main_app.file_type_router, kept here so worker processes
+# don't have to import (and compile) the graph.
+def route_file(path: str) -> str:
+    path = path.lower()
+    if path.endswith(".csv"):
+        return "structured"
+    if path.endswith((".jpg", ".jpeg", ".png")):
+        return "visual"
+    return "text"
+
+
+# CPU pool: profile one file
+def _profile_file(kind: str, path: str) -> Dict[str, Any]:
+    if kind == "structured":
+        from agents.structured import profile_tabular
+        return profile_tabular(path)
+    if kind == "visual":
+        from agents.visual import profile_image
+        return profile_image(path)
+    from agents.text import profile_text
+    return profile_text(path, mode="auto")
+
+
+# LLM pool: ask the planner for this file's kind
+def _plan_file(kind: str, profile: Dict[str, Any], user_goal: str) -> Dict[str, Any]:
+    if kind == "structured":
+        from agents.structured import llm_make_tabular_plan
+        return llm_make_tabular_plan(profile, user_goal)
+    if kind == "visual":
+        from agents.visual import llm_make_visual_plan
+        return llm_make_visual_plan(profile, user_goal)
+    from agents.text import llm_make_text_plan
+    return llm_make_text_plan(profile, user_goal)
+
+
+# CPU pool: apply the plan and write outputs under out_dir/<kind>/
+def _apply_file(kind: str, path: str, plan: Dict[str, Any], out_dir: str, out_name: str) -> Dict[str, Any]:
+    kind_dir = os.path.join(out_dir, kind)
+    os.makedirs(kind_dir, exist_ok=True)
+    if kind == "structured":
+        from agents.structured import apply_tabular_plan
+        out_path = os.path.join(kind_dir, f"processed_{out_name}")
+        df, log = apply_tabular_plan(path, plan, out_path)
+        return {"execution_log": log, "output": out_path,
+                "summary": f"Applied {len(plan.get('ops', []))} ops. Rows: {len(df)}. Cols: {df.shape[1]}."}
+    if kind == "visual":
+        from agents.visual import apply_visual_plan
+        fn, log = apply_visual_plan(path, plan, kind_dir)
+        return {"execution_log": log, "output": os.path.join(kind_dir, fn) if fn else "",
+                "summary": f"Applied {len(log)} ops; final image = {fn}"}
+    from agents.text import load_raw_text, apply_text_plan
+    cleaned, log = apply_text_plan(load_raw_text(path), plan)
+    out_path = os.path.join(kind_dir, f"processed_{os.path.splitext(out_name)[0]}.txt")
+    with open(out_path, "w", encoding="utf-8") as f:
+        f.write(cleaned)
+    return {"execution_log": log, "output": out_path,
+            "summary": f"Applied {len(plan.get('ops', []))} ops; final length {len(cleaned)} chars."}
+
+
+# Files already finished in a previous run (status ok in the checkpoint)
+def load_checkpoint(path: str) -> Dict[str, Dict[str, Any]]:
+    done: Dict[str, Dict[str, Any]] = {}
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                continue  # torn last line from an interrupted run
+            if rec.get("status") == "ok":
+                done[rec["file"]] = rec
+    return done
+
+
+_BROKEN_GRACE_S = 10.0  # wait for a broken pool's futures to fail before giving up
+_NODE_STATS = {"files": 0, "errors": 0, "fallback_plans": 0, "profile_s": 0.0, "plan_s": 0.0, "apply_s": 0.0}
+
+
+def _list_files(root: str) -> List[str]:
+    return sorted(
+        os.path.join(d, fn)
+        for d, _, files in os.walk(root)
+        for fn in files if fn.lower().endswith(_BATCH_EXTS)
+    )
+
+
+# Run every supported file under `root` (or an explicit list of paths).
+# max_concurrency bounds files in flight across all stages; cpu_workers sizes the
+# process pool for profile/apply and llm_workers the thread pool for planning.
+# Returns per-node-type throughput stats.
+def run_batch(
+    root: Any,
+    out_dir: str = "cleaned_uploads/batch",
+    user_goal: str = "prepare for ML",
+    checkpoint_path: Optional[str] = None,
+    max_concurrency: int = 32,
+    cpu_workers: Optional[int] = None,
+    llm_workers: int = 8,
+) -> Dict[str, Any]:
+    files = _list_files(root) if isinstance(root, str) else list(root)
+    base = root if isinstance(root, str) else os.path.commonpath([os.path.dirname(os.path.abspath(p)) for p in files] or ["."])
+    os.makedirs(out_dir, exist_ok=True)
+    checkpoint_path = checkpoint_path or os.path.join(out_dir, "checkpoint.jsonl")
+    done = load_checkpoint(checkpoint_path)
+    todo = [p for p in files if os.path.abspath(p) not in done]
+
+    slots = threading.BoundedSemaphore(max_concurrency)
+    lock = threading.Lock()
+    finished = threading.Event()
+    broken = threading.Event()  # a pool worker died; the pool takes no more work
+    pending = set(todo)
+    instrument = level_name()  # worker processes don't see the caller's context
+    stats: Dict[str, Dict[str, float]] = {}
+
+    def record(kind: str, stage: str, seconds: float) -> None:
+        with lock:
+            k = stats.setdefault(kind, dict(_NODE_STATS))
+            k[f"{stage}_s"] += seconds
+
+    def finish(path: str, kind: str, rec: Dict[str, Any]) -> None:
+        rec.update({"file": os.path.abspath(path), "kind": kind})
+        with lock:
+            if path not in pending:
+                return  # already given up on after the pool broke
+            pending.discard(path)
+            k = stats.setdefault(kind, dict(_NODE_STATS))
+            k["files"] += 1
+            k["errors"] += rec["status"] == "error"
+            k["fallback_plans"] += rec["status"] == "fallback"
+            ckpt.write(json.dumps(rec, default=str) + "\n")
+            ckpt.flush()
+            if not pending:
+                finished.set()
+        slots.release()
+
+    def failed(path: str, kind: str, stage: str, e: Exception) -> None:
+        if isinstance(e, BrokenExecutor):
+            broken.set()
+        finish(path, kind, {"status": "error", "stage": stage, "error": str(e) or type(e).__name__})
+
+    # Submit from a done-callback: an exception raised there would be swallowed by
+    # concurrent.futures and the file would never finish, so it is recorded instead
+    def submit(pool, stage: str, path: str, kind: str, fn, *args):
+        try:
+            return pool.submit(fn, *args)
+        except Exception as e:  # BrokenProcessPool once a worker died, or shut down
+            failed(path, kind, stage, e)
+            return None
+
+    def start(path: str) -> None:
+        kind = route_file(path)
+        rel = os.path.relpath(os.path.abspath(path), os.path.abspath(base))
+        out_name = rel.replace(os.sep, "__")
+        t0 = time.perf_counter()
+
+        def on_profiled(fut):
+            record(kind, "profile", time.perf_counter() - t0)
+            try:
+                profile = fut.result()
+            except Exception as e:
+                failed(path, kind, "profile", e)
+                return
+            t1 = time.perf_counter()
+            nxt = submit(llm_pool, "plan", path, kind, _plan_file, kind, profile, user_goal)
+            if nxt is not None:
+                nxt.add_done_callback(lambda f: on_planned(f, t1))
+
+        def on_planned(fut, t1):
+            record(kind, "plan", time.perf_counter() - t1)
+            try:
+                plan = fut.result()
+            except Exception as e:
+                failed(path, kind, "plan", e)
+                return
+            t2 = time.perf_counter()
+            nxt = submit(cpu_pool, "apply", path, kind, call_instrumented, instrument,
+                         _apply_file, kind, path, plan, out_dir, out_name)
+            if nxt is not None:
+                nxt.add_done_callback(lambda f: on_done(f, plan, t2))
+
+        def on_done(fut, plan, t2):
+            record(kind, "apply", time.perf_counter() - t2)
+            try:
+                res = fut.result()
+            except Exception as e:
+                failed(path, kind, "apply", e)
+                return
+            finish(path, kind, {"status": "ok" if is_real_plan(plan) else "fallback", "plan": plan, **res})
+
+        nxt = submit(cpu_pool, "profile", path, kind, _profile_file, kind, path)
+        if nxt is not None:
+            nxt.add_done_callback(on_profiled)
+
+    t_start = time.perf_counter()
+    with open(checkpoint_path, "a", encoding="utf-8") as ckpt, \
+         ProcessPoolExecutor(max_workers=cpu_workers) as cpu_pool, \
+         ThreadPoolExecutor(max_workers=llm_workers, thread_name_prefix="llm") as llm_pool:
+        for path in todo:
+            slots.acquire()
+            start(path)
+        # A broken pool fails its outstanding futures, which finishes their files;
+        # anything still unaccounted for after a grace period is recorded as an error
+        broken_at = None
+        while todo and not finished.wait(1.0):
+            if broken.is_set():
+                broken_at = broken_at or time.monotonic()
+                if time.monotonic() - broken_at > _BROKEN_GRACE_S:
+                    for path in list(pending):
+                        finish(path, route_file(path), {"status": "error", "stage": "pool",
+                                                        "error": "worker pool broke before this file finished"})
+                    break
+    wall = time.perf_counter() - t_start
+
+    # Per node type: files/sec over the run plus average time in each stage
+    for k in stats.values():
+        n = max(1, k["files"])
+        k["files_per_sec"] = round(k["files"] / wall, 3) if wall > 0 else 0.0
+        for stage in ("profile", "plan", "apply"):
+            k[f"avg_{stage}_s"] = round(k.pop(f"{stage}_s") / n, 4)
+    return {
+        "total_files": len(files),
+        "skipped_from_checkpoint": len(files) - len(todo),
+        "processed": len(todo),
+        "seconds": round(wall, 3),
+        "checkpoint": checkpoint_path,
+        "by_node": stats,
+    }
+
+
+if __name__ == "__main__":
+    # python batch_runner.py <input_dir> [out_dir]
+    if len(sys.argv) < 2:
+        print("usage: python batch_runner.py <input_dir> [out_dir]")
+        sys.exit(1)
+    result = run_batch(sys.argv[1], *(sys.argv[2:3]))
+    print(json.dumps(result, indent=2))
@@ -0,0 +1,406 @@
+import os
+import sys
+import json
+import time
+import fnmatch
+import platform
+import argparse
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.generators import csv_columns, make_csv, make_image, make_text
+
+# Benchmark suite for the three agents, the preview path and the API endpoints.
+#
+#   python -m benchmarks.bench                        # quick preset, all scenarios
+#   python -m benchmarks.bench --preset full --only "visual.*"
+#   python -m benchmarks.bench --save-baseline        # store results as the baseline
+#   python -m benchmarks.bench --baseline benchmarks/baseline.json --tolerance 0.15
+#
+# Each scenario runs in its own spawned process (so peak RSS is per scenario),
+# with LLM planners stubbed to fixed plans and the result cache disabled.
+# Results are written as JSON; with a baseline, scenarios whose median latency
+# grew by more than the tolerance are reported and the exit status is 1.
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, "baseline.json")
+DEFAULT_OUT = os.path.join(BENCH_DIR, "results", "latest.json")
+
+PRESETS: Dict[str, Dict[str, Any]] = {
+    "quick": {"rows": 20_000, "cols": 10, "null_rate": 0.05, "pages": 50, "words": 300,
+              "resolutions": [(256, 256), (1024, 768)], "repeat": 5, "warmup": 1},
+    "full": {"rows": 500_000, "cols": 20, "null_rate": 0.05, "pages": 1000, "words": 400,
+             "resolutions": [(256, 256), (1024, 768), (4096, 3072)], "repeat": 15, "warmup": 2},
+}
+
+
+# --- Fixed plans standing in for the LLM ----------------------------------------
+
+def tabular_plan(cols: int) -> Dict[str, Any]:
+    num = csv_columns(cols, "num")
+    return {"ops": [
+        *({"op": "impute", "col": c, "strategy": "median"} for c in num),
+        *({"op": "cast", "col": c, "to": "int"} for c in csv_columns(cols, "intstr")),
+        {"op": "trim_whitespace", "cols": csv_columns(cols, "str")},
+        *({"op": "parse_dates", "col": c} for c in csv_columns(cols, "date")),
+        {"op": "outliers", "cols": num, "method": "iqr", "threshold": 1.5, "action": "cap"},
+        {"op": "scale", "cols": num, "method": "standard"},
+    ], "notes": "benchmark plan"}
+
+
+TEXT_PLAN = {"ops": [{"op": "remove_boilerplate"}, {"op": "lowercase"}, {"op": "remove_punctuation"},
+                     {"op": "normalize_whitespace"}, {"op": "remove_stopwords"}, {"op": "lemmatize"}],
+             "notes": "benchmark plan"}
+
+VISUAL_PLAN = {"ops": [{"op": "resize", "width": 224, "height": 224},
+                       {"op": "denoise", "method": "gaussian", "ksize": 5},
+                       {"op": "normalize", "method": "minmax"}],
+               "reasoning": "benchmark plan", "notes": "benchmark plan"}
+
+AUGMENT_PLAN = {"ops": [{"op": "resize", "width": 224, "height": 224},
+                        {"op": "augment", "mode": "ml_training", "rotation_range": 15,
+                         "zoom_range": 0.1, "horizontal_flip": True, "num_variants": 8, "seed": 0}],
+                "reasoning": "benchmark plan", "notes": "benchmark plan"}
+
+
+# Replace every LLM entry point (including names api_server imported) with a
+# canned plan, so scenarios measure our code and not network latency.
+def stub_llm(cols: int) -> None:
+    import agents.structured as structured
+    import agents.text as text
+    import agents.visual as visual
+    structured.llm_make_tabular_plan = lambda profile, user_goal="": tabular_plan(cols)
+    text.llm_make_text_plan = lambda profile, user_goal="": dict(TEXT_PLAN)
+    visual.llm_make_visual_plan = lambda profile, user_goal="", dataset_info=None: dict(VISUAL_PLAN)
+    visual.llm_explain_step = lambda step, profile, user_goal: "benchmark explanation"
+    if "api_server" in sys.modules:
+        api = sys.modules["api_server"]
+        api.llm_make_visual_plan = visual.llm_make_visual_plan
+        api.llm_explain_step = visual.llm_explain_step
+
+
+# --- Scenarios ----------------------------------------------------------------------
+# A scenario builder takes (preset, work_dir) and returns (fn, units, unit):
+# fn() runs one iteration; if it returns an execution log (a list), its op
+# metrics feed the per-op breakdown. units is the amount of data one iteration
+# processes, used for throughput.
+
+Scenario = Callable[[Dict[str, Any], str], Tuple[Callable[[], Any], float, str]]
+SCENARIOS: Dict[str, Scenario] = {}
+
+
+def scenario(name: str):
+    def register(builder: Scenario) -> Scenario:
+        SCENARIOS[name] = builder
+        return builder
+    return register
+
+
+def _csv(p, wd):
+    return make_csv(wd, p["rows"], p["cols"], p["null_rate"])
+
+
+def _text(p, wd):
+    return make_text(wd, p["pages"], p["words"])
+
+
+@scenario("tabular.profile")
+def _tabular_profile(p, wd):
+    from agents.structured import profile_tabular
+    path = _csv(p, wd)
+    return (lambda: profile_tabular(path)), p["rows"], "rows"
+
+
+@scenario("tabular.apply")
+def _tabular_apply(p, wd):
+    from agents.structured import apply_tabular_plan
+    path, plan = _csv(p, wd), tabular_plan(p["cols"])
+    return (lambda: apply_tabular_plan(path, plan)[1]), p["rows"], "rows"
+
+
+@scenario("tabular.e2e")
+def _tabular_e2e(p, wd):
+    from agents.structured import run_structured_data_logic
+    path, out = _csv(p, wd), os.path.join(wd, "bench_cleaned.csv")
+    return (lambda: run_structured_data_logic(path, out_path=out)[0]["execution_log"]), p["rows"], "rows"
+
+
+@scenario("text.profile")
+def _text_profile(p, wd):
+    from agents.text import profile_text
+    path = _text(p, wd)
+    return (lambda: profile_text(path)), os.path.getsize(path), "bytes"
+
+
+@scenario("text.apply")
+def _text_apply(p, wd):
+    from agents.text import apply_text_plan, load_raw_text
+    raw = load_raw_text(_text(p, wd))
+    return (lambda: apply_text_plan(raw, TEXT_PLAN)[1]), len(raw), "chars"
+
+
+@scenario("text.e2e")
+def _text_e2e(p, wd):
+    from agents.text import run_text_data_logic
+    path = _text(p, wd)
+    return (lambda: run_text_data_logic(path)[0]["execution_log"]), os.path.getsize(path), "bytes"
+
+
+def _image_scenarios() -> None:
+    for w, h in sorted({r for preset in PRESETS.values() for r in preset["resolutions"]}):
+        res = f"{w}x{h}"
+
+        def profile(p, wd, w=w, h=h):
+            from agents.visual import profile_image
+            path = make_image(wd, w, h)
+            return (lambda: profile_image(path)), w * h, "pixels"
+
+        def apply(p, wd, w=w, h=h, plan=VISUAL_PLAN):
+            from agents.visual import apply_visual_plan
+            path, out = make_image(wd, w, h), os.path.join(wd, "bench_out")
+            return (lambda: apply_visual_plan(path, plan, out)[1]), w * h, "pixels"
+
+        def augment(p, wd, w=w, h=h):
+            return apply(p, wd, w, h, AUGMENT_PLAN)
+
+        def preview(p, wd, w=w, h=h):
+            from agents.visual import process_for_preview
+            with open(make_image(wd, w, h), "rb") as f:
+                data = f.read()
+            return (lambda: process_for_preview(data, VISUAL_PLAN)), w * h, "pixels"
+
+        def e2e(p, wd, w=w, h=h):
+            from agents.visual import run_visual_data_logic
+            path, out = make_image(wd, w, h), os.path.join(wd, "bench_out")
+            return (lambda: run_visual_data_logic(path, out_dir=out)[0]["execution_log"]), w * h, "pixels"
+
+        SCENARIOS[f"visual.profile@{res}"] = profile
+        SCENARIOS[f"visual.apply@{res}"] = apply
+        SCENARIOS[f"visual.augment@{res}"] = augment
+        SCENARIOS[f"visual.preview@{res}"] = preview
+        SCENARIOS[f"visual.e2e@{res}"] = e2e
+
+
+_image_scenarios()
+
+
+def _api_client(wd: str, cols: int):
+    os.makedirs(os.path.join(wd, "api"), exist_ok=True)
+    os.chdir(os.path.join(wd, "api"))  # the server creates temp_uploads/ etc. in cwd
+    from fastapi.testclient import TestClient
+    import api_server
+    stub_llm(cols)
+    return TestClient(api_server.app)
+
+
+@scenario("api.generate_plan.csv")
+def _api_generate_plan(p, wd):
+    path = _csv(p, wd)
+    client = _api_client(wd, p["cols"])
+    with open(path, "rb") as f:
+        data = f.read()
+
+    def run():
+        r = client.post("/generate-plan", files={"file": ("bench.csv", data, "text/csv")},
+                        data={"user_goal": "prepare for ML"})
+        r.raise_for_status()
+    return run, 1, "requests"
+
+
+@scenario("api.apply_plan.image")
+def _api_apply_plan(p, wd):
+    w, h = p["resolutions"][-1]
+    with open(make_image(wd, w, h), "rb") as f:
+        data = f.read()
+    client = _api_client(wd, p["cols"])
+    files = [("files", (f"img{i}.png", data, "image/png")) for i in range(8)]
+
+    def run():
+        r = client.post("/apply-plan", files=files, data={"plan": json.dumps(VISUAL_PLAN)})
+        r.raise_for_status()
+    return run, len(files), "images"
+
+
+@scenario("api.preview_image")
+def _api_preview(p, wd):
+    w, h = p["resolutions"][-1]
+    with open(make_image(wd, w, h), "rb") as f:
+        data = f.read()
+    client = _api_client(wd, p["cols"])
+
+    def run():
+        r = client.post("/preview-image", files={"file": ("p.png", data, "image/png")},
+                        data={"plan": json.dumps(VISUAL_PLAN)})
+        r.raise_for_status()
+    return run, 1, "requests"
+
+
+# --- Measurement ------------------------------------------------------------------
+
+def _percentiles(samples_ms: List[float]) -> Dict[str, float]:
+    a = np.asarray(samples_ms)
+    return {"p50": float(np.percentile(a, 50)), "p90": float(np.percentile(a, 90)),
+            "p99": float(np.percentile(a, 99)), "mean": float(a.mean()), "min": float(a.min())}
+
+
+def _peak_rss_mb() -> Optional[float]:
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+# Run one scenario (in the current process) and summarise it. Per-op timings come
+# from the execution-log metrics, so every iteration runs instrumented at the
+# cheap "time" level.
+def run_scenario(name: str, preset: Dict[str, Any], work_dir: str) -> Dict[str, Any]:
+    os.environ.pop("PRISM_CACHE_DIR", None)  # measure real work, not cache hits
+    work_dir = os.path.abspath(work_dir)
+    try:
+        stub_llm(preset["cols"])
+        fn, units, unit = SCENARIOS[name](preset, work_dir)
+        stub_llm(preset["cols"])
+    except ImportError as e:
+        return {"scenario": name, "skipped": f"missing dependency: {e}"}
+
+    from agents.instrument import instrumented
+    latencies, ops = [], {}
+    try:
+        for _ in range(preset["warmup"]):
+            fn()
+        with instrumented("time"):
+            for _ in range(preset["repeat"]):
+                t0 = time.perf_counter()
+                log = fn()
+                latencies.append((time.perf_counter() - t0) * 1000)
+                for entry in log if isinstance(log, list) else []:
+                    if "metrics" in entry:
+                        ops.setdefault(entry["op"], []).append(entry["metrics"]["wall_ms"])
+    except Exception as e:
+        return {"scenario": name, "error": f"{type(e).__name__}: {e}"}
+    lat = _percentiles(latencies)
+    return {
+        "scenario": name,
+        "iterations": len(latencies),
+        "unit": unit,
+        "units_per_iteration": units,
+        "latency_ms": lat,
+        "throughput": {"iterations_per_s": 1000 / lat["mean"], f"{unit}_per_s": units * 1000 / lat["mean"]},
+        "peak_rss_mb": _peak_rss_mb(),
+        "ops": {op: _percentiles(v) for op, v in ops.items()},
+    }
+
+
+def _environment() -> Dict[str, Any]:
+    import pandas, cv2
+    try:
+        rev = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                             text=True, cwd=BENCH_DIR, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        rev = None
+    return {"python": platform.python_version(), "platform": platform.platform(),
+            "cpu_count": os.cpu_count(), "numpy": np.__version__, "pandas": pandas.__version__,
+            "opencv": cv2.__version__, "git_rev": rev}
+
+
+def run_suite(names: List[str], preset_name: str, work_dir: str, isolate: bool = True,
+              repeat: Optional[int] = None) -> Dict[str, Any]:
+    preset = dict(PRESETS[preset_name])
+    if repeat:
+        preset["repeat"] = repeat
+    results = []
+    for name in names:
+        print(f"  {name} ...", file=sys.stderr, flush=True)
+        if isolate:
+            ctx = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as ex:
+                res = ex.submit(run_scenario, name, preset, work_dir).result()
+        else:
+            res = run_scenario(name, preset, work_dir)
+        results.append(res)
+    return {"preset": preset_name, "params": preset, "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "environment": _environment(), "results": results}
+
+
+# Compare median latency per scenario; ratio > 1 + tolerance is a regression
+def compare(current: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[Dict[str, Any]]:
+    base = {r["scenario"]: r for r in baseline.get("results", []) if "latency_ms" in r}
+    rows = []
+    for r in current["results"]:
+        b = base.get(r["scenario"])
+        if b is None or "latency_ms" not in r:
+            continue
+        ratio = r["latency_ms"]["p50"] / max(b["latency_ms"]["p50"], 1e-9)
+        rows.append({"scenario": r["scenario"], "baseline_p50_ms": b["latency_ms"]["p50"],
+                     "p50_ms": r["latency_ms"]["p50"], "ratio": ratio,
+                     "status": "regression" if ratio > 1 + tolerance
+                     else "improvement" if ratio < 1 - tolerance else "ok"})
+    return rows
+
+
+def _print_table(current: Dict[str, Any], comparison: List[Dict[str, Any]]) -> None:
+    cmp_by = {c["scenario"]: c for c in comparison}
+    print(f"{'scenario':34} {'p50 ms':>10} {'p90 ms':>10} {'throughput':>22} {'rss MB':>8}  vs baseline")
+    for r in current["results"]:
+        if "latency_ms" not in r:
+            print(f"{r['scenario']:34} {'skipped' if 'skipped' in r else 'FAILED'} "
+                  f"({r.get('skipped') or r.get('error')})")
+            continue
+        lat, unit = r["latency_ms"], r["unit"]
+        tput = f"{r['throughput'][f'{unit}_per_s']:.3g} {unit}/s"
+        rss = f"{r['peak_rss_mb']:.0f}" if r["peak_rss_mb"] is not None else "-"
+        c = cmp_by.get(r["scenario"])
+        vs = f"{c['ratio']:.2f}x {c['status']}" if c else ""
+        print(f"{r['scenario']:34} {lat['p50']:10.2f} {lat['p90']:10.2f} {tput:>22} {rss:>8}  {vs}")
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    ap = argparse.ArgumentParser(description="PRISM benchmark suite")
+    ap.add_argument("--preset", choices=sorted(PRESETS), default="quick")
+    ap.add_argument("--only", action="append", help="glob over scenario names (repeatable)")
+    ap.add_argument("--repeat", type=int, help="override the preset's iteration count")
+    ap.add_argument("--work-dir", default=os.path.join(BENCH_DIR, ".data"))
+    ap.add_argument("--out", default=DEFAULT_OUT)
+    ap.add_argument("--baseline", default=DEFAULT_BASELINE)
+    ap.add_argument("--save-baseline", action="store_true", help="write results to --baseline")
+    ap.add_argument("--tolerance", type=float, default=0.15)
+    ap.add_argument("--no-isolate", action="store_true", help="run scenarios in this process")
+    ap.add_argument("--list", action="store_true")
+    args = ap.parse_args(argv)
+
+    names = sorted(SCENARIOS)
+    if args.only:
+        names = [n for n in names if any(fnmatch.fnmatch(n, pat) for pat in args.only)]
+    preset = PRESETS[args.preset]
+    res_tags = {f"{w}x{h}" for w, h in preset["resolutions"]}
+    names = [n for n in names if "@" not in n or n.split("@")[1] in res_tags]
+    if args.list:
+        print("\n".join(names))
+        return 0
+
+    current = run_suite(names, args.preset, args.work_dir, not args.no_isolate, args.repeat)
+    comparison = []
+    if not args.save_baseline and os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as f:
+            comparison = compare(current, json.load(f), args.tolerance)
+        current["comparison"] = comparison
+
+    for path in [args.out] + ([args.baseline] if args.save_baseline else []):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(current, f, indent=2)
+    _print_table(current, comparison)
+    failed = any("error" in r for r in current["results"])
+    return 1 if failed or any(c["status"] == "regression" for c in comparison) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
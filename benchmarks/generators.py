@@ -0,0 +1,116 @@
+import os
+import json
+import hashlib
+from typing import Any, Dict, List
+
+import numpy as np
+import pandas as pd
+import cv2
+
+# Seeded synthetic inputs for the benchmark suite. Every generator is a pure
+# function of its parameters (seed included), and files are cached under the
+# work dir by a hash of those parameters, so repeated runs benchmark the same
+# bytes and generation time never counts towards a scenario.
+
+
+def _cached_path(work_dir: str, kind: str, params: Dict[str, Any], ext: str) -> str:
+    tag = hashlib.blake2b(json.dumps(params, sort_keys=True).encode(), digest_size=8).hexdigest()
+    os.makedirs(work_dir, exist_ok=True)
+    return os.path.join(work_dir, f"{kind}_{tag}{ext}")
+
+
+CSV_COLUMN_KINDS = ("num", "intstr", "str", "cat", "date")
+
+
+# CSV with `cols` columns cycling through numeric (normal, with a few outliers),
+# integer-as-string, padded string, category and date columns. `null_rate` of
+# the cells in every column are blanked.
+def make_csv(work_dir: str, rows: int = 100_000, cols: int = 10, null_rate: float = 0.05,
+             seed: int = 0) -> str:
+    params = {"rows": rows, "cols": cols, "null_rate": null_rate, "seed": seed}
+    path = _cached_path(work_dir, "csv", params, ".csv")
+    if os.path.exists(path):
+        return path
+    rng = np.random.default_rng(seed)
+    data = {}
+    for i in range(cols):
+        kind = CSV_COLUMN_KINDS[i % len(CSV_COLUMN_KINDS)]
+        name = f"{kind}_{i}"
+        if kind == "num":
+            col = rng.normal(50, 10, rows)
+            spikes = rng.random(rows) < 0.01
+            col[spikes] *= rng.choice([-20, 20], spikes.sum())
+            col = pd.Series(col)
+        elif kind == "intstr":
+            col = pd.Series(rng.integers(0, 10_000, rows).astype(str))
+        elif kind == "str":
+            words = np.array(["alpha", "beta", "gamma", "delta", "epsilon"])
+            col = pd.Series(["  " + w + " " for w in words[rng.integers(0, len(words), rows)]])
+        elif kind == "cat":
+            col = pd.Series(rng.choice(["red", "green", "blue"], rows))
+        else:
+            days = rng.integers(0, 3650, rows)
+            col = pd.Series(pd.Timestamp("2015-01-01") + pd.to_timedelta(days, unit="D")).dt.strftime("%Y-%m-%d")
+        col = col.astype(object)
+        col[rng.random(rows) < null_rate] = None
+        data[name] = col
+    pd.DataFrame(data).to_csv(path, index=False)
+    return path
+
+
+def csv_columns(cols: int, kind: str) -> List[str]:
+    return [f"{CSV_COLUMN_KINDS[i % len(CSV_COLUMN_KINDS)]}_{i}" for i in range(cols)
+            if CSV_COLUMN_KINDS[i % len(CSV_COLUMN_KINDS)] == kind]
+
+
+# Text corpus of `pages` pages, each framed by the same header/footer lines
+# (boilerplate for remove_boilerplate) around Zipf-distributed words with
+# punctuation, so stopword removal and lemmatisation see realistic input.
+def make_text(work_dir: str, pages: int = 200, words_per_page: int = 400,
+              boilerplate_lines: int = 3, seed: int = 0) -> str:
+    params = {"pages": pages, "words_per_page": words_per_page,
+              "boilerplate_lines": boilerplate_lines, "seed": seed}
+    path = _cached_path(work_dir, "text", params, ".txt")
+    if os.path.exists(path):
+        return path
+    rng = np.random.default_rng(seed)
+    vocab = _VOCAB + [f"term{i}" for i in range(5000)]
+    header = [f"ACME Corp Confidential - Internal Report line {i}" for i in range(boilerplate_lines)]
+    footer = ["Copyright 2024 ACME Corp. All rights reserved.", "Page footer"]
+    lines: List[str] = []
+    for p in range(pages):
+        lines.extend(header)
+        ranks = np.minimum(rng.zipf(1.3, words_per_page), len(vocab)) - 1
+        words = [vocab[r] for r in ranks]
+        for start in range(0, words_per_page, 12):
+            chunk = words[start:start + 12]
+            lines.append(" ".join(chunk).capitalize() + rng.choice([".", ",", "!", "?"]) + f" (p{p})")
+        lines.extend(footer)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines))
+    return path
+
+
+_VOCAB = ("the of and to a in is was for on that with as by it at from this be are "
+          "running studies better data models were cleaned values images samples features "
+          "training learning analysis results process processing was been has have").split()
+
+
+# Natural-looking test image: smooth gradients plus shapes and Gaussian noise,
+# so resize/denoise/normalize and PNG/JPEG encoding do representative work.
+def make_image(work_dir: str, width: int = 1024, height: int = 768, fmt: str = "png",
+               seed: int = 0) -> str:
+    params = {"width": width, "height": height, "fmt": fmt, "seed": seed}
+    path = _cached_path(work_dir, "image", params, "." + fmt)
+    if os.path.exists(path):
+        return path
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[0:height, 0:width].astype(np.float32)
+    img = np.stack([xx / width * 255, yy / height * 255, (xx + yy) / (width + height) * 255], -1)
+    for _ in range(12):
+        cx, cy = int(rng.integers(0, width)), int(rng.integers(0, height))
+        r = int(rng.integers(max(2, min(width, height) // 20), max(3, min(width, height) // 5)))
+        cv2.circle(img, (cx, cy), r, tuple(float(v) for v in rng.integers(0, 256, 3)), -1)
+    img += rng.normal(0, 12, img.shape).astype(np.float32)
+    cv2.imwrite(path, np.clip(img, 0, 255).astype(np.uint8))
+    return path
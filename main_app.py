@@ -1,4 +1,3 @@
-import os
 from typing import TypedDict, Any
 from langgraph.graph import StateGraph, END
 from dotenv import load_dotenv
@@ -10,6 +9,7 @@ load_dotenv()
 from agents.structured import run_structured_data_logic
 from agents.text import run_text_data_logic
 from agents.visual import run_visual_data_logic
+from batch_runner import route_file
 
 # Define the shared state schema for our graph nodes
 class DataTeamState(TypedDict, total=False):
@@ -48,16 +48,9 @@ def visual_data_node(state: DataTeamState) -> DataTeamState:
     }
 
 # Router function: pick node based on file extension
+# (shared with batch_runner so single-file and batch runs route the same way)
 def file_type_router(state: DataTeamState) -> str:
-    path = state["file_path"].lower()
-    if path.endswith(".csv"):
-        return "structured"
-    if path.endswith((".pdf", ".txt", ".md")):
-        return "text"
-    if path.endswith((".jpg", ".jpeg", ".png")):
-        return "visual"
-    # Default to text for unknown extensions
-    return "text"
+    return route_file(state["file_path"])
 
 # Build the state graph
 workflow = StateGraph(DataTeamState)
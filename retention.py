@@ -0,0 +1,253 @@
+import os
+import json
+import time
+import shutil
+import zipfile
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional
+
+# Retention for batch results under cleaned_uploads/<batch_id>. Each finished
+# batch gets a pre-built archive in cleaned_uploads/_archives/<batch_id>.zip plus a
+# small <batch_id>.json sidecar, so downloads (and their retries / ranged resumes)
+# are plain file reads - nothing is reprocessed or re-zipped.
+#
+# A background sweeper evicts batches whose last access is older than the TTL,
+# then the least recently accessed ones until the results fit in the disk quota.
+# Batches still being written (pinned, or reported busy by the job registry) are
+# never evicted. The sweeper also clears upload temp files orphaned by crashes;
+# a batch's uploads live in temp_uploads/<batch_id> and are kept while it is busy.
+
+_ARCHIVES = "_archives"
+
+
+def _is_batch_id(name: str) -> bool:
+    return len(name) == 32 and all(c in "0123456789abcdef" for c in name)
+
+
+def _tree_bytes(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for fn in files:
+            try:
+                total += os.path.getsize(os.path.join(root, fn))
+            except OSError:
+                pass
+    return total
+
+
+class ResultRetention:
+    def __init__(self,
+                 root: str = "cleaned_uploads",
+                 ttl_s: float = 24 * 3600,
+                 quota_bytes: int = 10 * 1024 ** 3,
+                 interval_s: float = 60.0,
+                 temp_dir: Optional[str] = "temp_uploads",
+                 temp_ttl_s: float = 3600,
+                 is_busy: Optional[Callable[[str], bool]] = None):
+        self.root = root
+        self.ttl_s = ttl_s
+        self.quota_bytes = quota_bytes
+        self.interval_s = interval_s
+        self.temp_dir = temp_dir
+        self.temp_ttl_s = temp_ttl_s
+        self.is_busy = is_busy or (lambda batch_id: False)
+        self._archives = os.path.join(root, _ARCHIVES)
+        os.makedirs(self._archives, exist_ok=True)
+        self._pinned: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.last_sweep: Dict[str, Any] = {}
+
+    @classmethod
+    def from_env(cls, **kwargs: Any) -> "ResultRetention":
+        env = os.environ.get
+        return cls(ttl_s=float(env("PRISM_RESULT_TTL_S", 24 * 3600)),
+                   quota_bytes=int(env("PRISM_RESULT_QUOTA_BYTES", 10 * 1024 ** 3)),
+                   interval_s=float(env("PRISM_RETENTION_INTERVAL_S", 60)),
+                   **kwargs)
+
+    # --- Paths and metadata ---------------------------------------------------------
+
+    def batch_dir(self, batch_id: str) -> str:
+        return os.path.join(self.root, batch_id)
+
+    def archive_path(self, batch_id: str) -> str:
+        return os.path.join(self._archives, f"{batch_id}.zip")
+
+    def _meta_path(self, batch_id: str) -> str:
+        return os.path.join(self._archives, f"{batch_id}.json")
+
+    def meta(self, batch_id: str) -> Optional[Dict[str, Any]]:
+        if not _is_batch_id(batch_id):
+            return None
+        try:
+            with open(self._meta_path(batch_id), encoding="utf-8") as f:
+                meta = json.load(f)
+            meta["last_access"] = os.path.getmtime(self._meta_path(batch_id))
+        except (OSError, ValueError):
+            return None
+        meta["expires_at"] = meta["last_access"] + self.ttl_s
+        return meta
+
+    # Record an access so TTL and quota eviction treat the batch as recently used
+    def touch(self, batch_id: str) -> None:
+        try:
+            os.utime(self._meta_path(batch_id))
+        except OSError:
+            pass
+
+    @contextmanager
+    def pinned(self, batch_id: str):
+        """Protect a batch from eviction while it is being written."""
+        with self._lock:
+            self._pinned[batch_id] = self._pinned.get(batch_id, 0) + 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._pinned[batch_id] -= 1
+                if not self._pinned[batch_id]:
+                    del self._pinned[batch_id]
+
+    # --- Archives ---------------------------------------------------------------------
+
+    # Zip the batch dir into its archive (temp file + rename, so a concurrent
+    # download never sees a partial zip) and write the sidecar. Idempotent.
+    def finalize(self, batch_id: str, data_type: str, status: str = "completed",
+                 summary: Optional[Dict[str, Any]] = None) -> str:
+        src, dst = self.batch_dir(batch_id), self.archive_path(batch_id)
+        os.makedirs(src, exist_ok=True)
+        files: List[Dict[str, Any]] = []
+        tmp = f"{dst}.{threading.get_ident()}.tmp"
+        with zipfile.ZipFile(tmp, "w", zipfile.ZIP_DEFLATED) as zf:
+            for root, _, names in os.walk(src):
+                for fn in sorted(names):
+                    path = os.path.join(root, fn)
+                    zf.write(path, fn)
+                    files.append({"name": fn, "bytes": os.path.getsize(path)})
+        os.replace(tmp, dst)
+        meta = {"batch_id": batch_id, "data_type": data_type, "status": status,
+                "created": time.time(), "files": files,
+                "archive_bytes": os.path.getsize(dst), "summary": summary}
+        tmp_meta = f"{self._meta_path(batch_id)}.tmp"
+        with open(tmp_meta, "w", encoding="utf-8") as f:
+            json.dump(meta, f, default=str)
+        os.replace(tmp_meta, self._meta_path(batch_id))
+        return dst
+
+    # Path to a single result file, or None (names come from the manifest only)
+    def file_path(self, batch_id: str, name: str) -> Optional[str]:
+        meta = self.meta(batch_id)
+        if meta is None or name not in {f["name"] for f in meta["files"]}:
+            return None
+        for root, _, names in os.walk(self.batch_dir(batch_id)):
+            if name in names:
+                return os.path.join(root, name)
+        return None
+
+    # --- Eviction -----------------------------------------------------------------------
+
+    def evict(self, batch_id: str) -> int:
+        freed = _tree_bytes(self.batch_dir(batch_id))
+        shutil.rmtree(self.batch_dir(batch_id), ignore_errors=True)
+        for path in (self.archive_path(batch_id), self._meta_path(batch_id)):
+            try:
+                freed += os.path.getsize(path)
+                os.remove(path)
+            except OSError:
+                pass
+        return freed
+
+    def _protected(self, batch_id: str) -> bool:
+        with self._lock:
+            if batch_id in self._pinned:
+                return True
+        return self.is_busy(batch_id)
+
+    def sweep(self) -> Dict[str, Any]:
+        now = time.time()
+        batches = []  # (last_access, batch_id, bytes)
+        for name in os.listdir(self.root):
+            if not _is_batch_id(name):
+                continue
+            try:
+                last = os.path.getmtime(self._meta_path(name))
+            except OSError:
+                # Never finalized (crashed or still running): age from the dir itself
+                last = os.path.getmtime(self.batch_dir(name))
+            size = _tree_bytes(self.batch_dir(name))
+            for path in (self.archive_path(name), self._meta_path(name)):
+                if os.path.exists(path):
+                    size += os.path.getsize(path)
+            batches.append((last, name, size))
+        # Sidecars whose batch dir is already gone
+        for fn in os.listdir(self._archives):
+            batch_id = fn.split(".", 1)[0]
+            if _is_batch_id(batch_id) and not os.path.isdir(self.batch_dir(batch_id)) \
+                    and not self._protected(batch_id):
+                try:
+                    os.remove(os.path.join(self._archives, fn))
+                except OSError:
+                    pass
+
+        batches.sort()
+        total = sum(b[2] for b in batches)
+        expired = evicted = freed = 0
+        for last, batch_id, size in batches:
+            over_ttl = now - last > self.ttl_s
+            over_quota = total > self.quota_bytes * 0.9
+            if not (over_ttl or over_quota) or self._protected(batch_id):
+                continue
+            freed += self.evict(batch_id)
+            total -= size
+            expired += over_ttl
+            evicted += not over_ttl
+
+        temp_removed = temp_bytes = 0
+        if self.temp_dir and os.path.isdir(self.temp_dir):
+            for entry in os.scandir(self.temp_dir):
+                try:
+                    if now - entry.stat().st_mtime <= self.temp_ttl_s:
+                        continue
+                    if entry.is_file():
+                        os.remove(entry.path)
+                        temp_removed += 1
+                    elif entry.is_dir() and _is_batch_id(entry.name) \
+                            and not self._protected(entry.name):
+                        # Uploads of a batch that is no longer queued or running
+                        shutil.rmtree(entry.path)
+                        temp_removed += 1
+                except OSError:
+                    pass
+            temp_bytes = _tree_bytes(self.temp_dir)
+
+        # result_bytes / temp_bytes double as the disk usage metrics between sweeps
+        self.last_sweep = {"at": now, "batches": len(batches), "expired": expired,
+                           "evicted_for_quota": evicted, "freed_bytes": freed,
+                           "result_bytes": total, "temp_files_removed": temp_removed,
+                           "temp_bytes": temp_bytes}
+        return self.last_sweep
+
+    # --- Background sweeper ---------------------------------------------------------
+
+    def start(self) -> None:
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="result-retention", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+    def _loop(self) -> None:
+        while not self._stop.is_set():
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f"Retention sweep failed: {e}")
+            self._stop.wait(self.interval_s)